@@ -0,0 +1,282 @@
+import math
+import Storage
+
+"""
+Aggregates used when grouping data points in Python. Each takes points
+one at a time with add() and holds a bounded amount of state no matter
+how many points it sees, and two aggregates of the same kind can be
+combined with merge(), so buckets (or sources) can be computed apart and
+put together afterwards.
+"""
+
+class Count:
+  def __init__(self):
+    self.count = 0
+
+  def add(self, ts, value):
+    self.count += 1
+
+  def merge(self, other):
+    self.count += other.count
+
+  def result(self):
+    return self.count
+
+class Sum:
+  def __init__(self):
+    self.sum = 0
+
+  def add(self, ts, value):
+    self.sum += value
+
+  def merge(self, other):
+    self.sum += other.sum
+
+  def result(self):
+    return self.sum
+
+class Min:
+  def __init__(self):
+    self.value = None
+
+  def add(self, ts, value):
+    if self.value is None or value < self.value:
+      self.value = value
+
+  def merge(self, other):
+    if other.value is not None:
+      self.add(None, other.value)
+
+  def result(self):
+    return self.value
+
+class Max:
+  def __init__(self):
+    self.value = None
+
+  def add(self, ts, value):
+    if self.value is None or value > self.value:
+      self.value = value
+
+  def merge(self, other):
+    if other.value is not None:
+      self.add(None, other.value)
+
+  def result(self):
+    return self.value
+
+class First:
+  """
+  Value of the point with the lowest timestamp, regardless of the order
+  points are added in
+  """
+  def __init__(self):
+    self.ts = None
+    self.value = None
+
+  def add(self, ts, value):
+    if self.ts is None or ts < self.ts:
+      self.ts = ts
+      self.value = value
+
+  def merge(self, other):
+    if other.ts is not None:
+      self.add(other.ts, other.value)
+
+  def result(self):
+    return self.value
+
+class Last:
+  """
+  Value of the point with the highest timestamp
+  """
+  def __init__(self):
+    self.ts = None
+    self.value = None
+
+  def add(self, ts, value):
+    if self.ts is None or ts > self.ts:
+      self.ts = ts
+      self.value = value
+
+  def merge(self, other):
+    if other.ts is not None:
+      self.add(other.ts, other.value)
+
+  def result(self):
+    return self.value
+
+class Mean:
+  def __init__(self):
+    self.count = 0
+    self.sum = 0
+
+  def add(self, ts, value):
+    self.count += 1
+    self.sum += value
+
+  def merge(self, other):
+    self.count += other.count
+    self.sum += other.sum
+
+  def result(self):
+    if self.count == 0:
+      return None
+    return float(self.sum) / self.count
+
+class StdDev:
+  """
+  Population standard deviation (same as STDDEV_POP() in SQL), kept as a
+  running mean and sum of squared differences so it stays accurate for
+  large values
+  """
+  def __init__(self):
+    self.count = 0
+    self.mean = 0.0
+    self.m2 = 0.0
+
+  def add(self, ts, value):
+    self.count += 1
+    delta = value - self.mean
+    self.mean += delta / self.count
+    self.m2 += delta * (value - self.mean)
+
+  def merge(self, other):
+    if other.count == 0:
+      return
+    count = self.count + other.count
+    delta = other.mean - self.mean
+    self.m2 += other.m2 + delta * delta * self.count * other.count / count
+    self.mean += delta * other.count / count
+    self.count = count
+
+  def result(self):
+    if self.count == 0:
+      return None
+    return math.sqrt(self.m2 / self.count)
+
+class TDigest:
+  """
+  Quantile sketch (a merging t-digest). Values are kept as centroids, a
+  mean and a weight, which are only allowed to grow big in the middle of
+  the distribution. This keeps the error low near the ends while holding
+  no more than about compression centroids. With fewer points than that,
+  every point is its own centroid and quantiles are exact.
+  """
+  def __init__(self, compression=100):
+    self.compression = compression
+    self.centroids = []
+    self.buffer = []
+    self.min = None
+    self.max = None
+
+  def add(self, value, weight=1):
+    if self.min is None or value < self.min:
+      self.min = value
+    if self.max is None or value > self.max:
+      self.max = value
+    self.buffer.append((value, weight))
+    if len(self.buffer) >= self.compression * 5:
+      self._compress()
+
+  def merge(self, other):
+    if other.min is None:
+      return
+    if self.min is None or other.min < self.min:
+      self.min = other.min
+    if self.max is None or other.max > self.max:
+      self.max = other.max
+    self.buffer.extend(other.centroids)
+    self.buffer.extend(other.buffer)
+    self._compress()
+
+  def _k(self, q):
+    return self.compression * math.asin(2 * q - 1) / (2 * math.pi)
+
+  def _q(self, k):
+    if k >= self.compression / 4.0:
+      return 1.0
+    return (math.sin(k * 2 * math.pi / self.compression) + 1) / 2
+
+  def _compress(self):
+    if not self.buffer:
+      return
+    points = sorted(self.centroids + self.buffer)
+    total = float(sum([weight for value, weight in points]))
+    result = []
+    mean, weight = points[0]
+    before = 0
+    limit = self._q(self._k(0) + 1)
+    for value, w in points[1:]:
+      if (before + weight + w) / total <= limit:
+        weight += w
+        mean += (value - mean) * w / weight
+      else:
+        result.append((mean, weight))
+        before += weight
+        limit = self._q(self._k(before / total) + 1)
+        mean = value
+        weight = w
+    result.append((mean, weight))
+    self.centroids = result
+    self.buffer = []
+
+  def quantile(self, q):
+    """
+    Estimated value at quantile q (0 to 1), None if nothing was added
+    """
+    self._compress()
+    if not self.centroids:
+      return None
+    total = sum([weight for mean, weight in self.centroids])
+    target = q * total
+    # Each centroid sits at the middle of the weight it covers, in between
+    # two of them the value is interpolated
+    before = 0
+    previous = None
+    for mean, weight in self.centroids:
+      center = before + weight / 2.0
+      if target == center:
+        return mean
+      if target < center:
+        if previous is None:
+          return self.min
+        return previous[0] + (mean - previous[0]) * (target - previous[1]) / (center - previous[1])
+      previous = (mean, center)
+      before += weight
+    return self.max
+
+class Quantile:
+  def __init__(self, percentile=50):
+    self.q = percentile / 100.0
+    self.digest = TDigest()
+
+  def add(self, ts, value):
+    self.digest.add(value)
+
+  def merge(self, other):
+    self.digest.merge(other.digest)
+
+  def result(self):
+    return self.digest.quantile(self.q)
+
+MODES = {
+  Storage.GROUP_BY_SUM : Sum,
+  Storage.GROUP_BY_AVERAGE : Mean,
+  Storage.GROUP_BY_MEDIAN : Quantile,
+  Storage.GROUP_BY_MIN : Min,
+  Storage.GROUP_BY_MAX : Max,
+  Storage.GROUP_BY_COUNT : Count,
+  Storage.GROUP_BY_FIRST : First,
+  Storage.GROUP_BY_LAST : Last,
+  Storage.GROUP_BY_STDDEV : StdDev,
+  Storage.GROUP_BY_PERCENTILE : Quantile
+}
+
+def create(mode, percentile=50):
+  """
+  Returns a new aggregate for one of the Storage.GROUP_BY_* modes
+  """
+  if mode == Storage.GROUP_BY_PERCENTILE:
+    return Quantile(percentile)
+  return MODES[mode]()
@@ -0,0 +1,564 @@
+import time
+import threading
+import logging
+import Storage
+from WriteBuffer import WriteBuffer
+from Metrics import Metrics
+
+# Columns of a source and a type as listed by sources() and types()
+SOURCE_COLUMNS = ['uuid', 'sid', 'name', 'type', 'accuracy', 'parameters']
+TYPE_COLUMNS = ['uuid', 'name', 'description']
+
+def sid_key(sid):
+  """
+  sids are stored as text, so 123 and '123' are the same source
+  """
+  if isinstance(sid, basestring):
+    return sid
+  return unicode(sid)
+
+class Backend:
+  """
+  Interface every storage backend implements. The server only talks to
+  storage through these calls, so backends can be swapped with --backend.
+
+  Backends which set COMPACTS can also move old data into a compressed
+  form, see compact().
+
+  The backend keeps all registered sources (along with the latest value
+  recorded for each) and types in memory, the methods dealing with that
+  are shared by all backends and live here. Backends add them using
+  _add_source() and _add_type() and everything about them is answered
+  from memory.
+
+  When the server runs more than one process or keeps the latest values
+  in a file, they are instead kept in shared memory (see share()) and
+  sources or types registered by another process are picked up by
+  _refresh().
+  """
+
+  # True if compact() is implemented
+  COMPACTS = False
+
+  def __init__(self):
+    # Holds all the sources AND the last recorded value (based on time)
+    self.cache = {}
+    self._types = {}
+    # uuid of each source by sid, see sid_key()
+    self.sids = {}
+    # Bumped whenever a source or type is added, see registry_version()
+    self.version = 0
+    # Protects cache and _types, since requests are served from many threads
+    self.lock = threading.RLock()
+    self.buffer = None
+    # Storage.Shared when there is more than one process, along with the
+    # generation of it which the cache is up to date with
+    self.shared = None
+    self.generation = 0
+    # Held while the cache is brought up to date, and set to have the
+    # thread doing so in the background get on with it, see _refresh()
+    self.reloading = threading.Lock()
+    self.stale = threading.Event()
+    self.reloader = None
+    # Background jobs waiting to be started, see hold()
+    self.held = None
+    # Called with the data points recorded, see watch()
+    self.watchers = []
+    # Timings and counters of the backend, see Metrics
+    self.metrics = Metrics()
+
+  def connect(self, user, pw, host, database):
+    """
+    Opens the storage, returns True on success. Backends which don't need
+    all of the arguments ignore them.
+    """
+    raise NotImplementedError
+
+  def disconnect(self):
+    """
+    Writes anything still buffered and closes the storage
+    """
+    if self.buffer is not None:
+      self.buffer.close()
+      self.buffer = None
+
+  def validate(self):
+    """
+    Tests if the storage is setup properly or if it needs to be installed
+    or upgraded, returns one of the Storage.VALIDATION_* values.
+    """
+    raise NotImplementedError
+
+  def setup(self, force, partition=False):
+    """
+    Creates the tables (or whatever the backend uses). If force is True,
+    existing data is deleted first.
+    """
+    raise NotImplementedError
+
+  def upgrade(self, partition=False, batch=50000):
+    """
+    Brings an older install up to date, see validate()
+    """
+    return True
+
+  def prepare(self):
+    """
+    Loads the sources, types and latest values into memory. Must be called
+    before any of the calls below.
+
+    If the latest values were restored from the last run (see share()),
+    only the sources are loaded and _restore() checks that they match,
+    otherwise the latest values are read from storage and handed to
+    _publish().
+    """
+    raise NotImplementedError
+
+  def share(self, shared):
+    """
+    Keeps the latest values in shared (a Storage.Shared) instead, so every
+    process forked later sees the same. Called before prepare().
+    """
+    with self.lock:
+      self.shared = shared
+      self.generation = shared.get('generation')
+
+  def _restoring(self):
+    """
+    True if the latest values in shared memory are those of the last run
+    """
+    return self.shared is not None and self.shared.restored
+
+  def _restore(self):
+    """
+    Checks that the restored latest values belong to the sources in the
+    cache. If they don't, they are cleared and False is returned, in
+    which case prepare() has to read them from storage after all.
+    """
+    with self.lock:
+      for source in self.cache.values():
+        if not self.shared.fits(source['id']) or self.shared.owner(source['id']) not in ['', source['uuid']]:
+          logging.warning('Restored latest values do not match the sources, reading them from storage')
+          self.shared.clear()
+          return False
+    return True
+
+  def _publish(self):
+    """
+    Copies the latest values read from storage into shared memory
+    """
+    if self.shared is None:
+      return
+    with self.lock:
+      for source in self.cache.values():
+        if source['latest'] is not None and self.shared.fits(source['id']):
+          self.shared.update(source['id'], source['uuid'], source['latest']['value'], source['latest']['ts'])
+
+  def hold(self):
+    """
+    Holds back the threads of background jobs until resume() is called,
+    since threads don't survive forking
+    """
+    self.held = []
+
+  def resume(self):
+    held = self.held or []
+    self.held = None
+    for job in held:
+      self._spawn(*job)
+
+  def _spawn(self, target, name, args=()):
+    """
+    Runs target in a background thread, or notes it for resume() if jobs
+    are held
+    """
+    if self.held is not None:
+      self.held.append((target, name, args))
+      return
+    thread = threading.Thread(target=target, args=args, name=name)
+    thread.daemon = True
+    thread.start()
+
+  def forked(self):
+    """
+    Called in a new process after forking. Connections inherited from the
+    parent are still used by it, so they must be left alone and new ones
+    opened instead.
+    """
+    pass
+
+  def _refresh(self, wait=True):
+    """
+    Loads sources and types registered by other processes since the cache
+    was last brought up to date. Without wait, the cache is used as it is
+    and brought up to date by a thread meanwhile, for callers answering
+    from memory on the IOLoop.
+    """
+    if self.shared is None:
+      return
+    generation = self.shared.get('generation')
+    if generation == self.generation:
+      return
+    if wait:
+      with self.reloading:
+        self._reload_to(generation)
+      return
+    with self.lock:
+      if self.reloader is None:
+        self.reloader = threading.Thread(target=self._reloader, name='Reload')
+        self.reloader.daemon = True
+        self.reloader.start()
+    self.stale.set()
+
+  def outdated(self):
+    """
+    Returns True if other processes registered sources or types which
+    aren't in the cache yet, see refresh()
+    """
+    return self.shared is not None and self.shared.get('generation') != self.generation
+
+  def refresh(self):
+    """
+    Brings the cache up to date, reading from storage if outdated().
+    Lookups answered from memory (sid2uuid(), query_latest(), sources(),
+    types()) don't wait for this, callers which can't miss a source
+    just registered through another process run it on a thread first.
+    """
+    self._refresh()
+
+  def _reloader(self):
+    while True:
+      self.stale.wait()
+      self.stale.clear()
+      with self.reloading:
+        self._reload_to(self.shared.get('generation'))
+
+  def _reload_to(self, generation):
+    """
+    Brings the cache up to date with generation, caller must hold
+    self.reloading
+    """
+    if self.generation >= generation:
+      return
+    if not self._reload():
+      # Tried again on the next lookup
+      return
+    with self.lock:
+      self.generation = generation
+
+  def _reload(self):
+    """
+    Adds any sources and types missing from the cache, see _refresh().
+    Returns True on success.
+    """
+    raise NotImplementedError
+
+  def _add_source(self, row):
+    """
+    Adds a source to the cache, row holds its SOURCE_COLUMNS (with the id
+    of the type), id and latest. Caller must hold the lock.
+    """
+    # The same whether it came from the client or from storage
+    row['sid'] = sid_key(row['sid'])
+    self.cache[row['uuid']] = row
+    self.sids[row['sid']] = row['uuid']
+    self.version += 1
+
+  def _add_type(self, row):
+    """
+    Adds a type to the cache, row holds its TYPE_COLUMNS and id. Caller
+    must hold the lock.
+    """
+    self._types[row['uuid']] = row
+    self.version += 1
+
+  def _changed(self):
+    """
+    Tells other processes that a source or type was registered
+    """
+    if self.shared is not None:
+      self.shared.increment('generation')
+
+  def watch(self, callback):
+    """
+    Calls callback with a list of (uuid, value, ts) every time data points
+    are recorded, from the thread recording them. Must be quick, since the
+    points are being recorded while it runs.
+    """
+    self.watchers.append(callback)
+
+  def _recorded(self, points):
+    for callback in self.watchers:
+      try:
+        callback(points)
+      except Exception:
+        logging.exception('Failed to hand on recorded data points')
+
+  def start_buffer(self, size, interval):
+    """
+    Enables write-behind of data points. Instead of storing every point
+    on its own, points are queued and handed to _flush() in batches once
+    size points are pending or interval seconds have passed.
+    """
+    self.buffer = WriteBuffer(self._flush, size, interval)
+    self.metrics.reading('datapoints_buffer_points', 'gauge', 'Data points buffered until the next write', self.buffer.pending)
+    return True
+
+  def compact(self, age):
+    """
+    Compresses data points older than age seconds, returns True on success
+    """
+    raise NotImplementedError
+
+  def start_compactor(self, age, interval=3600):
+    """
+    Runs compact() in the background every interval seconds
+    """
+    if not self.COMPACTS:
+      logging.error('This backend does not support compaction')
+      return False
+    self._spawn(self._compactor, 'Compactor', (age, interval))
+    return True
+
+  def _compactor(self, age, interval):
+    while True:
+      start = time.time()
+      try:
+        self.compact(age)
+      except Exception:
+        logging.exception('Compaction failed')
+      time.sleep(max(0, interval - (time.time() - start)))
+
+  def start_rollups(self, resolutions):
+    """
+    Keeps aggregates of every source in buckets of each of resolutions
+    (seconds), which grouped queries are answered from when possible
+    """
+    logging.error('This backend does not support rollups')
+    return False
+
+  def start_query_cache(self, size):
+    """
+    Keeps the results of grouped queries in memory, up to size rows, for
+    clients asking for the same again
+    """
+    logging.error('This backend does not cache query results')
+    return False
+
+  def stats(self):
+    """
+    Returns a dict of counters describing how the backend is doing
+    """
+    return {}
+
+  def _flush(self, points):
+    """
+    Stores a list of (source id, value, ts) tuples in one go, returns True
+    on success
+    """
+    raise NotImplementedError
+
+  def add_type(self, uuid, name, description):
+    raise NotImplementedError
+
+  def add_source(self, uuid, sid, name, type, accuracy = 1, parameters = ''):
+    raise NotImplementedError
+
+  def record(self, uuid, value, ts = None, sync = False):
+    """
+    Records a data point. When the write buffer is enabled, the point is
+    queued and the call returns right away unless sync is True, in which
+    case it waits until the point has been stored.
+    """
+    raise NotImplementedError
+
+  def record_many(self, points, sync = False):
+    """
+    Records a list of (uuid, value, ts) tuples, where ts may be None for
+    the current time. Points which can't be recorded are left out and the
+    rest are stored in one go (a single transaction where the backend has
+    them). Returns a list of (index, reason) for the points left out, or
+    None if storing the rest failed.
+    """
+    now = int(round(time.time()))
+    accepted = []
+    rejected = []
+    self._refresh()
+    with self.lock:
+      for i, (uuid, value, ts) in enumerate(points):
+        ts = now if ts is None else self._ts(ts)
+        source = self.cache.get(uuid, None)
+        if source is None:
+          rejected.append((i, 'No such UUID'))
+          continue
+        if ts < 1:
+          rejected.append((i, 'Timestamp has to be at least 1'))
+          continue
+        value = self._value(value)
+        if value is None:
+          rejected.append((i, 'Value out of range'))
+          continue
+        accepted.append((uuid, source['id'], value, ts))
+    if not accepted:
+      return rejected
+
+    stored = [(id, value, ts) for uuid, id, value, ts in accepted]
+    if self.buffer is not None:
+      if not self.buffer.put_many(stored, sync):
+        return None
+    elif not self._flush(stored):
+      return None
+    with self.lock:
+      for uuid, id, value, ts in accepted:
+        self._update_latest(uuid, value, ts)
+    self._recorded([(uuid, value, ts) for uuid, id, value, ts in accepted])
+    return rejected
+
+  def _value(self, value):
+    """
+    Value as the backend stores it, None if it can't be stored. Values are
+    32 bit integers, same as the int column in SQL.
+    """
+    if value < -2**31 or value >= 2**31:
+      return None
+    return value
+
+  def _ts(self, ts):
+    """
+    Timestamp as the backend stores it
+    """
+    return ts
+
+  def _update_latest(self, uuid, value, ts):
+    with self.lock:
+      source = self.cache[uuid]
+      if self.shared is not None and self.shared.fits(source['id']):
+        self.shared.update(source['id'], uuid, value, ts)
+      elif source['latest'] is None or source['latest']['ts'] <= ts:
+        source['latest'] = {
+          'value' : value,
+          'ts' : ts
+        }
+
+  def _latest(self, source):
+    """
+    Latest value of a source from the cache as a dict of value and ts,
+    None if it has none
+    """
+    if self.shared is not None and self.shared.fits(source['id']):
+      return self.shared.latest(source['id'])
+    return source['latest']
+
+  def registry_version(self):
+    """
+    Returns a number which changes whenever a source or type is added, so
+    listings of them can be kept until then
+    """
+    self._refresh(False)
+    return self.version
+
+  def sid2uuid(self, sid):
+    """
+    Returns the uuid of the source registered with sid, None if there is
+    none
+    """
+    self._refresh(False)
+    with self.lock:
+      return self.sids.get(sid_key(sid), None)
+
+  def type(self, uuid):
+    return self.types(uuid)
+
+  def types(self, uuid=None):
+    """
+    Returns registered types, or just the one of uuid
+    """
+    self._refresh(False)
+    with self.lock:
+      if uuid is None:
+        rows = sorted(self._types.values(), key=lambda row: row['id'])
+      elif uuid in self._types:
+        rows = [self._types[uuid]]
+      else:
+        logging.error('No such UUID: "%s"', repr(uuid))
+        return None
+      return [dict([(column, row[column]) for column in TYPE_COLUMNS]) for row in rows]
+
+  def source(self, uuid):
+    return self.sources(uuid)
+
+  def sources(self, uuid = None):
+    """
+    Returns registered sources and details about them, or just the one of
+    uuid
+    """
+    self._refresh(False)
+    with self.lock:
+      if uuid is None:
+        rows = sorted(self.cache.values(), key=lambda row: row['id'])
+      elif uuid in self.cache:
+        rows = [self.cache[uuid]]
+      else:
+        logging.error('No such UUID: "%s"', repr(uuid))
+        return None
+      return [dict([(column, row[column]) for column in SOURCE_COLUMNS]) for row in rows]
+
+  def query_latest(self, uuids):
+    self._refresh(False)
+    result = []
+    with self.lock:
+      for u in uuids:
+        source = self.cache.get(u, None)
+        if source is None:
+          continue
+        latest = self._latest(source)
+        if latest is not None:
+          result.append({'uuid' : u, 'ts' : latest['ts'] , 'value' : latest['value']})
+    return result
+
+  def query(self, uuids, ts_start = None, ts_end = None, count = 0, groupby = 0, mode = Storage.GROUP_BY_NONE, descending=False, percentile=50):
+    """
+    Retrieves data points from UUIDs
+    ts_start will limit results on timestamp. If negative, counts back from now
+    ts_end will limit results on timestamp. If negative, counts back from now
+    Limit to count (zero means no limit)
+    Group it by groupby seconds (zero means no grouping)
+
+    Grouping essentially breaks it down to groups of X seconds, using
+    the described method in mode (one of Storage.GROUP_BY_*). For
+    GROUP_BY_PERCENTILE, percentile (0 to 100) is the one to return.
+
+    Returns iterator which allows streaming of data
+    """
+    raise NotImplementedError
+
+class Iterator:
+  """
+  Result of a query, rows are read one at a time using next()
+  """
+  def __init__(self, error=None):
+    self.error = error
+
+  def getError(self):
+    """
+    Returns any potential error, if no error condition exist,
+    it will return None
+    """
+    return self.error
+
+  def next(self):
+    """
+    Advances to the next record, returning current
+    Record is a dict of uuid, ts, value
+
+    If no more record exists, the function returns None
+    """
+    return None
+
+  def release(self):
+    """
+    Early bailout, after calling this function, the iterator
+    resources are freed and you should not use it anymore.
+    """
+    if self.error is None:
+      self.error = 'Iterator is released'
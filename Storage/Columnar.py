@@ -0,0 +1,549 @@
+import os
+import json
+import mmap
+import time
+import bisect
+import shutil
+import struct
+import logging
+import threading
+import Storage
+import Backend
+import Stream
+import Compression
+import Aggregate
+
+# One data point on disk, timestamp followed by value
+RECORD = struct.Struct('<qi')
+# Header of a packed chunk: number of points, first and last timestamp and
+# the last value
+PACKED = struct.Struct('<iqqi')
+
+def search(buf, count, ts):
+  """
+  Binary search for the first record in buf with a timestamp >= ts
+  """
+  lo = 0
+  hi = count
+  while lo < hi:
+    mid = (lo + hi) // 2
+    if RECORD.unpack_from(buf, mid * RECORD.size)[0] < ts:
+      lo = mid + 1
+    else:
+      hi = mid
+  return lo
+
+class Chunk:
+  """
+  One segment file holding the points of a source for a period of time,
+  sorted on timestamp. Only the first and last timestamp of it are kept
+  in memory, which is enough to tell if a query needs to look inside.
+  """
+  def __init__(self, path):
+    self.path = path
+    self.count = 0
+    self.first = None
+    self.last = None
+    self.value = None
+
+  def load(self):
+    """
+    Reads the first and last record. A record only partially written (the
+    server died while appending) is cut off.
+    """
+    size = os.path.getsize(self.path)
+    self.count = size // RECORD.size
+    with open(self.path, 'r+b') as f:
+      if size % RECORD.size:
+        logging.warning('Truncating partial record in %s' % self.path)
+        f.truncate(self.count * RECORD.size)
+      if self.count == 0:
+        return
+      self.first = RECORD.unpack(f.read(RECORD.size))[0]
+      f.seek((self.count - 1) * RECORD.size)
+      self.last, self.value = RECORD.unpack(f.read(RECORD.size))
+
+  def write(self, points):
+    """
+    Stores a list of (ts, value) sorted on ts. If all of them are newer
+    than what the chunk holds, they are appended. Otherwise the chunk is
+    merged with them and replaced, so readers holding the old file keep
+    seeing it.
+    """
+    if self.last is None or points[0][0] > self.last:
+      with open(self.path, 'ab') as f:
+        f.write(b''.join([RECORD.pack(ts, value) for ts, value in points]))
+        f.flush()
+        os.fsync(f.fileno())
+      self.count += len(points)
+    else:
+      merged = dict(self.read())
+      merged.update(points)
+      points = sorted(merged.items())
+      with open(self.path + '.tmp', 'wb') as f:
+        f.write(b''.join([RECORD.pack(ts, value) for ts, value in points]))
+        f.flush()
+        os.fsync(f.fileno())
+      os.rename(self.path + '.tmp', self.path)
+      self.count = len(points)
+    self.first = points[0][0] if self.first is None else min(self.first, points[0][0])
+    if self.last is None or points[-1][0] >= self.last:
+      self.last, self.value = points[-1]
+
+  def read(self, ts_start=None, ts_end=None, descending=False):
+    """
+    Yields (ts, value) between ts_start and ts_end. The file is memory
+    mapped and the range found with a binary search, so only the pages
+    holding the requested points are ever read.
+    """
+    try:
+      f = open(self.path, 'rb')
+    except IOError:
+      # Replaced since the query started, nothing we can do
+      return
+    try:
+      size = os.fstat(f.fileno()).st_size
+      count = size // RECORD.size
+      if count == 0:
+        return
+      buf = mmap.mmap(f.fileno(), count * RECORD.size, access=mmap.ACCESS_READ)
+      try:
+        lo = 0 if ts_start is None else search(buf, count, ts_start)
+        hi = count if ts_end is None else search(buf, count, ts_end + 1)
+        while lo < hi:
+          if descending:
+            hi -= 1
+            yield RECORD.unpack_from(buf, hi * RECORD.size)
+          else:
+            yield RECORD.unpack_from(buf, lo * RECORD.size)
+            lo += 1
+      finally:
+        buf.close()
+    finally:
+      f.close()
+
+class PackedChunk:
+  """
+  A chunk which has been compacted, the points are compressed (see
+  Compression) and decoded as they are read. Packed chunks are never
+  written to, late points turn them back into a Chunk (see
+  Columnar._flush).
+  """
+  def __init__(self, path):
+    self.path = path
+    self.count = 0
+    self.first = None
+    self.last = None
+    self.value = None
+
+  def load(self):
+    with open(self.path, 'rb') as f:
+      self.count, self.first, self.last, self.value = PACKED.unpack(f.read(PACKED.size))
+
+  def pack(self, points):
+    """
+    Writes a list of (ts, value) sorted on ts
+    """
+    with open(self.path + '.tmp', 'wb') as f:
+      f.write(PACKED.pack(len(points), points[0][0], points[-1][0], points[-1][1]))
+      f.write(Compression.encode(points))
+      f.flush()
+      os.fsync(f.fileno())
+    os.rename(self.path + '.tmp', self.path)
+    self.count = len(points)
+    self.first = points[0][0]
+    self.last, self.value = points[-1]
+
+  def read(self, ts_start=None, ts_end=None, descending=False):
+    """
+    Yields (ts, value) between ts_start and ts_end
+    """
+    try:
+      with open(self.path, 'rb') as f:
+        data = f.read()
+    except IOError:
+      return
+    for point in Compression.read(data[PACKED.size:], ts_start, ts_end, descending):
+      yield point
+
+class Columnar(Backend.Backend):
+  """
+  Stores data points in plain files instead of a database, for sources
+  recording at a high rate. Each source has a directory of its own with
+  one file per chunk (a day by default) of fixed size records, appended
+  to as points arrive. Sources and types are kept in registry.json.
+
+  Chunks older than a given age can be packed by compact(), which
+  replaces the file with a compressed copy of it.
+
+  Only one process may use the directory at a time.
+  """
+  # Version of the layout created by setup()
+  SCHEMA_VERSION = 1
+  # Seconds of data per chunk file
+  CHUNK = 86400
+  COMPACTS = True
+
+  def __init__(self, chunk = CHUNK):
+    Backend.Backend.__init__(self)
+    self.chunk = chunk
+    self.path = None
+    self.registry = None
+    # Chunk objects for each source id, keyed on the start of the chunk
+    # along with a sorted list of these starts
+    self.chunks = {}
+    self.starts = {}
+    # Serializes writes to the files
+    self.write_lock = threading.Lock()
+
+  def connect(self, user, pw, host, database):
+    """
+    Only database is used, it's the directory to store data in
+    """
+    if database is None:
+      logging.error('Columnar storage needs a directory to use as database')
+      return False
+    self.path = database
+    if os.path.exists(self.path) and not os.path.isdir(self.path):
+      logging.error('%s is not a directory' % self.path)
+      return False
+    return True
+
+  def _registry(self):
+    return os.path.join(self.path, 'registry.json')
+
+  def _load(self):
+    with open(self._registry(), 'r') as f:
+      return json.load(f)
+
+  def _save(self):
+    """
+    Writes the registry, the old one is replaced only once the new one is
+    safely on disk. Caller must hold the lock.
+    """
+    filename = self._registry()
+    with open(filename + '.tmp', 'w') as f:
+      json.dump(self.registry, f, indent=1)
+      f.flush()
+      os.fsync(f.fileno())
+    os.rename(filename + '.tmp', filename)
+
+  def validate(self):
+    if not os.path.exists(self._registry()):
+      return Storage.VALIDATION_NOT_SETUP
+    try:
+      registry = self._load()
+    except (IOError, ValueError) as err:
+      logging.error('Unable to read registry: ' + repr(err))
+      return Storage.VALIDATION_ERROR
+    if registry.get('schema', 0) < self.SCHEMA_VERSION:
+      return Storage.VALIDATION_NEED_UPGRADE
+    return Storage.VALIDATION_OK
+
+  def setup(self, force, partition=False):
+    if partition:
+      logging.warning('Columnar storage is already split by time, ignoring partitioning')
+    try:
+      if force and os.path.isdir(self.path):
+        if os.path.exists(self._registry()):
+          logging.info('Removing ' + self._registry())
+          os.remove(self._registry())
+        for name in os.listdir(self.path):
+          if name.isdigit():
+            logging.info('Removing data of source ' + name)
+            shutil.rmtree(os.path.join(self.path, name))
+
+      if self.validate() != Storage.VALIDATION_NOT_SETUP:
+        logging.error('Database is not in a state where it can be setup')
+        return False
+
+      if not os.path.isdir(self.path):
+        os.makedirs(self.path)
+      with self.lock:
+        self.registry = {
+          'schema' : self.SCHEMA_VERSION,
+          'sources' : [],
+          'types' : []
+        }
+        self._save()
+    except (IOError, OSError) as err:
+      logging.error('Failed to setup %s: %s' % (self.path, repr(err)))
+      return False
+    return True
+
+  def prepare(self):
+    start = time.time()
+    try:
+      registry = self._load()
+    except (IOError, ValueError) as err:
+      logging.error('Unable to read registry: ' + repr(err))
+      return False
+
+    with self.lock:
+      self.registry = registry
+      for row in registry['types']:
+        self._add_type(dict(row))
+
+      withdata = 0
+      for row in registry['sources']:
+        source = dict(row)
+        source['latest'] = None
+        try:
+          self._index(source['id'])
+        except (IOError, OSError) as err:
+          logging.error('Failed to load data of %s: %s' % (source['uuid'], repr(err)))
+          return False
+        starts = self.starts[source['id']]
+        if starts:
+          withdata += 1
+          chunk = self.chunks[source['id']][starts[-1]]
+          source['latest'] = {
+            'value' : chunk.value,
+            'ts' : chunk.last
+          }
+        self._add_source(source)
+    # The newest chunks are read anyway, so the latest values are always
+    # taken from them
+    self._publish()
+    logging.info('Loaded %d sources (%d with data) in %.2fs' % (len(self.cache), withdata, time.time() - start))
+    return True
+
+  def _directory(self, id):
+    return os.path.join(self.path, str(id))
+
+  def _index(self, id):
+    """
+    Builds the index of chunks for a source from its directory
+    """
+    self.chunks[id] = {}
+    self.starts[id] = []
+    directory = self._directory(id)
+    if not os.path.isdir(directory):
+      return
+    names = os.listdir(directory)
+    for name in names:
+      if name.endswith('.dat'):
+        chunk = Chunk(os.path.join(directory, name))
+      elif name.endswith('.dpc'):
+        # A plain chunk for the same time means the server stopped while
+        # packing or unpacking it, the plain one holds all of the points
+        if name[:-4] + '.dat' in names:
+          os.remove(os.path.join(directory, name))
+          continue
+        chunk = PackedChunk(os.path.join(directory, name))
+      else:
+        continue
+      chunk.load()
+      if chunk.count == 0:
+        continue
+      start = int(name[:-4])
+      self.chunks[id][start] = chunk
+      self.starts[id].append(start)
+    self.starts[id].sort()
+
+  def _flush(self, points):
+    # Group the points by source and chunk, last point wins if a source
+    # has more than one for the same timestamp
+    pending = {}
+    for id, value, ts in points:
+      start = ts - ts % self.chunk
+      pending.setdefault((id, start), {})[ts] = value
+
+    with self.write_lock:
+      for key in sorted(pending):
+        id, start = key
+        try:
+          with self.lock:
+            chunk = self.chunks[id].get(start)
+          if chunk is None:
+            directory = self._directory(id)
+            if not os.path.isdir(directory):
+              os.makedirs(directory)
+            chunk = Chunk(os.path.join(directory, '%d.dat' % start))
+          elif isinstance(chunk, PackedChunk):
+            packed = chunk
+            chunk = Chunk(os.path.join(self._directory(id), '%d.dat' % start))
+            chunk.write(list(packed.read()))
+            with self.lock:
+              self.chunks[id][start] = chunk
+            os.remove(packed.path)
+          chunk.write(sorted(pending[key].items()))
+          with self.lock:
+            if start not in self.chunks[id]:
+              self.chunks[id][start] = chunk
+              bisect.insort(self.starts[id], start)
+        except (IOError, OSError, struct.error) as err:
+          logging.error('Failed to flush %d data points: %s' % (len(points), repr(err)))
+          return False
+    return True
+
+  def compact(self, age):
+    """
+    Packs the chunks of all sources which ended more than age seconds ago
+    """
+    cutoff = int(time.time()) - age
+    start = time.time()
+    packed = points = 0
+    with self.lock:
+      ids = list(self.chunks.keys())
+    for id in ids:
+      with self.lock:
+        starts = [s for s in self.starts[id] if s + self.chunk <= cutoff and isinstance(self.chunks[id][s], Chunk)]
+      for s in starts:
+        # One chunk at a time, so writes are only held up briefly
+        with self.write_lock:
+          chunk = self.chunks[id][s]
+          try:
+            data = list(chunk.read())
+            result = PackedChunk(os.path.join(self._directory(id), '%d.dpc' % s))
+            result.pack(data)
+            with self.lock:
+              self.chunks[id][s] = result
+            os.remove(chunk.path)
+          except (IOError, OSError) as err:
+            logging.error('Failed to compact %s: %s' % (chunk.path, repr(err)))
+            return False
+        packed += 1
+        points += len(data)
+    if packed:
+      logging.info('Compacted %d chunks (%d points) in %.2fs' % (packed, points, time.time() - start))
+    return True
+
+  def add_type(self, uuid, name, description):
+    with self.lock:
+      if uuid in self._types:
+        logging.error('Failed to add type: %s already exists' % uuid)
+        return False
+      row = {
+        'id' : max([t['id'] for t in self.registry['types']] + [0]) + 1,
+        'uuid' : uuid,
+        'name' : name,
+        'description' : description
+      }
+      self.registry['types'].append(row)
+      try:
+        self._save()
+      except (IOError, OSError) as err:
+        self.registry['types'].remove(row)
+        logging.error('Failed to add type: ' + repr(err))
+        return False
+      self._add_type(dict(row))
+    return True
+
+  def add_source(self, uuid, sid, name, type, accuracy = 1, parameters = ''):
+    with self.lock:
+      if type not in self._types:
+        return False
+      if uuid in self.cache or Backend.sid_key(sid) in self.sids:
+        logging.error('Failed to add source: %s or %s already exists' % (uuid, sid))
+        return False
+      row = {
+        'id' : max([s['id'] for s in self.registry['sources']] + [0]) + 1,
+        'uuid' : uuid,
+        'sid' : sid,
+        'name' : name,
+        'type' : self._types[type]['id'],
+        'accuracy' : accuracy,
+        'parameters' : parameters
+      }
+      self.registry['sources'].append(row)
+      try:
+        self._save()
+      except (IOError, OSError) as err:
+        self.registry['sources'].remove(row)
+        logging.error('Failed to add source: ' + repr(err))
+        return False
+      self.chunks[row['id']] = {}
+      self.starts[row['id']] = []
+      source = dict(row)
+      source['latest'] = None
+      self._add_source(source)
+    return True
+
+  def record(self, uuid, value, ts = None, sync = False):
+    ts = int(round(time.time())) if ts is None else self._ts(ts)
+    if ts < 1:
+      logging.warn('Cannot have timestamps less than 1, typically indicate issue :)')
+      return False
+    source = self.cache.get(uuid, None)
+    if source is None:
+      logging.warn('UUID %s does not exist' % uuid)
+      return False
+    value = self._value(value)
+    if value is None:
+      logging.warn('Value of %s is out of range' % uuid)
+      return False
+
+    if self.buffer is not None:
+      self._update_latest(uuid, value, ts)
+      self._recorded([(uuid, value, ts)])
+      return self.buffer.put((source['id'], value, ts), sync)
+
+    if not self._flush([(source['id'], value, ts)]):
+      return False
+    self._update_latest(uuid, value, ts)
+    self._recorded([(uuid, value, ts)])
+    return True
+
+  def _value(self, value):
+    # Records only hold integers
+    return Backend.Backend._value(self, int(round(value)))
+
+  def _ts(self, ts):
+    # Records hold whole seconds
+    return int(ts)
+
+  def _read(self, uuid, chunks, ts_start, ts_end, descending):
+    """
+    Yields the rows of one source from the given chunks, in order
+    """
+    if descending:
+      chunks = reversed(chunks)
+    for chunk in chunks:
+      for ts, value in chunk.read(ts_start, ts_end, descending):
+        yield {'uuid' : uuid, 'value' : value, 'ts' : ts}
+
+  def query(self, uuids, ts_start = None, ts_end = None, count = 0, groupby = 0, mode = Storage.GROUP_BY_NONE, descending=False, percentile=50):
+    grouped = mode != Storage.GROUP_BY_NONE and groupby > 0
+    if grouped and mode not in Aggregate.MODES:
+      logging.error('This database doesn\'t support desired grouping method')
+      return None
+
+    now = int(time.time())
+    if ts_start is not None and ts_start < 0:
+      ts_start = now + ts_start
+    if ts_end is not None and ts_end < 0:
+      ts_end = now + ts_end
+
+    streams = []
+    for u in uuids:
+      with self.lock:
+        if u not in self.cache:
+          continue
+        id = self.cache[u]['id']
+        # Only chunks which can hold points in the range are read, found
+        # by where they start and then their first and last point
+        starts = self.starts[id]
+        lo = 0
+        hi = len(starts)
+        if ts_start is not None:
+          lo = max(0, bisect.bisect_right(starts, ts_start) - 1)
+        if ts_end is not None:
+          hi = bisect.bisect_right(starts, ts_end)
+        chunks = []
+        for start in starts[lo:hi]:
+          chunk = self.chunks[id][start]
+          if ts_start is not None and chunk.last < ts_start:
+            continue
+          if ts_end is not None and chunk.first > ts_end:
+            continue
+          chunks.append(chunk)
+      rows = self._read(u, chunks, ts_start, ts_end, descending)
+      if grouped:
+        rows = Stream.group(rows, int(groupby), mode, percentile)
+      streams.append(rows)
+
+    rows = Stream.merge(streams, descending)
+    if count > 0:
+      rows = Stream.limit(rows, int(count))
+    return Stream.StreamIterator(rows)
@@ -0,0 +1,98 @@
+"""
+Compact encoding of the points of one source, used for data which is old
+enough that it's no longer expected to change.
+
+Sensors tend to report at a fixed interval and values change slowly, so
+rather than the timestamp and value of each point, the change in interval
+(delta of delta) and the change in value are stored. Both are zigzag
+encoded into variable length integers, which makes a point recorded at
+the usual interval with a small change in value take two bytes.
+
+The first byte is the format version, followed by the number of points.
+"""
+FORMAT = 1
+
+def _zigzag(n):
+  return n * 2 if n >= 0 else -n * 2 - 1
+
+def _varint(out, n):
+  while n > 0x7f:
+    out.append((n & 0x7f) | 0x80)
+    n >>= 7
+  out.append(n)
+
+def encode(points):
+  """
+  Encodes a list of (ts, value) sorted on ts, returns a byte string
+  """
+  out = bytearray([FORMAT])
+  _varint(out, len(points))
+  ts = delta = value = 0
+  for t, v in points:
+    _varint(out, _zigzag(t - ts - delta))
+    _varint(out, _zigzag(v - value))
+    delta = t - ts
+    ts = t
+    value = v
+  return bytes(out)
+
+def decode(data):
+  """
+  Yields the (ts, value) points held by data, in order
+  """
+  buf = bytearray(data)
+  if not buf or buf[0] != FORMAT:
+    raise ValueError('Unknown compression format')
+  pos = 1
+  ts = delta = value = 0
+
+  count = shift = 0
+  while True:
+    b = buf[pos]
+    pos += 1
+    count |= (b & 0x7f) << shift
+    shift += 7
+    if b < 0x80:
+      break
+
+  for i in range(count):
+    n = shift = 0
+    while True:
+      b = buf[pos]
+      pos += 1
+      n |= (b & 0x7f) << shift
+      shift += 7
+      if b < 0x80:
+        break
+    delta += (n >> 1) ^ -(n & 1)
+
+    n = shift = 0
+    while True:
+      b = buf[pos]
+      pos += 1
+      n |= (b & 0x7f) << shift
+      shift += 7
+      if b < 0x80:
+        break
+    value += (n >> 1) ^ -(n & 1)
+
+    ts += delta
+    yield ts, value
+
+def read(data, ts_start=None, ts_end=None, descending=False):
+  """
+  Yields the (ts, value) points held by data between ts_start and ts_end
+  """
+  points = decode(data)
+  if descending:
+    points = reversed(list(points))
+  for ts, value in points:
+    if ts_start is not None and ts < ts_start:
+      if descending:
+        break
+      continue
+    if ts_end is not None and ts > ts_end:
+      if descending:
+        continue
+      break
+    yield ts, value
@@ -0,0 +1,284 @@
+import heapq
+import time
+import Storage
+import Stream
+
+"""
+Reduces the data points of a range to about a given number per source,
+for when the result is going to be drawn and there are far more points
+than pixels to draw them on.
+
+The range is split into buckets of equal time and every source keeps a
+few of the points in each, picked so the line still looks the same:
+
+LTTB (Largest-Triangle-Three-Buckets) keeps the first and last point and
+one point per bucket, the one forming the largest triangle with the point
+kept in the bucket before and the average of the bucket after.
+
+MINMAX keeps the lowest and the highest point of each bucket, so no spike
+is ever lost.
+
+Points are read once, in order, and only the bucket being picked from
+and the one after it are held for each source. A source with no more
+points than asked for is returned as is.
+"""
+
+LTTB = 'lttb'
+MINMAX = 'minmax'
+
+class Largest:
+  """
+  Picks points of one source with LTTB, buckets are numbered in the
+  order points arrive
+  """
+  def __init__(self):
+    self.previous = None
+    self.current = None
+    self.following = None
+    self.index = None
+    self.last = None
+    self.last_index = None
+
+  @staticmethod
+  def buckets(points):
+    # The first and the last point are always kept
+    return points - 2
+
+  def add(self, index, row):
+    if self.previous is None:
+      self.previous = row
+      return [row]
+    # Until the stream ends it isn't known which point is the last one, so
+    # each point is only put in its bucket once the next one arrives
+    result = []
+    if self.last is not None:
+      result = self._place(self.last_index, self.last)
+    self.last = row
+    self.last_index = index
+    return result
+
+  def finish(self):
+    if self.last is None:
+      return []
+    result = []
+    if self.current is not None:
+      result.append(self._pick(self.current, self._average(self.following)))
+    if self.following is not None:
+      result.append(self._pick(self.following, (self.last['ts'], self.last['value'])))
+    result.append(self.last)
+    return result
+
+  def pending(self):
+    """
+    The first point (in stream order) which may still be returned
+    """
+    for rows in (self.current, self.following):
+      if rows:
+        return rows[0]
+    return self.last
+
+  def _place(self, index, row):
+    if self.following is not None and index == self.index:
+      self.following.append(row)
+      return []
+    result = []
+    if self.current is not None:
+      result.append(self._pick(self.current, self._average(self.following)))
+    self.current = self.following
+    self.following = [row]
+    self.index = index
+    return result
+
+  def _average(self, rows):
+    ts = value = 0.0
+    for row in rows:
+      ts += row['ts']
+      value += row['value']
+    return (ts / len(rows), value / len(rows))
+
+  def _pick(self, rows, after):
+    ax = self.previous['ts']
+    ay = self.previous['value']
+    cx, cy = after
+    best = None
+    area = -1
+    for row in rows:
+      # Twice the area, which picks the same point
+      a = abs((ax - cx) * (row['value'] - ay) - (ax - row['ts']) * (cy - ay))
+      if a > area:
+        area = a
+        best = row
+    self.previous = best
+    return best
+
+class Extremes:
+  """
+  Picks the lowest and highest point of each bucket of one source
+  """
+  def __init__(self):
+    self.index = None
+    self.low = None
+    self.high = None
+
+  @staticmethod
+  def buckets(points):
+    return points // 2
+
+  def add(self, index, row):
+    result = []
+    if index != self.index:
+      result = self.finish()
+      self.index = index
+      self.low = self.high = row
+    elif row['value'] < self.low['value']:
+      self.low = row
+    elif row['value'] > self.high['value']:
+      self.high = row
+    return result
+
+  def finish(self):
+    if self.low is None:
+      return []
+    if self.low is self.high:
+      result = [self.low]
+    else:
+      # Same order as the points came in
+      result = [self.low, self.high] if self.low is self.pending() else [self.high, self.low]
+    self.low = self.high = None
+    return result
+
+  def pending(self):
+    if self.low is None:
+      return None
+    return self.low if self.low['n'] < self.high['n'] else self.high
+
+SAMPLERS = {
+  LTTB : Largest,
+  MINMAX : Extremes
+}
+
+class Source:
+  """
+  Downsampling state of one source. The points are also kept as is until
+  there are more of them than asked for.
+  """
+  def __init__(self, method, points):
+    self.sampler = SAMPLERS[method]()
+    self.points = points
+    self.raw = []
+    self.held = []
+
+  def add(self, index, row):
+    result = self.sampler.add(index, row)
+    if self.raw is None:
+      return result
+    self.raw.append(row)
+    self.held.extend(result)
+    if len(self.raw) <= self.points:
+      return []
+    result = self.held
+    self.raw = self.held = None
+    return result
+
+  def finish(self):
+    if self.raw is not None:
+      return self.raw
+    return self.sampler.finish()
+
+  def pending(self):
+    if self.raw is not None:
+      return self.raw[0]
+    return self.sampler.pending()
+
+def downsample(rows, points, ts_start, ts_end, method=LTTB, descending=False):
+  """
+  Reduces rows ordered by ts (of any number of sources, all between
+  ts_start and ts_end) to about points rows per source, still ordered
+  by ts
+  """
+  count = SAMPLERS[method].buckets(points)
+  span = ts_end - ts_start + 1
+  sources = {}
+  # Picked points wait here until no source can come up with an earlier
+  # one, each row is numbered to keep them in stream order
+  ready = []
+  n = 0
+  try:
+    for row in rows:
+      row = dict(row, n=n)
+      n += 1
+      offset = ts_end - row['ts'] if descending else row['ts'] - ts_start
+      index = min(count - 1, max(0, int(offset * count / span)))
+
+      source = sources.get(row['uuid'])
+      if source is None:
+        source = sources[row['uuid']] = Source(method, points)
+      picked = source.add(index, row)
+      if not picked:
+        continue
+      for p in picked:
+        heapq.heappush(ready, (p['n'], p))
+
+      first = row['n']
+      for source in sources.values():
+        p = source.pending()
+        if p is not None and p['n'] < first:
+          first = p['n']
+      while ready and ready[0][0] < first:
+        yield _strip(heapq.heappop(ready)[1])
+
+    for source in sources.values():
+      for p in source.finish():
+        heapq.heappush(ready, (p['n'], p))
+    while ready:
+      yield _strip(heapq.heappop(ready)[1])
+  finally:
+    rows.close()
+
+def _nothing():
+  return
+  yield
+
+def _strip(row):
+  del row['n']
+  return row
+
+def query(backend, uuids, ts_start=None, ts_end=None, points=1000, method=LTTB, descending=False, count=0):
+  """
+  Retrieves data points from UUIDs like backend.query() does, reduced to
+  about points per source (at least 3) and then limited to count (zero
+  means no limit). Returns an Iterator.
+  """
+  now = int(time.time())
+  if ts_start is not None and ts_start < 0:
+    ts_start = now + ts_start
+  if ts_end is not None and ts_end < 0:
+    ts_end = now + ts_end
+
+  # Buckets need both ends of the range, any missing end is taken from
+  # the data
+  for end in ('start', 'end'):
+    if (ts_start if end == 'start' else ts_end) is not None:
+      continue
+    result = backend.query(uuids, ts_start, ts_end, 1, 0, Storage.GROUP_BY_NONE, end == 'end')
+    if result is None:
+      return None
+    row = result.next()
+    error = result.getError()
+    result.release()
+    if error is not None:
+      return Stream.StreamIterator(None, error)
+    if row is None:
+      return Stream.StreamIterator(_nothing())
+    if end == 'start':
+      ts_start = row['ts']
+    else:
+      ts_end = row['ts']
+
+  result = backend.query(uuids, ts_start, ts_end, 0, 0, Storage.GROUP_BY_NONE, descending)
+  if result is None:
+    return None
+  result = downsample(Stream.rows(result), points, ts_start, ts_end, method, descending)
+  if count > 0:
+    result = Stream.limit(result, int(count))
+  return Stream.StreamIterator(result)
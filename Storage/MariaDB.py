@@ -6,25 +6,184 @@ import datetime
 import traceback
 import random
 import Storage
+import Backend
+import Stream
+import QueryCache
+import Compression
+import Aggregate
+
+try:
+  import Queue as queue
+except ImportError:
+  import queue
 
 import mysql.connector
 from mysql.connector import errorcode
 
-class MariaDB:
+class ConnectionPool:
+  """
+  Bounded pool of database connections. Connections are opened on demand
+  up to size, after which callers wait up to timeout seconds for one to be
+  returned. Connections which have been idle for more than recycle seconds
+  are pinged (and reconnected if needed) before being handed out again.
+
+  The pure Python driver is used since it allows a connection with unread
+  results to be dropped without reading them (see Iterator.release).
+  """
+  def __init__(self, params, size=5, timeout=10, recycle=60):
+    self.params = params
+    self.size = size
+    self.timeout = timeout
+    self.recycle = recycle
+    self.idle = queue.LifoQueue()
+    self.lock = threading.Lock()
+    self.opened = 0
+
+  def get(self):
+    """
+    Checks out a connection, raises mysql.connector.Error if no connection
+    could be had
+    """
+    try:
+      cnx, since = self.idle.get_nowait()
+    except queue.Empty:
+      cnx = self._open()
+      if cnx is not None:
+        return cnx
+      try:
+        cnx, since = self.idle.get(True, self.timeout)
+      except queue.Empty:
+        raise mysql.connector.errors.PoolError('No database connection available after %ds' % self.timeout)
+
+    if time.time() - since > self.recycle:
+      try:
+        cnx.ping(reconnect=True, attempts=3, delay=1)
+      except mysql.connector.Error:
+        self.put(cnx, discard=True)
+        raise
+    return cnx
+
+  def put(self, cnx, discard=False):
+    """
+    Returns a connection to the pool. Use discard if the connection is in
+    a state where it can't be reused.
+    """
+    if discard:
+      try:
+        cnx.shutdown()
+      except mysql.connector.Error:
+        pass
+      with self.lock:
+        self.opened -= 1
+      return
+    # Don't let the next user see a stale snapshot from a read
+    if cnx.in_transaction:
+      try:
+        cnx.rollback()
+      except mysql.connector.Error:
+        self.put(cnx, discard=True)
+        return
+    self.idle.put((cnx, time.time()))
+
+  def close(self):
+    while True:
+      try:
+        cnx, since = self.idle.get_nowait()
+      except queue.Empty:
+        break
+      try:
+        cnx.close()
+      except mysql.connector.Error:
+        pass
+      with self.lock:
+        self.opened -= 1
+
+  def _open(self):
+    """
+    Opens a new connection if the pool isn't full yet, otherwise None
+    """
+    with self.lock:
+      if self.opened >= self.size:
+        return None
+      self.opened += 1
+    try:
+      return mysql.connector.connect(use_pure=True, **self.params)
+    except:
+      with self.lock:
+        self.opened -= 1
+      raise
+
+def months(since, until):
+  """
+  Yields the first day of every month from since up to and including until
+  """
+  d = datetime.date(since.year, since.month, 1)
+  while d <= until:
+    yield d
+    d = datetime.date(d.year + d.month // 12, d.month % 12 + 1, 1)
+
+class MariaDB(Backend.Backend):
+  # Version of the tables created by setup(), older installs are brought
+  # up to date by upgrade()
+  SCHEMA_VERSION = 4
+
+  # How many months of partitions to keep ready ahead of time
+  PARTITIONS_AHEAD = 12
+
+  # Seconds of data per compressed chunk, see compact()
+  CHUNK = 86400
+  COMPACTS = True
 
-  def __init__(self):
-    # Holds all the sources AND the last recorded value (based on time)
-    self.cache = {}
-    self._types = {}
-    self.GROUP_METHOD = [ 'SUM', 'AVG' ]
+  # Rows of data read at a time per source by queries over compacted data
+  PAGE = 5000
 
+  # Rollups are kept this many seconds behind the current time, so points
+  # arriving a little late don't need to be rolled up again
+  ROLLUP_LAG = 60
+
+  def __init__(self, pool_size=5, pool_timeout=10, pool_recycle=60):
+    Backend.Backend.__init__(self)
+    # Modes the database can group by itself, the others are done by
+    # reading the points into the aggregates of the same name
+    self.GROUP_METHOD = {
+      Storage.GROUP_BY_SUM : 'SUM',
+      Storage.GROUP_BY_AVERAGE : 'AVG',
+      Storage.GROUP_BY_MIN : 'MIN',
+      Storage.GROUP_BY_MAX : 'MAX',
+      Storage.GROUP_BY_COUNT : 'COUNT',
+      Storage.GROUP_BY_STDDEV : 'STDDEV_POP'
+    }
+    self.pool = None
+    self.pool_size = pool_size
+    self.pool_timeout = pool_timeout
+    self.pool_recycle = pool_recycle
+    # True once there are compressed chunks to consider in queries
+    self.compacted = False
+    # Resolutions of the rollups, see start_rollups()
+    self.resolutions = []
+    self.watermark = None
+    # See start_query_cache()
+    self.query_cache = None
+    # Timings of the statements on the paths recording and querying data
+    # points, along with the wait for a connection
+    self.executing = {}
+    self.committing = {}
+    for operation in ['record', 'flush', 'query']:
+      self.executing[operation] = self.metrics.histogram('datapoints_db_execute_seconds', 'Time taken executing statements', operation=operation)
+    for operation in ['record', 'flush']:
+      self.committing[operation] = self.metrics.histogram('datapoints_db_commit_seconds', 'Time taken committing transactions', operation=operation)
+    self.waiting = self.metrics.histogram('datapoints_db_pool_wait_seconds', 'Time taken getting a connection from the pool')
 
   def connect(self, user, pw, host, database):
+    params = {
+      'user' : user,
+      'password' : pw,
+      'host' : host,
+      'database' : database
+    }
+    self.pool = ConnectionPool(params, self.pool_size, self.pool_timeout, self.pool_recycle)
     try:
-      self.cnx = mysql.connector.connect(user=user,
-                                         password=pw,
-                                         host=host,
-                                         database=database)
+      self.pool.put(self.pool.get())
       return True
     except mysql.connector.Error as err:
       if err.errno == errorcode.ER_ACCESS_DENIED_ERROR:
@@ -35,6 +194,49 @@ class MariaDB:
         logging.error(err)
     return False
 
+  def forked(self):
+    # Connections of the parent are left open for it to keep using
+    self.pool = ConnectionPool(self.pool.params, self.pool_size, self.pool_timeout, self.pool_recycle)
+
+  def _share_state(self):
+    """
+    Lets other processes know how far the rollups go and if there are
+    compressed chunks, which only the process running the background
+    jobs finds out about
+    """
+    if self.shared is None:
+      return
+    if self.watermark is not None:
+      self.shared.set('watermark', self.watermark)
+    if self.compacted:
+      self.shared.set('compacted', 1)
+
+  def _watermark(self):
+    """
+    Rollups are complete up to this point in time, None without rollups
+    """
+    if self.shared is not None and self.watermark is not None:
+      return self.shared.get('watermark')
+    return self.watermark
+
+  def _compacted(self):
+    """
+    True once there are compressed chunks to consider in queries
+    """
+    return self.compacted or (self.shared is not None and self.shared.get('compacted') != 0)
+
+  def _connection(self):
+    """
+    Checks out a connection from the pool, returns None if there is none
+    to be had. Must be handed back using self.pool.put()
+    """
+    try:
+      with self.waiting.time():
+        return self.pool.get()
+    except mysql.connector.Error as err:
+      logging.error('Unable to get a database connection: ' + repr(err))
+    return None
+
   def validate(self):
     """
     Tests if the database is setup properly or if it needs to be installed
@@ -45,25 +247,286 @@ class MariaDB:
         2 = Needs to upgrade
       255 = Things went terribly wrong
     """
-    cursor = self.cnx.cursor(buffered=True)
-    for table in [ 'sources', 'data' ]:
-      query = ("DESCRIBE " + table)
+    cnx = self._connection()
+    if cnx is None:
+      return Storage.VALIDATION_ERROR
+    cursor = cnx.cursor(buffered=True)
+    try:
+      for table in [ 'sources', 'data' ]:
+        query = ("DESCRIBE " + table)
+        try:
+          cursor.execute(query)
+        except mysql.connector.Error as err:
+          if err.errno == errorcode.ER_NO_SUCH_TABLE:
+            return Storage.VALIDATION_NOT_SETUP
+          else:
+            logging.error(err)
+            return Storage.VALIDATION_ERROR
+      version = self._version(cursor)
+    except mysql.connector.Error as err:
+      logging.error(err)
+      return Storage.VALIDATION_ERROR
+    finally:
+      cursor.close()
+      self.pool.put(cnx)
+    if version < self.SCHEMA_VERSION:
+      logging.warning('Database is at version %d, current version is %d' % (version, self.SCHEMA_VERSION))
+      return Storage.VALIDATION_NEED_UPGRADE
+    return Storage.VALIDATION_OK
+
+  def _version(self, cursor):
+    """
+    Returns the version of the tables. The first version didn't keep
+    track of this, so no meta table means version 1.
+    """
+    try:
+      cursor.execute("SELECT value FROM meta WHERE name = 'schema'")
+    except mysql.connector.Error as err:
+      if err.errno == errorcode.ER_NO_SUCH_TABLE:
+        return 1
+      raise
+    row = cursor.fetchone()
+    if row is None:
+      return 1
+    return int(row[0])
+
+  def _data_table(self, name, partition, since=None):
+    """
+    Statement creating a data table. Rows are clustered on (source, ts) so
+    lookups for a source within a time range only touch the rows needed.
+    If partition is True, the table is also split into monthly partitions
+    starting with the month of since (default is this month).
+    """
+    sql = 'CREATE TABLE %s (source int not null, ts datetime not null, value int not null, PRIMARY KEY (source, ts))' % name
+    if partition:
+      if since is None:
+        since = datetime.date.today()
+      first = datetime.date(since.year, since.month, 1)
+      parts = [ "PARTITION pold VALUES LESS THAN (TO_DAYS('%s'))" % first ]
+      parts.extend(self._partitions(first))
+      parts.append('PARTITION pfuture VALUES LESS THAN MAXVALUE')
+      sql += ' PARTITION BY RANGE (TO_DAYS(ts)) (%s)' % ', '.join(parts)
+    return sql
+
+  def _chunks_table(self, name):
+    """
+    Statement creating the table of compressed chunks. Each row holds the
+    points of a source for CHUNK seconds from start, along with the first
+    and last timestamp and the last value so they don't need decoding to
+    be known.
+    """
+    return 'CREATE TABLE %s (source int not null, start datetime not null, first datetime not null, last datetime not null, count int not null, value int not null, data mediumblob not null, PRIMARY KEY (source, start))' % name
+
+  def _rollup_tables(self, prefix=''):
+    """
+    Statements creating the rollups, which hold count, sum, min and max of
+    a source for each bucket of a resolution (named by when it starts),
+    and the table of buckets needing to be rolled up again.
+    """
+    return [
+      'CREATE TABLE %srollups (source int not null, resolution int not null, ts datetime not null, count int not null, sum bigint not null, min int not null, max int not null, PRIMARY KEY (source, resolution, ts))' % prefix,
+      'CREATE TABLE %srollup_dirty (source int not null, ts datetime not null, PRIMARY KEY (source, ts))' % prefix
+    ]
+
+  def _partitions(self, since):
+    """
+    Monthly partition definitions from since until PARTITIONS_AHEAD
+    months from now
+    """
+    today = datetime.date.today()
+    until = datetime.date(today.year + (today.month + self.PARTITIONS_AHEAD - 1) // 12, (today.month + self.PARTITIONS_AHEAD - 1) % 12 + 1, 1)
+    result = []
+    for month in months(since, until):
+      end = datetime.date(month.year + month.month // 12, month.month % 12 + 1, 1)
+      result.append("PARTITION p%04d%02d VALUES LESS THAN (TO_DAYS('%s'))" % (month.year, month.month, end))
+    return result
+
+  def partitioned(self):
+    """
+    Returns True if the data table is partitioned by month
+    """
+    query = "SELECT COUNT(*) FROM information_schema.PARTITIONS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'data' AND PARTITION_NAME IS NOT NULL"
+    cnx = self._connection()
+    if cnx is None:
+      return False
+    cursor = cnx.cursor(buffered=True)
+    try:
+      cursor.execute(query)
+      return cursor.fetchone()[0] > 0
+    except mysql.connector.Error as err:
+      logging.error('Failed to check partitions: ' + repr(err))
+    finally:
+      cursor.close()
+      self.pool.put(cnx)
+    return False
+
+  def add_partitions(self):
+    """
+    Makes sure a partitioned data table has partitions for the months
+    ahead, by splitting them off the catch-all partition
+    """
+    query = "SELECT PARTITION_NAME FROM information_schema.PARTITIONS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'data' AND PARTITION_NAME LIKE 'p2%' ORDER BY PARTITION_ORDINAL_POSITION DESC LIMIT 1"
+    cnx = self._connection()
+    if cnx is None:
+      return False
+    cursor = cnx.cursor(buffered=True)
+    try:
+      cursor.execute(query)
+      row = cursor.fetchone()
+      if row is None:
+        return True
+      last = datetime.date(int(row[0][1:5]), int(row[0][5:7]), 1)
+      parts = self._partitions(datetime.date(last.year + last.month // 12, last.month % 12 + 1, 1))
+      if not parts:
+        return True
+      logging.info('Adding %d partitions to data table' % len(parts))
+      parts.append('PARTITION pfuture VALUES LESS THAN MAXVALUE')
+      cursor.execute('ALTER TABLE data REORGANIZE PARTITION pfuture INTO (%s)' % ', '.join(parts))
+      return True
+    except mysql.connector.Error as err:
+      logging.error('Failed to add partitions: ' + repr(err))
+    finally:
+      cursor.close()
+      self.pool.put(cnx)
+    return False
+
+  def upgrade(self, partition=False, batch=50000):
+    """
+    Brings the tables up to SCHEMA_VERSION. This is done online, the server
+    may keep recording and querying data while existing rows are migrated
+    in batches of batch rows.
+    """
+    cnx = self._connection()
+    if cnx is None:
+      return False
+    cursor = cnx.cursor(buffered=True)
+    try:
+      version = self._version(cursor)
+    except mysql.connector.Error as err:
+      logging.error('Unable to determine database version: ' + repr(err))
+      return False
+    finally:
+      cursor.close()
+      self.pool.put(cnx)
+
+    while version < self.SCHEMA_VERSION:
+      logging.info('Upgrading database from version %d to %d' % (version, version + 1))
+      start = time.time()
+      if not getattr(self, '_upgrade%d' % (version + 1))(partition, batch):
+        logging.error('Upgrade to version %d failed' % (version + 1))
+        return False
+      version += 1
+      if not self._execute(["INSERT INTO meta (name, value) VALUES ('schema', '%d') ON DUPLICATE KEY UPDATE value = VALUES(value)" % version]):
+        return False
+      logging.info('Database is now at version %d (took %.1fs)' % (version, time.time() - start))
+    return True
+
+  def _execute(self, sql, params=None):
+    """
+    Runs one or more statements in a transaction, returns False if any of them failed
+    """
+    cnx = self._connection()
+    if cnx is None:
+      return False
+    cursor = cnx.cursor(buffered=True)
+    try:
+      for s in sql:
+        cursor.execute(s, params)
+      cnx.commit()
+      return True
+    except mysql.connector.Error as err:
+      logging.error('Failed to execute: ' + s)
+      logging.error(err)
+    finally:
+      cursor.close()
+      self.pool.put(cnx)
+    return False
+
+  def _upgrade2(self, partition, batch):
+    """
+    Version 2 adds the meta table and replaces the unindexed data table
+    with one keyed on (source, ts). Rows are copied to data_new in batches
+    along a temporary index on ts, after which the tables are swapped and
+    any rows added in the meantime are copied over. The old table is left
+    as data_v1.
+    """
+    if not self._execute([
+        'CREATE TABLE IF NOT EXISTS meta (name varchar(64) primary key, value varchar(255) not null)',
+        'DROP TABLE IF EXISTS data_new'
+      ]):
+      return False
+
+    cnx = self._connection()
+    if cnx is None:
+      return False
+    cursor = cnx.cursor(buffered=True)
+    try:
       try:
-        cursor.execute(query)
+        cursor.execute('ALTER TABLE data ADD INDEX upgrade_ts (ts), ALGORITHM=INPLACE, LOCK=NONE')
       except mysql.connector.Error as err:
-        cursor.close()
-        if err.errno == errorcode.ER_NO_SUCH_TABLE:
-          return Storage.VALIDATION_NOT_SETUP
-        else:
-          logging.error(err)
-          return Storage.VALIDATION_ERROR
-    cursor.close()
-    return Storage.VALIDATION_OK
+        # Index is left from an earlier attempt
+        if err.errno != errorcode.ER_DUP_KEYNAME:
+          raise
+
+      cursor.execute('SELECT MIN(ts) FROM data')
+      low = cursor.fetchone()[0]
+      cursor.execute(self._data_table('data_new', partition, low))
+
+      copy = 'INSERT INTO %s (source, ts, value) SELECT source, ts, value FROM %s WHERE ts >= %%s%s ON DUPLICATE KEY UPDATE value = VALUES(value)'
+      copied = 0
+      while low is not None:
+        cursor.execute('SELECT ts FROM data WHERE ts > %s ORDER BY ts LIMIT %s, 1', (low, batch))
+        row = cursor.fetchone()
+        if row is None:
+          break
+        cursor.execute(copy % ('data_new', 'data', ' AND ts < %s'), (low, row[0]))
+        cnx.commit()
+        copied += cursor.rowcount
+        logging.info('Migrated rows up to %s (%d so far)' % (row[0], copied))
+        low = row[0]
 
-  def setup(self, force):
+      # Whatever is left is the most recent data, copy it and swap tables
+      # before copying anything which arrived after that.
+      if low is not None:
+        cursor.execute(copy % ('data_new', 'data', ''), (low,))
+        cnx.commit()
+      cursor.execute('RENAME TABLE data TO data_v1, data_new TO data')
+      if low is not None:
+        cursor.execute(copy % ('data', 'data_v1', ''), (low,))
+        cnx.commit()
+      logging.info('Data migrated, the old table is kept as data_v1 and can be dropped')
+      return True
+    except mysql.connector.Error as err:
+      logging.error('Failed to migrate data: ' + repr(err))
+      cnx.rollback()
+    finally:
+      cursor.close()
+      self.pool.put(cnx)
+    return False
+
+  def _upgrade3(self, partition, batch):
+    """
+    Version 3 adds the table for compressed chunks
+    """
+    return self._execute([self._chunks_table('IF NOT EXISTS chunks')])
+
+  def _upgrade4(self, partition, batch):
+    """
+    Version 4 adds the tables for rollups
+    """
+    return self._execute(self._rollup_tables('IF NOT EXISTS '))
+
+  def setup(self, force, partition=False):
+    """
+    Creates the tables. If partition is True, the data table is split
+    into monthly partitions.
+    """
     if force:
-      cursor = self.cnx.cursor(buffered=True)
-      for table in [ 'sources', 'data' ]:
+      cnx = self._connection()
+      if cnx is None:
+        return False
+      cursor = cnx.cursor(buffered=True)
+      for table in [ 'sources', 'data', 'chunks', 'rollups', 'rollup_dirty', 'types', 'meta' ]:
         query = ("DROP TABLE " + table)
         try:
           logging.info(query)
@@ -71,62 +534,562 @@ class MariaDB:
         except mysql.connector.Error as err:
           pass
       cursor.close()
+      self.pool.put(cnx)
 
     if self.validate() != Storage.VALIDATION_NOT_SETUP:
       logging.error('Database is not in a state where it can be setup')
       return False
 
     sql = [
+      'CREATE TABLE meta (name varchar(64) primary key, value varchar(255) not null)',
+      "INSERT INTO meta (name, value) VALUES ('schema', '%d')" % self.SCHEMA_VERSION,
       'CREATE TABLE sources (id int primary key auto_increment, sid varchar(64) not null unique, name varchar(128) not null, uuid varchar(64) not null unique, type int not null, accuracy int not null, parameters text not null)',
-      'CREATE TABLE data (ts datetime not null, source int not null, value int not null)',
+      self._data_table('data', partition),
+      self._chunks_table('chunks'),
+      self._rollup_tables()[0],
+      self._rollup_tables()[1],
       'CREATE TABLE types (id int primary key auto_increment, uuid varchar(64) not null unique, name varchar(128) not null, description TEXT not null)'
     ]
 
-    cursor = self.cnx.cursor(buffered=True)
-    for s in sql:
+    cnx = self._connection()
+    if cnx is None:
+      return False
+    cursor = cnx.cursor(buffered=True)
+    try:
+      for s in sql:
+        try:
+          cursor.execute(s)
+        except mysql.connector.Error as err:
+          logging.error('Failed to execute: ' + s)
+          logging.error(err)
+          return False
+      cnx.commit()
+    finally:
+      cursor.close()
+      self.pool.put(cnx)
+    return True
+
+  def disconnect(self):
+    Backend.Backend.disconnect(self)
+    self.pool.close()
+
+  def _flush(self, points):
+    """
+    Writes a batch of (source, value, ts) tuples in a single transaction,
+    retrying once on a fresh connection if it fails.
+    """
+    for attempt in range(2):
+      cnx = self._connection()
+      if cnx is None:
+        continue
+      cursor = None
+      failed = False
       try:
-        cursor.execute(s)
+        cursor = cnx.cursor()
+        for i in range(0, len(points), 1000):
+          chunk = points[i:i+1000]
+          query = 'INSERT INTO data (source, value, ts) VALUES ' + ','.join(['(%s, %s, FROM_UNIXTIME(%s))'] * len(chunk)) + ' ON DUPLICATE KEY UPDATE value = VALUES(value)'
+          params = []
+          for p in chunk:
+            params.extend(p)
+          with self.executing['flush'].time():
+            cursor.execute(query, params)
+        with self.committing['flush'].time():
+          cnx.commit()
       except mysql.connector.Error as err:
-        cursor.close()
-        logging.error('Failed to execute: ' + s)
-        logging.error(err)
+        logging.error('Failed to flush %d data points: %s' % (len(points), repr(err)))
+        failed = True
+        try:
+          cnx.rollback()
+        except mysql.connector.Error:
+          pass
+      finally:
+        if cursor is not None:
+          cursor.close()
+        self.pool.put(cnx, discard=failed)
+      if not failed:
+        self._mark_dirty(points)
+        self._invalidate(points)
+        return True
+    return False
+
+  def prepare(self):
+    """
+    Loads up the cache and is now ready to be used
+    """
+    cnx = self._connection()
+    if cnx is None:
+      return False
+    try:
+      if not self._prepare(cnx):
         return False
-    cursor.close()
+    finally:
+      self.pool.put(cnx)
+
+    if self.partitioned():
+      self.add_partitions()
+      self._spawn(self._maintain, 'Partitions')
     return True
 
-  def disconnect(self):
-    self.cnx.close()
+  def _maintain(self):
+    while True:
+      time.sleep(86400)
+      self.add_partitions()
 
-  def prepare(self):
+  def compact(self, age):
+    """
+    Moves points older than age seconds from data into compressed chunks,
+    one source and CHUNK seconds at a time. Only whole chunks are
+    compacted. Points recorded later for a compacted period are kept in
+    data until the next run, which merges them into the chunk.
+    """
+    cutoff = int(time.time()) - age
+    cutoff -= cutoff % self.CHUNK
+    cnx = self._connection()
+    if cnx is None:
+      return False
+    cursor = cnx.cursor(buffered=True)
+    began = time.time()
+    chunks = points = 0
+    try:
+      cursor.execute('SELECT source, UNIX_TIMESTAMP(MIN(ts)) FROM data WHERE ts < FROM_UNIXTIME(%s) GROUP BY source', (cutoff,))
+      for source, low in cursor.fetchall():
+        while low is not None:
+          start = int(low) - int(low) % self.CHUNK
+          points += self._compact(cursor, source, start)
+          cnx.commit()
+          chunks += 1
+          cursor.execute('SELECT UNIX_TIMESTAMP(MIN(ts)) FROM data WHERE source = %s AND ts >= FROM_UNIXTIME(%s) AND ts < FROM_UNIXTIME(%s)', (source, start + self.CHUNK, cutoff))
+          low = cursor.fetchone()[0]
+    except mysql.connector.Error as err:
+      logging.error('Failed to compact data: ' + repr(err))
+      try:
+        cnx.rollback()
+      except mysql.connector.Error:
+        pass
+      return False
+    finally:
+      cursor.close()
+      self.pool.put(cnx)
+    if chunks:
+      self.compacted = True
+      self._share_state()
+      logging.info('Compacted %d points into %d chunks in %.2fs' % (points, chunks, time.time() - began))
+    return True
+
+  def _compact(self, cursor, source, start):
+    """
+    Merges the rows in data of a source from start and CHUNK seconds on
+    into its chunk, returns the number of rows moved. Caller commits.
+    """
+    params = (source, start, start + self.CHUNK)
+    # Locking the rows (and the gaps between them) holds up anything being
+    # recorded for the period until the rows are deleted
+    cursor.execute('SELECT UNIX_TIMESTAMP(ts), value FROM data WHERE source = %s AND ts >= FROM_UNIXTIME(%s) AND ts < FROM_UNIXTIME(%s) ORDER BY ts FOR UPDATE', params)
+    rows = cursor.fetchall()
+    cursor.execute('SELECT data FROM chunks WHERE source = %s AND start = FROM_UNIXTIME(%s) FOR UPDATE', (source, start))
+    row = cursor.fetchone()
+    merged = {}
+    if row is not None:
+      merged.update(Compression.decode(row[0]))
+    merged.update([(int(ts), value) for ts, value in rows])
+    points = sorted(merged.items())
+    cursor.execute('INSERT INTO chunks (source, start, first, last, count, value, data) '
+                   'VALUES (%s, FROM_UNIXTIME(%s), FROM_UNIXTIME(%s), FROM_UNIXTIME(%s), %s, %s, %s) '
+                   'ON DUPLICATE KEY UPDATE first = VALUES(first), last = VALUES(last), count = VALUES(count), value = VALUES(value), data = VALUES(data)',
+                   (source, start, points[0][0], points[-1][0], len(points), points[-1][1], Compression.encode(points)))
+    cursor.execute('DELETE FROM data WHERE source = %s AND ts >= FROM_UNIXTIME(%s) AND ts < FROM_UNIXTIME(%s)', params)
+    return len(rows)
+
+  def start_rollups(self, resolutions):
+    """
+    Keeps count, sum, min and max of every source in buckets of each of
+    resolutions (seconds), so grouped queries can be answered without
+    reading every point. Each resolution must be a multiple of the one
+    before it.
+
+    Rollups are complete up to the watermark, which a background thread
+    moves along (starting from the oldest point if there are no rollups
+    for these resolutions yet). Points recorded for before the watermark
+    are noted in rollup_dirty and rolled up on the next run.
+    """
+    resolutions = sorted(set(resolutions))
+    if not resolutions or resolutions[0] < 1:
+      logging.error('Rollups need at least one resolution')
+      return False
+    for i in range(1, len(resolutions)):
+      if resolutions[i] % resolutions[i - 1]:
+        logging.error('Rollup resolution %d is not a multiple of %d' % (resolutions[i], resolutions[i - 1]))
+        return False
+    configured = ','.join([str(r) for r in resolutions])
+
+    cnx = self._connection()
+    if cnx is None:
+      return False
+    cursor = cnx.cursor(buffered=True)
+    try:
+      cursor.execute("SELECT name, value FROM meta WHERE name IN ('rollups', 'rollup_watermark')")
+      meta = dict(cursor.fetchall())
+      if meta.get('rollups') == configured and 'rollup_watermark' in meta:
+        watermark = int(meta['rollup_watermark'])
+      else:
+        logging.info('Building rollups for resolutions ' + configured)
+        cursor.execute('DELETE FROM rollups')
+        cursor.execute('DELETE FROM rollup_dirty')
+        cursor.execute('SELECT UNIX_TIMESTAMP(MIN(ts)) FROM data')
+        low = cursor.fetchone()[0]
+        cursor.execute('SELECT UNIX_TIMESTAMP(MIN(first)) FROM chunks')
+        first = cursor.fetchone()[0]
+        if low is None or (first is not None and first < low):
+          low = first
+        if low is None:
+          low = time.time()
+        watermark = int(low) - int(low) % resolutions[-1]
+        for name, value in [('rollups', configured), ('rollup_watermark', str(watermark))]:
+          cursor.execute('INSERT INTO meta (name, value) VALUES (%s, %s) ON DUPLICATE KEY UPDATE value = VALUES(value)', (name, value))
+        cnx.commit()
+    except mysql.connector.Error as err:
+      logging.error('Failed to setup rollups: ' + repr(err))
+      return False
+    finally:
+      cursor.close()
+      self.pool.put(cnx)
+
+    with self.lock:
+      self.resolutions = resolutions
+      self.watermark = watermark
+    self._share_state()
+    self._spawn(self._roller, 'Rollups')
+    return True
+
+  def start_query_cache(self, size):
+    """
+    Keeps up to size rows of the results of grouped queries, see
+    QueryCache. Buckets are cached once ROLLUP_LAG seconds have passed
+    since they ended, same as rollups.
+    """
+    self.query_cache = QueryCache.QueryCache(self._query, size, self.ROLLUP_LAG, self.shared)
+    self.metrics.reading('datapoints_query_cache_hits_total', 'counter', 'Grouped queries answered from the query cache', lambda: self.query_cache.hits)
+    self.metrics.reading('datapoints_query_cache_misses_total', 'counter', 'Grouped queries with nothing in the query cache', lambda: self.query_cache.misses)
+    self.metrics.reading('datapoints_query_cache_rows', 'gauge', 'Rows kept in the query cache', lambda: self.query_cache.rows)
+    return True
+
+  def _invalidate(self, points):
     """
-    Loads up the cache and is now ready to be used (yes, this could be done by a join)
+    Lets the query cache know (source, value, ts) points were stored
     """
-    query = 'SELECT id, uuid, name, type, accuracy, parameters FROM sources'
-    cursor = self.cnx.cursor(dictionary=True, buffered=True)
-    cursor2 = self.cnx.cursor(dictionary=True, buffered=True)
+    if self.query_cache is not None:
+      self.query_cache.invalidate(points)
+
+  def stats(self):
+    if self.query_cache is None:
+      return {}
+    return {'query_cache' : self.query_cache.stats()}
+
+  def _roller(self):
+    interval = min(self.resolutions[0], 60)
+    while True:
+      start = time.time()
+      try:
+        self.rollup()
+      except Exception:
+        logging.exception('Rollup failed')
+      time.sleep(max(1, interval - (time.time() - start)))
+
+  def rollup(self):
+    """
+    Rolls up what has been recorded since the last run, returns True on
+    success
+    """
+    if not self._rollup_dirty():
+      return False
+    finest = self.resolutions[0]
+    target = int(time.time()) - self.ROLLUP_LAG
+    target -= target % finest
+    # At most a day at a time, so catching up doesn't hold locks for long
+    step = max(self.CHUNK - self.CHUNK % finest, finest)
+    while self.watermark < target:
+      low = self.watermark
+      high = min(target, low + step)
+      # Moved first, so anything recorded from now on for before it is
+      # noted as dirty
+      with self.lock:
+        self.watermark = high
+      self._share_state()
+      if not self._rollup_range(low, high):
+        with self.lock:
+          self.watermark = low
+        self._share_state()
+        return False
+      if not self._execute(["INSERT INTO meta (name, value) VALUES ('rollup_watermark', %s) ON DUPLICATE KEY UPDATE value = VALUES(value)"], (str(high),)):
+        return False
+    return True
+
+  def _rollup_range(self, low, high):
+    """
+    Rolls up all sources from low up to high
+    """
+    self._refresh()
+    with self.lock:
+      sources = [(source['id'], source['uuid']) for source in self.cache.values()]
+    if not sources:
+      return True
+    ids = [id for id, uuid in sources]
+    finest = self.resolutions[0]
+
+    # Sources with compressed points in the range are rolled up here,
+    # the rest by the database
+    rows = []
+    if self._compacted():
+      chunks = self._chunks(ids, low, high - 1)
+      if chunks is None:
+        return False
+      for id in chunks:
+        result = self._aggregate(id, low, high)
+        if result is None:
+          return False
+        rows.extend(result)
+      ids = [id for id in ids if id not in chunks]
+
+    cnx = self._connection()
+    if cnx is None:
+      return False
+    cursor = cnx.cursor(buffered=True)
+    try:
+      self._store_rollups(cursor, rows)
+      if ids:
+        cursor.execute('INSERT INTO rollups (source, resolution, ts, count, sum, min, max) '
+                       'SELECT source, %%s, FROM_UNIXTIME(FLOOR(UNIX_TIMESTAMP(ts) / %%s) * %%s) AS bucket, COUNT(*), SUM(value), MIN(value), MAX(value) '
+                       'FROM data WHERE source IN (%s) AND ts >= FROM_UNIXTIME(%%s) AND ts < FROM_UNIXTIME(%%s) GROUP BY source, bucket '
+                       'ON DUPLICATE KEY UPDATE count = VALUES(count), sum = VALUES(sum), min = VALUES(min), max = VALUES(max)' % ', '.join(['%s'] * len(ids)),
+                       [finest, finest, finest] + ids + [low, high])
+      for resolution in self.resolutions[1:]:
+        self._rollup_coarse(cursor, [id for id, uuid in sources], resolution, low - low % resolution, high)
+      cnx.commit()
+      return True
+    except mysql.connector.Error as err:
+      logging.error('Failed to roll up data: ' + repr(err))
+      try:
+        cnx.rollback()
+      except mysql.connector.Error:
+        pass
+    finally:
+      cursor.close()
+      self.pool.put(cnx)
+    return False
+
+  def _rollup_coarse(self, cursor, ids, resolution, low, high):
+    """
+    Recomputes the rollups of resolution from low up to high, using the
+    finest rollups
+    """
+    cursor.execute('INSERT INTO rollups (source, resolution, ts, count, sum, min, max) '
+                   'SELECT source, %%s, FROM_UNIXTIME(FLOOR(UNIX_TIMESTAMP(ts) / %%s) * %%s) AS bucket, SUM(count), SUM(sum), MIN(min), MAX(max) '
+                   'FROM rollups WHERE source IN (%s) AND resolution = %%s AND ts >= FROM_UNIXTIME(%%s) AND ts < FROM_UNIXTIME(%%s) GROUP BY source, bucket '
+                   'ON DUPLICATE KEY UPDATE count = VALUES(count), sum = VALUES(sum), min = VALUES(min), max = VALUES(max)' % ', '.join(['%s'] * len(ids)),
+                   [resolution, resolution, resolution] + ids + [self.resolutions[0], low, high])
+
+  def _aggregate(self, id, low, high):
+    """
+    Finest rollups of a source from low up to high computed from its
+    points, as a list of (source, bucket, count, sum, min, max). None on
+    failure.
+    """
+    finest = self.resolutions[0]
+    result = self._query_data([id], low, high - 1, 0, 0, Storage.GROUP_BY_NONE, False)
+    if result.getError() is not None:
+      return None
+    buckets = {}
+    try:
+      while True:
+        row = result.next()
+        if row is None:
+          break
+        ts = int(row['ts'])
+        bucket = buckets.get(ts - ts % finest)
+        if bucket is None:
+          buckets[ts - ts % finest] = [1, row['value'], row['value'], row['value']]
+        else:
+          bucket[0] += 1
+          bucket[1] += row['value']
+          bucket[2] = min(bucket[2], row['value'])
+          bucket[3] = max(bucket[3], row['value'])
+      if result.getError() is not None:
+        return None
+    finally:
+      result.release()
+    return [tuple([id, ts] + values) for ts, values in sorted(buckets.items())]
+
+  def _store_rollups(self, cursor, rows):
+    """
+    Writes finest rollups, a list of (source, bucket, count, sum, min, max)
+    """
+    for i in range(0, len(rows), 1000):
+      chunk = rows[i:i+1000]
+      params = []
+      for row in chunk:
+        params.extend([row[0], self.resolutions[0]] + list(row[1:]))
+      cursor.execute('INSERT INTO rollups (source, resolution, ts, count, sum, min, max) VALUES ' +
+                     ','.join(['(%s, %s, FROM_UNIXTIME(%s), %s, %s, %s, %s)'] * len(chunk)) +
+                     ' ON DUPLICATE KEY UPDATE count = VALUES(count), sum = VALUES(sum), min = VALUES(min), max = VALUES(max)', params)
+
+  def _rollup_dirty(self):
+    """
+    Rolls up again the buckets which had points recorded after they were
+    rolled up
+    """
+    cnx = self._connection()
+    if cnx is None:
+      return False
+    cursor = cnx.cursor(buffered=True)
+    try:
+      cursor.execute('SELECT source, UNIX_TIMESTAMP(ts) FROM rollup_dirty')
+      dirty = [(source, int(ts)) for source, ts in cursor.fetchall()]
+      # Cleared before rolling up, points recorded in the meantime will
+      # mark the bucket again
+      for source, ts in dirty:
+        cursor.execute('DELETE FROM rollup_dirty WHERE source = %s AND ts = FROM_UNIXTIME(%s)', (source, ts))
+      cnx.commit()
+    except mysql.connector.Error as err:
+      logging.error('Failed to find dirty rollups: ' + repr(err))
+      return False
+    finally:
+      cursor.close()
+      self.pool.put(cnx)
+    if not dirty:
+      return True
+
+    finest = self.resolutions[0]
+    rows = []
+    for source, ts in dirty:
+      result = self._aggregate(source, ts, ts + finest)
+      if result is None:
+        self._mark_dirty([(source, None, ts) for source, ts in dirty], True)
+        return False
+      rows.extend(result)
+
+    cnx = self._connection()
+    if cnx is None:
+      self._mark_dirty([(source, None, ts) for source, ts in dirty], True)
+      return False
+    cursor = cnx.cursor(buffered=True)
+    try:
+      self._store_rollups(cursor, rows)
+      for resolution in self.resolutions[1:]:
+        for source, low in set([(source, ts - ts % resolution) for source, ts in dirty]):
+          self._rollup_coarse(cursor, [source], resolution, low, low + resolution)
+      cnx.commit()
+      logging.info('Rolled up %d buckets again' % len(dirty))
+      # Results cached meanwhile may have come from the old rollups
+      self._invalidate([(source, None, ts) for source, ts in dirty])
+      return True
+    except mysql.connector.Error as err:
+      logging.error('Failed to roll up data: ' + repr(err))
+      try:
+        cnx.rollback()
+      except mysql.connector.Error:
+        pass
+    finally:
+      cursor.close()
+      self.pool.put(cnx)
+    self._mark_dirty([(source, None, ts) for source, ts in dirty], True)
+    return False
+
+  def _mark_dirty(self, points, force=False):
+    """
+    Notes the buckets of (source, value, ts) points which are older than
+    the watermark, so they are rolled up again
+    """
+    watermark = self._watermark()
+    if watermark is None:
+      return
+    finest = self.resolutions[0]
+    late = set([(id, ts - ts % finest) for id, value, ts in points if force or ts < watermark])
+    if not late:
+      return
+    params = []
+    for pair in late:
+      params.extend(pair)
+    self._execute(['INSERT IGNORE INTO rollup_dirty (source, ts) VALUES ' + ','.join(['(%s, FROM_UNIXTIME(%s))'] * len(late))], params)
+
+  def _prepare(self, cnx):
+    # All sources along with their latest value in one go. The newest ts per
+    # source is found with a loose scan of the (source, ts) key, which only
+    # touches one index entry per source. Restored latest values save even
+    # that.
+    restoring = self._restoring()
+    if restoring:
+      query = 'SELECT id, uuid, sid, name, type, accuracy, parameters, NULL AS ts, NULL AS value FROM sources'
+    else:
+      query = ('SELECT id, uuid, sid, name, type, accuracy, parameters, UNIX_TIMESTAMP(data.ts) AS ts, data.value '
+               'FROM sources '
+               'LEFT JOIN (SELECT source, MAX(ts) AS ts FROM data GROUP BY source) AS newest ON newest.source = sources.id '
+               'LEFT JOIN data ON data.source = newest.source AND data.ts = newest.ts')
+    start = time.time()
+    cursor = cnx.cursor(dictionary=True, buffered=True)
     try:
       cursor.execute(query)
       for row in cursor:
-        self.cache[row['uuid']] = row
-        self.cache[row['uuid']]['latest'] = None
-        cursor2.execute('SELECT UNIX_TIMESTAMP(ts) AS ts,value FROM data WHERE source = %s ORDER BY ts DESC LIMIT 1', (self.cache[row['uuid']]['id'],))
-        for r2 in cursor2:
-          self.cache[row['uuid']]['latest'] = {
-            'value' : r2['value'],
-            'ts' : r2['ts']
+        ts = row.pop('ts')
+        value = row.pop('value')
+        row['latest'] = None
+        if ts is not None:
+          row['latest'] = {
+            'value' : value,
+            'ts' : ts
           }
+        with self.lock:
+          self._add_source(row)
     except mysql.connector.Error as err:
       logging.error('Failed to prepare cache: ' + repr(err));
     finally:
       cursor.close()
-      cursor2.close()
+
+    if restoring and not self._restore():
+      return self._prepare(cnx)
+
+    # Sources which only have compacted data get their latest value from
+    # the newest chunk, when restoring it only matters if there are any
+    if restoring:
+      query = 'SELECT source, NULL AS ts, NULL AS value FROM chunks LIMIT 1'
+    else:
+      query = ('SELECT chunks.source, UNIX_TIMESTAMP(last) AS ts, value FROM chunks '
+               'JOIN (SELECT source, MAX(start) AS start FROM chunks GROUP BY source) AS newest ON newest.source = chunks.source AND newest.start = chunks.start')
+    cursor = cnx.cursor(dictionary=True, buffered=True)
+    try:
+      cursor.execute(query)
+      with self.lock:
+        ids = dict([(source['id'], source) for source in self.cache.values()])
+        for row in cursor:
+          self.compacted = True
+          source = ids.get(row['source'])
+          if source is not None and row['ts'] is not None and (source['latest'] is None or source['latest']['ts'] < row['ts']):
+            source['latest'] = {
+              'value' : row['value'],
+              'ts' : row['ts']
+            }
+    except mysql.connector.Error as err:
+      # Not there until the tables are upgraded
+      if err.errno != errorcode.ER_NO_SUCH_TABLE:
+        logging.error('Failed to prepare cache: ' + repr(err));
+    finally:
+      cursor.close()
+    self._publish()
+    self._share_state()
+    if restoring:
+      logging.info('Loaded %d sources in %.2fs, latest values restored' % (len(self.cache), time.time() - start))
+    else:
+      with self.lock:
+        withdata = len([source for source in self.cache.values() if source['latest'] is not None])
+      logging.info('Loaded %d sources (%d with data) in %.2fs' % (len(self.cache), withdata, time.time() - start))
 
     query = 'SELECT id, uuid, name, description FROM types'
-    cursor = self.cnx.cursor(dictionary=True, buffered=True)
+    cursor = cnx.cursor(dictionary=True, buffered=True)
     try:
       cursor.execute(query)
       for row in cursor:
-        self._types[row['uuid']] = row
+        with self.lock:
+          self._add_type(row)
       return True
     except mysql.connector.Error as err:
       logging.error('Failed to prepare cache: ' + repr(err));
@@ -135,256 +1098,474 @@ class MariaDB:
 
     return False
 
+  def _reload(self):
+    cnx = self._connection()
+    if cnx is None:
+      return False
+    cursor = cnx.cursor(dictionary=True, buffered=True)
+    try:
+      cursor.execute('SELECT id, uuid, sid, name, type, accuracy, parameters FROM sources')
+      for row in cursor:
+        row['latest'] = None
+        with self.lock:
+          if row['uuid'] not in self.cache:
+            self._add_source(row)
+      cursor.execute('SELECT id, uuid, name, description FROM types')
+      for row in cursor:
+        with self.lock:
+          if row['uuid'] not in self._types:
+            self._add_type(row)
+      return True
+    except mysql.connector.Error as err:
+      logging.error('Failed to reload sources: ' + repr(err))
+    finally:
+      cursor.close()
+      self.pool.put(cnx)
+    return False
+
   def add_type(self, uuid, name, description):
     query = 'INSERT INTO types (uuid, name, description) VALUES (%s, %s, %s)'
-    cursor = self.cnx.cursor(buffered=True)
+    cnx = self._connection()
+    if cnx is None:
+      return False
+    cursor = cnx.cursor(buffered=True)
     try:
       cursor.execute(query, (uuid, name, description))
-      self.cnx.commit()
-      self._types[uuid] = {
-        'id' : cursor.lastrowid,
-        'uuid' : uuid,
-        'name' : name,
-        'description' : description
-      }
+      cnx.commit()
+      with self.lock:
+        self._add_type({
+          'id' : cursor.lastrowid,
+          'uuid' : uuid,
+          'name' : name,
+          'description' : description
+        })
+      self._changed()
       return True
     except mysql.connector.Error as err:
       logging.error('Failed to add type: ' + repr(err));
     finally:
       cursor.close()
+      self.pool.put(cnx)
     return False
 
   def add_source(self, uuid, sid, name, type, accuracy = 1, parameters = ''):
     query = 'INSERT INTO sources (uuid, sid, name, type, accuracy, parameters) VALUES (%s, %s, %s, %s, %s, %s)'
-    if type not in self._types:
-      return False
-    typeid = self._types[type]['id']
+    self._refresh()
+    with self.lock:
+      if type not in self._types:
+        return False
+      typeid = self._types[type]['id']
 
-    cursor = self.cnx.cursor(buffered=True)
+    cnx = self._connection()
+    if cnx is None:
+      return False
+    cursor = cnx.cursor(buffered=True)
     try:
       cursor.execute(query, (uuid, sid, name, typeid, accuracy, parameters))
-      self.cnx.commit()
-      self.cache[uuid] = {
-        'id' : cursor.lastrowid,
-        'uuid' : uuid,
-        'sid' : sid,
-        'name' : name,
-        'type' : type,
-        'accuracy' : accuracy,
-        'parameters' : parameters,
-        'latest' : None
-      }
+      cnx.commit()
+      with self.lock:
+        self._add_source({
+          'id' : cursor.lastrowid,
+          'uuid' : uuid,
+          'sid' : sid,
+          'name' : name,
+          'type' : typeid,
+          'accuracy' : accuracy,
+          'parameters' : parameters,
+          'latest' : None
+        })
+      self._changed()
       return True
     except mysql.connector.Error as err:
       logging.error('Failed to add source: ' + repr(err));
     finally:
       cursor.close()
+      self.pool.put(cnx)
     return False
 
-  def record(self, uuid, value, ts = None):
+  def record(self, uuid, value, ts = None, sync = False):
     if ts is None:
       ts = int(round(time.time()))
     if ts < 1:
       logging.warn('Cannot have timestamps less than 1, typically indicate issue :)')
       return False
-    query = 'INSERT INTO data (source, value, ts) VALUES (%s, %s, FROM_UNIXTIME(%s))'
-    cursor = self.cnx.cursor(buffered=True)
-    if uuid in self.cache:
-      id = self.cache[uuid]['id']
+    query = 'INSERT INTO data (source, value, ts) VALUES (%s, %s, FROM_UNIXTIME(%s)) ON DUPLICATE KEY UPDATE value = VALUES(value)'
+    self._refresh()
+    source = self.cache.get(uuid, None)
+    if source is not None:
+      id = source['id']
     else:
       logging.warn('UUID %s does not exist' % uuid)
       return False
+    value = self._value(value)
+    if value is None:
+      logging.warn('Value of %s is out of range' % uuid)
+      return False
 
-    try:
-      cursor.execute(query, (id, value, ts))
-      self.cnx.commit()
-      if self.cache[uuid]['latest'] is None or self.cache[uuid]['latest']['ts'] <= ts:
-        self.cache[uuid]['latest'] = {
-          'value' : value,
-          'ts' : ts
-        }
-      return True
-    except mysql.connector.Error as err:
-      logging.error('Failed to record data: ' + repr(err));
-    finally:
-      cursor.close()
-    return False
+    if self.buffer is not None:
+      self._update_latest(uuid, value, ts)
+      self._recorded([(uuid, value, ts)])
+      return self.buffer.put((id, value, ts), sync)
 
-  def sid2uuid(self, sid):
-    cursor = self.cnx.cursor(dictionary=True, buffered=True)
-    result = []
+    cnx = self._connection()
+    if cnx is None:
+      return False
+    cursor = cnx.cursor(buffered=True)
     try:
-      print("SID: " + repr(sid))
-      query = 'SELECT uuid FROM sources WHERE sid = "%s"' % sid
-      cursor.execute(query)
-      result = cursor.fetchone()
-      return result['uuid']
+      with self.executing['record'].time():
+        cursor.execute(query, (id, value, ts))
+      with self.committing['record'].time():
+        cnx.commit()
+      self._update_latest(uuid, value, ts)
     except mysql.connector.Error as err:
-      logging.error('Failed to find data: ' + repr(err));
+      logging.error('Failed to record data: ' + repr(err));
+      return False
     finally:
       cursor.close()
-    return None
-
-  def type(self, uuid):
-    return self.types(uuid)
+      self.pool.put(cnx)
+    self._mark_dirty([(id, value, ts)])
+    self._invalidate([(id, value, ts)])
+    self._recorded([(uuid, value, ts)])
+    return True
 
-  def types(self, uuid=None):
-    cursor = self.cnx.cursor(dictionary=True, buffered=True)
-    result = []
+  def query(self, uuids, ts_start = None, ts_end = None, count = 0, groupby = 0, mode = Storage.GROUP_BY_NONE, descending=False, percentile=50):
+    self._refresh()
+    ids = []
+    for u in uuids:
+      if u in self.cache:
+        ids.append(self.cache[u]['id'])
+    if not ids:
+      return Iterator(None)
 
-    print(repr(self._types))
+    # Relative offsets are resolved here, once, so the database compares
+    # the ts column against constants and can use the (source, ts) key
+    now = int(time.time())
+    if ts_start is not None and ts_start < 0:
+      ts_start = now + ts_start
+    if ts_end is not None and ts_end < 0:
+      ts_end = now + ts_end
 
-    try:
-      if uuid is None:
-        query = 'SELECT uuid, name, description FROM types'
-        cursor.execute(query)
-      elif uuid in self._types:
-        query = 'SELECT uuid, name, description FROM types WHERE id = %s' % self._types[uuid]['id']
-        print(repr(query))
-        cursor.execute(query)
-      else:
-        logging.error('No such UUID: "%s"', repr(uuid));
-        return None
-      logging.debug("Statement: " + repr(cursor.statement))
-      for row in cursor:
-        result.append(row)
-      return result
-    except mysql.connector.Error as err:
-      logging.error('Failed to record data: ' + repr(err));
-    finally:
-      cursor.close()
-    return None
+    grouped = mode != Storage.GROUP_BY_NONE and groupby > 0
+    if grouped and mode not in Aggregate.MODES:
+      logging.error('This database doesn\'t support desired grouping method')
+      return None
 
-  def source(self, uuid):
-    return self.sources(uuid)
+    if grouped and self.query_cache is not None:
+      result = self.query_cache.query(ids, ts_start, ts_end, count, int(groupby), mode, descending, percentile)
+      if result is not None:
+        return result
+    return self._query(ids, ts_start, ts_end, count, groupby, mode, descending, percentile)
 
-  def sources(self, uuid = None):
+  def _query(self, ids, ts_start, ts_end, count, groupby, mode, descending, percentile=50):
     """
-    Returns registered sources and details about them
+    Answers a query with an absolute range from the rollups if possible,
+    otherwise from the data
     """
-    cursor = self.cnx.cursor(dictionary=True, buffered=True)
-    result = []
-
-    try:
-      if uuid is None:
-        query = 'SELECT uuid, sid, name, type, accuracy, parameters FROM sources'
-        cursor.execute(query)
-      elif uuid in self.cache:
-        query = 'SELECT uuid, sid, name, type, accuracy, parameters FROM sources WHERE id = %s' % self.cache[uuid]['id']
-        cursor.execute(query)
-      else:
-        logging.error('No such UUID: "%s"', repr(uuid));
-        return None
-      logging.debug("Statement: " + repr(cursor.statement))
-      for row in cursor:
-        result.append(row)
-      return result
-    except mysql.connector.Error as err:
-      logging.error('Failed to record data: ' + repr(err));
-    finally:
-      cursor.close()
-    return None
+    grouped = mode != Storage.GROUP_BY_NONE and groupby > 0
+    if grouped:
+      resolution = self._resolution(int(groupby))
+      if resolution is not None:
+        result = self._query_rollups(ids, resolution, ts_start, ts_end, count, int(groupby), mode, descending)
+        if result is not None:
+          return result
+    return self._query_data(ids, ts_start, ts_end, count, groupby, mode, descending, percentile)
 
-  def query_latest(self, uuids):
-    result = []
-    for u in uuids:
-      if u in self.cache:
-        result.append({'uuid' : u, 'ts' : self.cache[uuid]['latest']['ts'] , 'value' : self.cache[uuid]['latest']['value']})
-    return result
-
-  def query(self, uuids, ts_start = None, ts_end = None, count = 0, groupby = 0, mode = Storage.GROUP_BY_NONE, descending=False):
+  def _query_data(self, ids, ts_start, ts_end, count, groupby, mode, descending, percentile=50):
     """
-    Retrieves data points from UUIDs
-    ts_start will limit results on timestamp. If negative, counts back from now
-    ts_end will limit results on timestamp. If negative, counts back from now
-    Limit to count (zero means no limit)
-    Group it by groupby seconds (zero means no grouping)
-
-    Grouping essentially breaks it down to groups of X seconds, using
-    the described method in mode (default is sum)
-
-    Returns iterator which allows streaming of data
+    Answers a query from the data table (and any compressed chunks)
     """
+    grouped = mode != Storage.GROUP_BY_NONE and groupby > 0
+    if grouped and mode not in self.GROUP_METHOD:
+      # Points are read in order and grouped as they come
+      result = Stream.group(Stream.rows(self._query_data(ids, ts_start, ts_end, 0, 0, Storage.GROUP_BY_NONE, descending)), int(groupby), mode, percentile)
+      if count > 0:
+        result = Stream.limit(result, int(count))
+      return Stream.StreamIterator(result)
+
+    # Older points may be compacted, in which case the result is put
+    # together here rather than by the database
+    if self._compacted():
+      chunks = self._chunks(ids, ts_start, ts_end)
+      if chunks is None:
+        return Iterator(None, 'Error performing query')
+      if chunks:
+        return self._query_chunks(ids, chunks, ts_start, ts_end, count, groupby, mode, descending, percentile)
 
     # Build the query
-    query = ''
-    if mode != Storage.GROUP_BY_NONE and groupby > 0:
-      if mode > len(self.GROUP_METHOD):
-        logging.error('This database doesn\'t support desired grouping method')
-        return None
-      query = 'SELECT uuid, %s(value) AS value, (ROUND(UNIX_TIMESTAMP(ts) / %d) * %d) AS ts ' % (self.GROUP_METHOD[mode-1], groupby, groupby)
+    params = []
+    if grouped:
+      bucket = '(FLOOR(UNIX_TIMESTAMP(data.ts) / %s) * %s)'
+      query = 'SELECT uuid, %s(value) AS value, %s AS ts ' % (self.GROUP_METHOD[mode], bucket)
+      params.extend([int(groupby), int(groupby)])
     else:
-      query = 'SELECT uuid, value, UNIX_TIMESTAMP(ts) AS ts '
+      query = 'SELECT uuid, value, UNIX_TIMESTAMP(data.ts) AS ts '
 
-    query += 'FROM data LEFT JOIN sources ON data.source = sources.id WHERE id IN ('
-    for u in uuids:
-      if u in self.cache:
-        query += '%d,' % self.cache[u]['id']
-    query = query[:-1] + ') '
+    query += 'FROM data JOIN sources ON data.source = sources.id WHERE data.source IN (%s) ' % ', '.join(['%s'] * len(ids))
+    params.extend(ids)
 
     if ts_start is not None:
-      if ts_start < 0:
-        query += 'AND UNIX_TIMESTAMP(ts) >= UNIX_TIMESTAMP(NOW()%d) ' % ts_start
-      else:
-        query += 'AND UNIX_TIMESTAMP(ts) >= %d ' % ts_start
+      query += 'AND data.ts >= FROM_UNIXTIME(%s) '
+      params.append(ts_start)
     if ts_end is not None:
-      if ts_end < 0:
-        query += 'AND UNIX_TIMESTAMP(ts) <= UNIX_TIMESTAMP(NOW()%d) ' % ts_end
-      else:
-        query += 'AND UNIX_TIMESTAMP(ts) <= %d ' % ts_end
-
-    if mode != Storage.GROUP_BY_NONE:
-      query += 'GROUP BY source, (ROUND(UNIX_TIMESTAMP(ts) / %d) * %d) ' % (groupby, groupby)
+      query += 'AND data.ts <= FROM_UNIXTIME(%s) '
+      params.append(ts_end)
 
-    query += 'ORDER BY ts '
+    if grouped:
+      query += 'GROUP BY data.source, %s ORDER BY ts ' % bucket
+      params.extend([int(groupby), int(groupby)])
+    else:
+      query += 'ORDER BY data.ts '
     if descending:
       query += 'DESC '
     if count > 0:
-      query += 'LIMIT %d' % count
-    logging.debug('Query statement: ' + query)
+      query += 'LIMIT %s'
+      params.append(int(count))
+    return self._stream(query, params)
 
-    cursor = self.cnx.cursor(dictionary=True, buffered=True)
+  def _stream(self, query, params):
+    """
+    Runs a query and returns an Iterator over the result
+    """
+    logging.debug('Query statement: ' + query + ' ' + repr(params))
+
+    # Results are streamed from an unbuffered cursor, which ties up the
+    # connection until the iterator is released
+    cnx = self._connection()
+    if cnx is None:
+      return Iterator(None, 'Error performing query')
+    cursor = cnx.cursor(dictionary=True)
     try:
-      cursor.execute(query)
-      return Iterator(cursor, None)
+      with self.executing['query'].time():
+        cursor.execute(query, params)
+      return Iterator(cursor, None, cnx, self.pool)
     except mysql.connector.Error as err:
-      logging.error('Failed to record data: ' + repr(err));
-    cursor.close()
+      logging.error('Failed to query data: ' + repr(err));
+    self.pool.put(cnx, discard=True)
     return Iterator(None, 'Error performing query')
 
-class Iterator:
-  def __init__(self, resultset, error=None):
-    self.cursor = resultset
-    self.error = error
-    pass
+  def _resolution(self, groupby):
+    """
+    Coarsest rollup resolution which groupby is a multiple of, None if
+    there is none
+    """
+    with self.lock:
+      for resolution in reversed(self.resolutions):
+        if groupby % resolution == 0:
+          return resolution
+    return None
+
+  def _query_rollups(self, ids, resolution, ts_start, ts_end, count, groupby, mode, descending):
+    """
+    Answers a grouped query from the rollups of resolution as far as they
+    go. Buckets only partly within the range, or not rolled up yet, are
+    grouped from the points. Returns None if no bucket could be had from
+    the rollups.
+    """
+    if mode == Storage.GROUP_BY_SUM:
+      value = 'SUM(sum)'
+    elif mode == Storage.GROUP_BY_AVERAGE:
+      value = 'SUM(sum) / SUM(count)'
+    elif mode == Storage.GROUP_BY_MIN:
+      value = 'MIN(min)'
+    elif mode == Storage.GROUP_BY_MAX:
+      value = 'MAX(max)'
+    elif mode == Storage.GROUP_BY_COUNT:
+      value = 'SUM(count)'
+    else:
+      return None
+
+    watermark = self._watermark()
+    low = None
+    if ts_start is not None:
+      low = ts_start + (-ts_start % groupby)
+    high = watermark - watermark % groupby
+    if ts_end is not None:
+      high = min(high, ts_end + 1 - (ts_end + 1) % groupby)
+    if low is not None and low >= high:
+      return None
+
+    bucket = '(FLOOR(UNIX_TIMESTAMP(rollups.ts) / %s) * %s)'
+    query = 'SELECT uuid, %s AS value, %s AS ts ' % (value, bucket)
+    query += 'FROM rollups JOIN sources ON rollups.source = sources.id WHERE rollups.source IN (%s) AND resolution = %%s ' % ', '.join(['%s'] * len(ids))
+    params = [groupby, groupby] + ids + [resolution]
+    if low is not None:
+      query += 'AND rollups.ts >= FROM_UNIXTIME(%s) '
+      params.append(low)
+    query += 'AND rollups.ts < FROM_UNIXTIME(%s) '
+    params.append(high)
+    query += 'GROUP BY rollups.source, %s ORDER BY ts ' % bucket
+    params.extend([groupby, groupby])
+    if descending:
+      query += 'DESC '
+    if count > 0:
+      query += 'LIMIT %s'
+      params.append(int(count))
+
+    parts = []
+    if low is not None and ts_start < low:
+      parts.append((self._query_data, (ids, ts_start, low - 1, count, groupby, mode, descending)))
+    parts.append((self._stream, (query, params)))
+    if ts_end is None or high <= ts_end:
+      parts.append((self._query_data, (ids, high, ts_end, count, groupby, mode, descending)))
+    if descending:
+      parts.reverse()
+
+    result = self._chain(parts)
+    if count > 0:
+      result = Stream.limit(result, int(count))
+    return Stream.StreamIterator(result)
 
-  def getError(self):
+  def _chain(self, parts):
     """
-    Returns any potential error, if no error condition exist,
-    it will return None
+    Yields the rows of one query after the other, parts is a list of
+    functions returning an Iterator along with their arguments
     """
-    return self.error
+    for function, args in parts:
+      for row in Stream.rows(function(*args)):
+        yield row
 
-  def next(self):
+  def _chunks(self, ids, ts_start, ts_end):
+    """
+    Returns the compressed chunks of the sources which hold points between
+    ts_start and ts_end, as a dict of source id and list of chunks ordered
+    by time. None if the lookup failed.
+    """
+    query = 'SELECT source, data FROM chunks WHERE source IN (%s) ' % ', '.join(['%s'] * len(ids))
+    params = list(ids)
+    if ts_start is not None:
+      query += 'AND start > FROM_UNIXTIME(%s) AND last >= FROM_UNIXTIME(%s) '
+      params.extend([ts_start - self.CHUNK, ts_start])
+    if ts_end is not None:
+      query += 'AND start <= FROM_UNIXTIME(%s) AND first <= FROM_UNIXTIME(%s) '
+      params.extend([ts_end, ts_end])
+    query += 'ORDER BY source, start'
+
+    cnx = self._connection()
+    if cnx is None:
+      return None
+    cursor = cnx.cursor(buffered=True)
+    result = {}
+    try:
+      cursor.execute(query, params)
+      for source, data in cursor:
+        result.setdefault(source, []).append(data)
+      return result
+    except mysql.connector.Error as err:
+      # Not there until the tables are upgraded
+      if err.errno == errorcode.ER_NO_SUCH_TABLE:
+        return result
+      logging.error('Failed to find chunks: ' + repr(err))
+    finally:
+      cursor.close()
+      self.pool.put(cnx)
+    return None
+
+  def _query_chunks(self, ids, chunks, ts_start, ts_end, count, groupby, mode, descending, percentile=50):
     """
-    Advances to the next record, returning current
-    Record is a dict of source, ts, value
+    Query where some of the points are in compressed chunks. The chunks
+    are decoded as the result is read and merged with the points still in
+    data, which are read a page at a time per source (see _paged()).
+    Grouping is done in Python, see Stream.
+    """
+    with self.lock:
+      uuids = dict([(source['id'], source['uuid']) for source in self.cache.values()])
+    streams = []
+    for id in ids:
+      result = Stream.overlay(self._decode(uuids[id], chunks.get(id, []), ts_start, ts_end, descending),
+                              self._paged(id, uuids[id], ts_start, ts_end, descending),
+                              descending)
+      if mode != Storage.GROUP_BY_NONE and groupby > 0:
+        result = Stream.group(result, int(groupby), mode, percentile)
+      streams.append(result)
+
+    result = Stream.merge(streams, descending)
+    if count > 0:
+      result = Stream.limit(result, int(count))
+    return Stream.StreamIterator(result)
 
-    If no more record exists, the function returns None
+  def _paged(self, id, uuid, ts_start, ts_end, descending):
     """
-    if self.error is not None:
+    Yields the points of source id still in data, PAGE rows at a time
+    continuing from the ts of the last one, so neither the rows nor a
+    connection are held on to while the result is read
+    """
+    low, high = ts_start, ts_end
+    while True:
+      query = 'SELECT UNIX_TIMESTAMP(ts), value FROM data WHERE source = %s '
+      params = [id]
+      if low is not None:
+        query += 'AND ts >= FROM_UNIXTIME(%s) '
+        params.append(low)
+      if high is not None:
+        query += 'AND ts <= FROM_UNIXTIME(%s) '
+        params.append(high)
+      query += 'ORDER BY ts %s LIMIT %%s' % ('DESC' if descending else 'ASC')
+      params.append(self.PAGE)
+
+      cnx = self._connection()
+      if cnx is None:
+        raise RuntimeError('No database connection')
+      cursor = cnx.cursor(buffered=True)
+      try:
+        with self.executing['query'].time():
+          cursor.execute(query, params)
+        rows = cursor.fetchall()
+      except mysql.connector.Error as err:
+        raise RuntimeError('Failed to query data: ' + repr(err))
+      finally:
+        cursor.close()
+        self.pool.put(cnx)
+
+      for ts, value in rows:
+        yield {'uuid' : uuid, 'value' : value, 'ts' : int(ts)}
+      if len(rows) < self.PAGE:
+        return
+      # ts is whole seconds and unique per source
+      if descending:
+        high = int(rows[-1][0]) - 1
+      else:
+        low = int(rows[-1][0]) + 1
+
+  def _decode(self, uuid, chunks, ts_start, ts_end, descending):
+    if descending:
+      chunks = reversed(chunks)
+    for data in chunks:
+      for ts, value in Compression.read(data, ts_start, ts_end, descending):
+        yield {'uuid' : uuid, 'value' : value, 'ts' : ts}
+
+class Iterator(Backend.Iterator):
+  def __init__(self, resultset, error=None, connection=None, pool=None):
+    Backend.Iterator.__init__(self, error)
+    self.cursor = resultset
+    self.cnx = connection
+    self.pool = pool
+    self.done = False
+
+  def next(self):
+    if self.error is not None or self.cursor is None:
       return None
-    rec = self.cursor.fetchone()
+    try:
+      rec = self.cursor.fetchone()
+    except mysql.connector.Error as err:
+      logging.error('Failed to read result: ' + repr(err))
+      self.error = 'Error reading result'
+      return None
+    if rec is None:
+      self.done = True
     return rec
 
   def release(self):
-    """
-    Early bailout, after calling this function, the iterator
-    resources are freed and you should not use it anymore.
-    """
-    if self.error is not None:
+    if self.cursor is None:
       return
-    self.error = 'Iterator is released'
-    self.cursor.close()
+    if self.error is None:
+      self.error = 'Iterator is released'
+    if self.done:
+      self.cursor.close()
+      self.pool.put(self.cnx)
+    else:
+      # Closing normally would read all remaining rows first, so drop
+      # the connection instead
+      self.pool.put(self.cnx, discard=True)
     self.cursor = None
+    self.cnx = None
     return
@@ -0,0 +1,140 @@
+import time
+import bisect
+import threading
+import collections
+
+def format_value(value):
+  if isinstance(value, float):
+    if value == float('inf'):
+      return '+Inf'
+    return repr(value)
+  return str(value)
+
+def format_labels(labels):
+  if not labels:
+    return ''
+  escaped = []
+  for name, value in labels:
+    value = unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    escaped.append('%s="%s"' % (name, value))
+  return '{' + ','.join(escaped) + '}'
+
+class Counter:
+  def __init__(self):
+    self.value = 0
+    self.lock = threading.Lock()
+
+  def inc(self, amount=1):
+    with self.lock:
+      self.value += amount
+
+  def samples(self, name, labels):
+    yield name, labels, self.value
+
+class Reading:
+  """
+  Value which is only looked at when the metrics are rendered, such as
+  the length of a queue
+  """
+  def __init__(self, fetch):
+    self.fetch = fetch
+
+  def samples(self, name, labels):
+    value = self.fetch()
+    if value is not None:
+      yield name, labels, value
+
+class Timer:
+  def __init__(self, histogram):
+    self.histogram = histogram
+
+  def __enter__(self):
+    self.start = time.time()
+
+  def __exit__(self, kind, value, trace):
+    self.histogram.observe(time.time() - self.start)
+
+class Histogram:
+  """
+  Counts observations by the first bucket (upper bound) they fit in
+  """
+  def __init__(self, bounds):
+    self.bounds = bounds
+    self.counts = [0] * (len(bounds) + 1)
+    self.sum = 0
+    self.lock = threading.Lock()
+
+  def observe(self, value):
+    i = bisect.bisect_left(self.bounds, value)
+    with self.lock:
+      self.counts[i] += 1
+      self.sum += value
+
+  def time(self):
+    """
+    Observes how many seconds the with block takes
+    """
+    return Timer(self)
+
+  def samples(self, name, labels):
+    with self.lock:
+      counts = list(self.counts)
+      total = self.sum
+    cumulative = 0
+    for bound, count in zip(self.bounds + [float('inf')], counts):
+      cumulative += count
+      yield name + '_bucket', labels + (('le', format_value(bound)),), cumulative
+    yield name + '_sum', labels, total
+    yield name + '_count', labels, cumulative
+
+class Metrics:
+  """
+  Counters, histograms and readings of this process, rendered in the
+  Prometheus text format. A metric is looked up (and created the first
+  time) by name and labels, callers on hot paths keep hold of it.
+  """
+  # Bucket bounds for timings in seconds and for sizes of batches
+  LATENCY = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+  SIZES = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+  def __init__(self):
+    # name : (type, help, { labels : metric })
+    self.families = collections.OrderedDict()
+    self.lock = threading.Lock()
+
+  def _get(self, name, kind, help, labels, create):
+    key = tuple(sorted(labels.items()))
+    with self.lock:
+      family = self.families.get(name, None)
+      if family is None:
+        family = (kind, help, {})
+        self.families[name] = family
+      metric = family[2].get(key, None)
+      if metric is None:
+        metric = create()
+        family[2][key] = metric
+      return metric
+
+  def counter(self, name, help, **labels):
+    return self._get(name, 'counter', help, labels, Counter)
+
+  def histogram(self, name, help, bounds=LATENCY, **labels):
+    return self._get(name, 'histogram', help, labels, lambda: Histogram(bounds))
+
+  def reading(self, name, kind, help, fetch, **labels):
+    """
+    Adds a metric of kind (gauge or counter) whose value is fetch()
+    """
+    return self._get(name, kind, help, labels, lambda: Reading(fetch))
+
+  def render(self):
+    with self.lock:
+      families = [(name, kind, help, sorted(metrics.items())) for name, (kind, help, metrics) in self.families.items()]
+    lines = []
+    for name, kind, help, metrics in families:
+      lines.append('# HELP %s %s' % (name, help))
+      lines.append('# TYPE %s %s' % (name, kind))
+      for labels, metric in metrics:
+        for sample, sample_labels, value in metric.samples(name, labels):
+          lines.append('%s%s %s' % (sample, format_labels(sample_labels), format_value(value)))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,235 @@
+import time
+import bisect
+import threading
+import logging
+import collections
+import Backend
+import Stream
+
+class Entry:
+  """
+  Cached result of one grouped query, the rows of buckets from low up to
+  (but not including) high in ascending order
+  """
+  def __init__(self, ids, groupby, low):
+    self.ids = ids
+    self.groupby = groupby
+    self.low = low
+    self.high = low
+    self.rows = []
+    # ts of each row, for bisecting
+    self.starts = []
+    # Lowest bucket asked for since the entry was last trimmed
+    self.asked = low
+    self.trimmed = time.time()
+
+class QueryCache:
+  """
+  Keeps the results of grouped queries for buckets which are over, so a
+  dashboard asking for the same thing again only has the buckets at the
+  edges of its range read from storage.
+
+  Results are kept per set of sources, groupby, mode and percentile. They
+  cover the whole buckets of the range asked for up to the last one which
+  ended settle seconds ago, and are extended as time goes on. Points
+  recorded for one of those buckets drop it and the ones after it, see
+  invalidate(). At most size rows are kept, the results used least
+  recently go first.
+
+  fetch is called as fetch(ids, ts_start, ts_end, count, groupby, mode,
+  descending, percentile) for what isn't cached and returns an Iterator.
+  """
+  # Rows of buckets no query has asked for in this many seconds are dropped
+  TRIM = 3600
+
+  def __init__(self, fetch, size, settle, shared=None):
+    self.fetch = fetch
+    self.size = size
+    self.settle = settle
+    # Other processes record points as well and count the ones which are
+    # late in shared, see invalidate()
+    self.shared = shared
+    self.late = 0 if shared is None else shared.get('late')
+    # Entries by key, least recently used first
+    self.entries = collections.OrderedDict()
+    # Keys of the entries each source id is part of
+    self.sources = {}
+    self.rows = 0
+    # Bumped on every invalidation, results fetched meanwhile aren't kept
+    self.epoch = 0
+    self.hits = 0
+    self.misses = 0
+    self.lock = threading.Lock()
+
+  def stats(self):
+    with self.lock:
+      return {
+        'hits' : self.hits,
+        'misses' : self.misses,
+        'entries' : len(self.entries),
+        'rows' : self.rows
+      }
+
+  def query(self, ids, ts_start, ts_end, count, groupby, mode, descending, percentile):
+    """
+    Same as Backend.query() for a grouped query with an absolute range,
+    returns None if no bucket of it can be cached
+    """
+    settled = int(time.time()) - self.settle
+    settled -= settled % groupby
+    if ts_start is None:
+      return None
+    low = ts_start + (-ts_start % groupby)
+    high = settled
+    if ts_end is not None:
+      high = min(high, ts_end + 1 - (ts_end + 1) % groupby)
+    if low >= high:
+      return None
+
+    key = (tuple(sorted(ids)), groupby, mode, percentile)
+    with self.lock:
+      self._check()
+      entry = self.entries.get(key, None)
+      if entry is not None and entry.low <= low:
+        self.hits += 1
+        self.entries[key] = self.entries.pop(key)
+        entry.asked = min(entry.asked, low)
+        cached = entry.rows[bisect.bisect_left(entry.starts, low):bisect.bisect_left(entry.starts, high)]
+        start = entry.high
+      else:
+        self.misses += 1
+        entry = Entry(ids, groupby, low)
+        cached = []
+        start = low
+      epoch = self.epoch
+
+    if start < high:
+      try:
+        fetched = list(Stream.rows(self.fetch(ids, start, high - 1, 0, groupby, mode, False, percentile)))
+      except RuntimeError as e:
+        logging.error('Failed to query data: ' + repr(e))
+        return Backend.Iterator('Error performing query')
+      # The entry may end before the range starts
+      cached += fetched[bisect.bisect_left([row['ts'] for row in fetched], low):]
+      with self.lock:
+        if self.epoch == epoch:
+          self._store(key, entry, fetched, start, high)
+
+    parts = []
+    if ts_start < low:
+      parts.append((ts_start, low - 1))
+    parts.append(cached[::-1] if descending else cached)
+    if ts_end is None or high <= ts_end:
+      parts.append((high, ts_end))
+    if descending:
+      parts.reverse()
+    result = self._chain(parts, ids, count, groupby, mode, descending, percentile)
+    if count > 0:
+      result = Stream.limit(result, int(count))
+    return Stream.StreamIterator(result)
+
+  def _chain(self, parts, ids, count, groupby, mode, descending, percentile):
+    """
+    Yields the rows of each part, which is either a list of cached rows or
+    a range to fetch
+    """
+    for part in parts:
+      if isinstance(part, list):
+        for row in part:
+          yield row
+      else:
+        for row in Stream.rows(self.fetch(ids, part[0], part[1], count, groupby, mode, descending, percentile)):
+          yield row
+
+  def _store(self, key, entry, rows, start, high):
+    """
+    Adds rows from start up to high to entry. Caller must hold the lock.
+    """
+    if entry.high != start:
+      # Another thread got there first
+      return
+    if self.entries.get(key, None) is not entry:
+      # New, replacing an older one or dropped to make room meanwhile
+      self._drop(key)
+      self.entries[key] = entry
+      self.rows += len(entry.rows)
+      for id in entry.ids:
+        self.sources.setdefault(id, set()).add(key)
+    entry.rows.extend(rows)
+    entry.starts.extend([row['ts'] for row in rows])
+    entry.high = high
+    self.rows += len(rows)
+
+    if time.time() - entry.trimmed > self.TRIM:
+      self._truncate(entry, entry.asked, True)
+      entry.asked = entry.high
+      entry.trimmed = time.time()
+    while self.rows > self.size and self.entries:
+      self._drop(next(iter(self.entries)))
+
+  def _drop(self, key):
+    entry = self.entries.pop(key, None)
+    if entry is None:
+      return
+    self.rows -= len(entry.rows)
+    for id in entry.ids:
+      keys = self.sources.get(id, None)
+      if keys is not None:
+        keys.discard(key)
+        if not keys:
+          del self.sources[id]
+
+  def _truncate(self, entry, ts, head=False):
+    """
+    Drops the rows of entry from bucket ts on, or before it if head is
+    True. Caller must hold the lock.
+    """
+    i = bisect.bisect_left(entry.starts, ts)
+    if head:
+      self.rows -= i
+      del entry.rows[:i]
+      del entry.starts[:i]
+      entry.low = max(entry.low, ts)
+    else:
+      self.rows -= len(entry.rows) - i
+      del entry.rows[i:]
+      del entry.starts[i:]
+      entry.high = min(entry.high, ts)
+
+  def _check(self):
+    """
+    Drops everything if another process recorded late points. Caller must
+    hold the lock.
+    """
+    if self.shared is None:
+      return
+    late = self.shared.get('late')
+    if late != self.late:
+      self.late = late
+      for key in self.entries.keys():
+        self._drop(key)
+
+  def invalidate(self, points):
+    """
+    Called with the (source id, value, ts) of points once they are stored.
+    Cached buckets they fall in are dropped, along with the ones after.
+    """
+    cutoff = int(time.time()) - self.settle
+    late = [(id, ts) for id, value, ts in points if ts < cutoff]
+    if not late:
+      return
+    with self.lock:
+      self.epoch += 1
+      for id, ts in late:
+        for key in list(self.sources.get(id, ())):
+          entry = self.entries[key]
+          if ts >= entry.high:
+            continue
+          if ts < entry.low + entry.groupby:
+            self._drop(key)
+          else:
+            self._truncate(entry, ts - ts % entry.groupby)
+      if self.shared is not None:
+        late = self.shared.increment('late')
+        if late == self.late + 1:
+          self.late = late
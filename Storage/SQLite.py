@@ -0,0 +1,387 @@
+import time
+import threading
+import logging
+import Storage
+import Backend
+import Stream
+import Aggregate
+
+import sqlite3
+
+def rowdict(cursor, row):
+  result = {}
+  for i, column in enumerate(cursor.description):
+    result[column[0]] = row[i]
+  return result
+
+class SQLite(Backend.Backend):
+  """
+  Embedded backend keeping everything in a single SQLite file, for small
+  installs (or tests) which shouldn't need a database server. The file is
+  used in WAL mode, so queries don't block writes and commits are cheap.
+  """
+  # Version of the tables created by setup()
+  SCHEMA_VERSION = 1
+
+  def __init__(self):
+    Backend.Backend.__init__(self)
+    # Modes SQLite can group by itself, see MariaDB
+    self.GROUP_METHOD = {
+      Storage.GROUP_BY_SUM : 'SUM',
+      Storage.GROUP_BY_AVERAGE : 'AVG',
+      Storage.GROUP_BY_MIN : 'MIN',
+      Storage.GROUP_BY_MAX : 'MAX',
+      Storage.GROUP_BY_COUNT : 'COUNT'
+    }
+    self.filename = None
+    self.local = threading.local()
+    self.connections = []
+
+  def connect(self, user, pw, host, database):
+    """
+    Only database is used, it's the name of the file to store data in
+    """
+    if database is None:
+      logging.error('SQLite needs the name of the file to use as database')
+      return False
+    self.filename = database
+    return self._connection() is not None
+
+  def _open(self):
+    cnx = sqlite3.connect(self.filename, timeout=30, check_same_thread=False)
+    cnx.row_factory = rowdict
+    cnx.execute('PRAGMA journal_mode=WAL')
+    cnx.execute('PRAGMA synchronous=NORMAL')
+    return cnx
+
+  def _connection(self):
+    """
+    Returns the connection used by the calling thread, SQLite connections
+    can't be used by more than one thread at a time.
+    """
+    cnx = getattr(self.local, 'cnx', None)
+    if cnx is None:
+      try:
+        cnx = self._open()
+      except sqlite3.Error as err:
+        logging.error('Unable to open %s: %s' % (self.filename, repr(err)))
+        return None
+      self.local.cnx = cnx
+      with self.lock:
+        self.connections.append(cnx)
+    return cnx
+
+  def forked(self):
+    # The parent's connections are simply forgotten, closing them here
+    # could upset its locks
+    with self.lock:
+      self.local = threading.local()
+      self.connections = []
+
+  def disconnect(self):
+    Backend.Backend.disconnect(self)
+    with self.lock:
+      for cnx in self.connections:
+        cnx.close()
+      self.connections = []
+
+  def validate(self):
+    cnx = self._connection()
+    if cnx is None:
+      return Storage.VALIDATION_ERROR
+    try:
+      tables = []
+      for row in cnx.execute("SELECT name FROM sqlite_master WHERE type = 'table'"):
+        tables.append(row['name'])
+      for table in [ 'meta', 'sources', 'data', 'types' ]:
+        if table not in tables:
+          return Storage.VALIDATION_NOT_SETUP
+      row = cnx.execute("SELECT value FROM meta WHERE name = 'schema'").fetchone()
+    except sqlite3.Error as err:
+      logging.error(err)
+      return Storage.VALIDATION_ERROR
+    if row is None or int(row['value']) < self.SCHEMA_VERSION:
+      return Storage.VALIDATION_NEED_UPGRADE
+    return Storage.VALIDATION_OK
+
+  def setup(self, force, partition=False):
+    if partition:
+      logging.warning('SQLite does not support partitioning, ignoring')
+    cnx = self._connection()
+    if cnx is None:
+      return False
+
+    if force:
+      for table in [ 'sources', 'data', 'types', 'meta' ]:
+        query = 'DROP TABLE IF EXISTS ' + table
+        logging.info(query)
+        cnx.execute(query)
+      cnx.commit()
+
+    if self.validate() != Storage.VALIDATION_NOT_SETUP:
+      logging.error('Database is not in a state where it can be setup')
+      return False
+
+    sql = [
+      'CREATE TABLE meta (name varchar(64) primary key, value varchar(255) not null)',
+      "INSERT INTO meta (name, value) VALUES ('schema', '%d')" % self.SCHEMA_VERSION,
+      'CREATE TABLE sources (id integer primary key autoincrement, sid varchar(64) not null unique, name varchar(128) not null, uuid varchar(64) not null unique, type int not null, accuracy int not null, parameters text not null)',
+      'CREATE TABLE data (source integer not null, ts integer not null, value integer not null, PRIMARY KEY (source, ts)) WITHOUT ROWID',
+      'CREATE TABLE types (id integer primary key autoincrement, uuid varchar(64) not null unique, name varchar(128) not null, description text not null)'
+    ]
+    try:
+      for s in sql:
+        cnx.execute(s)
+      cnx.commit()
+    except sqlite3.Error as err:
+      cnx.rollback()
+      logging.error('Failed to execute: ' + s)
+      logging.error(err)
+      return False
+    return True
+
+  def prepare(self):
+    cnx = self._connection()
+    if cnx is None:
+      return False
+
+    # Restored latest values save finding the newest point of every source
+    restoring = self._restoring()
+    if restoring:
+      query = 'SELECT id, uuid, sid, name, type, accuracy, parameters, NULL AS ts, NULL AS value FROM sources'
+    else:
+      query = ('SELECT id, uuid, sid, name, type, accuracy, parameters, data.ts AS ts, data.value AS value '
+               'FROM sources '
+               'LEFT JOIN (SELECT source, MAX(ts) AS ts FROM data GROUP BY source) AS newest ON newest.source = sources.id '
+               'LEFT JOIN data ON data.source = newest.source AND data.ts = newest.ts')
+    start = time.time()
+    try:
+      for row in cnx.execute(query):
+        ts = row.pop('ts')
+        value = row.pop('value')
+        row['latest'] = None
+        if ts is not None:
+          row['latest'] = {
+            'value' : value,
+            'ts' : ts
+          }
+        with self.lock:
+          self._add_source(row)
+      if restoring and not self._restore():
+        return self.prepare()
+      self._publish()
+      logging.info('Loaded %d sources in %.2fs' % (len(self.cache), time.time() - start))
+
+      for row in cnx.execute('SELECT id, uuid, name, description FROM types'):
+        with self.lock:
+          self._add_type(row)
+      return True
+    except sqlite3.Error as err:
+      logging.error('Failed to prepare cache: ' + repr(err))
+    return False
+
+  def _reload(self):
+    cnx = self._connection()
+    if cnx is None:
+      return False
+    try:
+      for row in cnx.execute('SELECT id, uuid, sid, name, type, accuracy, parameters FROM sources'):
+        row['latest'] = None
+        with self.lock:
+          if row['uuid'] not in self.cache:
+            self._add_source(row)
+      for row in cnx.execute('SELECT id, uuid, name, description FROM types'):
+        with self.lock:
+          if row['uuid'] not in self._types:
+            self._add_type(row)
+      return True
+    except sqlite3.Error as err:
+      logging.error('Failed to reload sources: ' + repr(err))
+    return False
+
+  def _flush(self, points):
+    cnx = self._connection()
+    if cnx is None:
+      return False
+    try:
+      cnx.executemany('INSERT OR REPLACE INTO data (source, value, ts) VALUES (?, ?, ?)', points)
+      cnx.commit()
+      return True
+    except sqlite3.Error as err:
+      cnx.rollback()
+      logging.error('Failed to flush %d data points: %s' % (len(points), repr(err)))
+    return False
+
+  def add_type(self, uuid, name, description):
+    cnx = self._connection()
+    if cnx is None:
+      return False
+    try:
+      cursor = cnx.execute('INSERT INTO types (uuid, name, description) VALUES (?, ?, ?)', (uuid, name, description))
+      cnx.commit()
+      with self.lock:
+        self._add_type({
+          'id' : cursor.lastrowid,
+          'uuid' : uuid,
+          'name' : name,
+          'description' : description
+        })
+      self._changed()
+      return True
+    except sqlite3.Error as err:
+      cnx.rollback()
+      logging.error('Failed to add type: ' + repr(err))
+    return False
+
+  def add_source(self, uuid, sid, name, type, accuracy = 1, parameters = ''):
+    self._refresh()
+    with self.lock:
+      if type not in self._types:
+        return False
+      typeid = self._types[type]['id']
+
+    cnx = self._connection()
+    if cnx is None:
+      return False
+    try:
+      cursor = cnx.execute('INSERT INTO sources (uuid, sid, name, type, accuracy, parameters) VALUES (?, ?, ?, ?, ?, ?)', (uuid, sid, name, typeid, accuracy, parameters))
+      cnx.commit()
+      with self.lock:
+        self._add_source({
+          'id' : cursor.lastrowid,
+          'uuid' : uuid,
+          'sid' : sid,
+          'name' : name,
+          'type' : typeid,
+          'accuracy' : accuracy,
+          'parameters' : parameters,
+          'latest' : None
+        })
+      self._changed()
+      return True
+    except sqlite3.Error as err:
+      cnx.rollback()
+      logging.error('Failed to add source: ' + repr(err))
+    return False
+
+  def record(self, uuid, value, ts = None, sync = False):
+    if ts is None:
+      ts = int(round(time.time()))
+    if ts < 1:
+      logging.warn('Cannot have timestamps less than 1, typically indicate issue :)')
+      return False
+    self._refresh()
+    source = self.cache.get(uuid, None)
+    if source is None:
+      logging.warn('UUID %s does not exist' % uuid)
+      return False
+    value = self._value(value)
+    if value is None:
+      logging.warn('Value of %s is out of range' % uuid)
+      return False
+
+    if self.buffer is not None:
+      self._update_latest(uuid, value, ts)
+      self._recorded([(uuid, value, ts)])
+      return self.buffer.put((source['id'], value, ts), sync)
+
+    if not self._flush([(source['id'], value, ts)]):
+      return False
+    self._update_latest(uuid, value, ts)
+    self._recorded([(uuid, value, ts)])
+    return True
+
+  def query(self, uuids, ts_start = None, ts_end = None, count = 0, groupby = 0, mode = Storage.GROUP_BY_NONE, descending=False, percentile=50):
+    self._refresh()
+    ids = []
+    for u in uuids:
+      if u in self.cache:
+        ids.append(self.cache[u]['id'])
+    if not ids:
+      return Iterator(None)
+
+    now = int(time.time())
+    if ts_start is not None and ts_start < 0:
+      ts_start = now + ts_start
+    if ts_end is not None and ts_end < 0:
+      ts_end = now + ts_end
+
+    grouped = mode != Storage.GROUP_BY_NONE and groupby > 0
+    if grouped and mode not in Aggregate.MODES:
+      logging.error('This database doesn\'t support desired grouping method')
+      return None
+    if grouped and mode not in self.GROUP_METHOD:
+      result = Stream.group(Stream.rows(self.query(uuids, ts_start, ts_end, 0, 0, Storage.GROUP_BY_NONE, descending)), int(groupby), mode, percentile)
+      if count > 0:
+        result = Stream.limit(result, int(count))
+      return Stream.StreamIterator(result)
+
+    params = []
+    if grouped:
+      # Integer division, so this is the start of the bucket
+      bucket = '(data.ts / ?) * ?'
+      query = 'SELECT uuid, %s(value) AS value, %s AS ts ' % (self.GROUP_METHOD[mode], bucket)
+      params.extend([int(groupby), int(groupby)])
+    else:
+      query = 'SELECT uuid, value, data.ts AS ts '
+
+    query += 'FROM data JOIN sources ON data.source = sources.id WHERE data.source IN (%s) ' % ', '.join(['?'] * len(ids))
+    params.extend(ids)
+
+    if ts_start is not None:
+      query += 'AND data.ts >= ? '
+      params.append(ts_start)
+    if ts_end is not None:
+      query += 'AND data.ts <= ? '
+      params.append(ts_end)
+
+    if grouped:
+      query += 'GROUP BY data.source, %s ORDER BY ts ' % bucket
+      params.extend([int(groupby), int(groupby)])
+    else:
+      query += 'ORDER BY data.ts '
+    if descending:
+      query += 'DESC '
+    if count > 0:
+      query += 'LIMIT ?'
+      params.append(int(count))
+    logging.debug('Query statement: ' + query + ' ' + repr(params))
+
+    # Each query gets a connection of its own, since the rows are read
+    # lazily and possibly from another thread
+    try:
+      cnx = self._open()
+    except sqlite3.Error as err:
+      logging.error('Unable to open %s: %s' % (self.filename, repr(err)))
+      return Iterator(None, 'Error performing query')
+    try:
+      return Iterator(cnx.execute(query, params), None, cnx)
+    except sqlite3.Error as err:
+      logging.error('Failed to query data: ' + repr(err))
+    cnx.close()
+    return Iterator(None, 'Error performing query')
+
+class Iterator(Backend.Iterator):
+  def __init__(self, cursor, error=None, connection=None):
+    Backend.Iterator.__init__(self, error)
+    self.cursor = cursor
+    self.cnx = connection
+
+  def next(self):
+    if self.error is not None or self.cursor is None:
+      return None
+    try:
+      return self.cursor.fetchone()
+    except sqlite3.Error as err:
+      logging.error('Failed to read result: ' + repr(err))
+      self.error = 'Error reading result'
+    return None
+
+  def release(self):
+    if self.cursor is None:
+      return
+    Backend.Iterator.release(self)
+    self.cursor.close()
+    self.cnx.close()
+    self.cursor = None
+    self.cnx = None
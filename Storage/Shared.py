@@ -0,0 +1,252 @@
+import os
+import time
+import mmap
+import fcntl
+import struct
+import logging
+import tempfile
+import threading
+
+# Start of the mapping: magic, version of the layout and number of slots.
+# The counters (see Shared.FIELDS) follow and the slots start at
+# HEADER_SIZE.
+HEADER = struct.Struct('<4sII')
+HEADER_SIZE = 64
+MAGIC = 'DPLV'
+VERSION = 1
+# One counter of the header
+COUNTER = struct.Struct('<q')
+# Latest value of a source: sequence number (odd while the slot is being
+# written), 1 if there is a value, timestamp, value and uuid of the
+# source (NUL padded)
+SLOT = struct.Struct('<Iidd40s')
+SEQUENCE = struct.Struct('<I')
+
+def number(x):
+  """
+  Slots hold doubles, whole numbers are handed back as int
+  """
+  if x.is_integer():
+    return int(x)
+  return x
+
+class Locked:
+  """
+  Holds the lock of the shared memory for a with block. Between processes
+  it's a lock of the file fd, which the kernel releases when the process
+  holding it dies, while the threads of a process take lock first.
+  """
+  def __init__(self, fd, lock):
+    self.fd = fd
+    self.lock = lock
+
+  def __enter__(self):
+    self.lock.acquire()
+    try:
+      fcntl.lockf(self.fd, fcntl.LOCK_EX)
+    except:
+      self.lock.release()
+      raise
+
+  def __exit__(self, kind, value, trace):
+    try:
+      fcntl.lockf(self.fd, fcntl.LOCK_UN)
+    finally:
+      self.lock.release()
+
+class Shared:
+  """
+  Memory holding the latest value of each source, in the slot given by
+  the id of the source, along with a few counters (see FIELDS).
+
+  When the server runs more than one process (see --workers) it is
+  mapped before forking, so every process sees the same pages. With a
+  filename the memory is a file instead (see --latest-file), which other
+  processes on the machine can map and read, and which is taken over by
+  the next run if this one shut down cleanly (see close()).
+
+  Writers take a lock, readers don't. Instead they read a slot again if
+  its sequence number was odd or changed while reading it.
+
+  A worker may die while writing, see --workers. The lock is released
+  along with it, and a slot it was writing reads as having no value
+  until the slot is written again or recover() is called.
+  """
+  # generation is bumped when a source or type is registered, watermark
+  # is where rollups are complete up to, compacted is 1 once there are
+  # compressed chunks, clean is 1 once the values are complete and late
+  # is bumped when points are recorded for buckets of cached query
+  # results (see QueryCache)
+  FIELDS = ['generation', 'watermark', 'compacted', 'clean', 'late']
+  # Writes take microseconds, readers waiting this long on a slot wait
+  # for the lock instead, to tell a slow writer from one which died
+  READ_TIMEOUT = 0.05
+
+  def __init__(self, filename=None, slots=65536):
+    self.slots = slots
+    self.size = HEADER_SIZE + SLOT.size * slots
+    self.lock = threading.Lock()
+    self.warned = False
+    # True if the values are those of the last run
+    self.restored = False
+    if filename is None:
+      # Only there to be locked, see Locked
+      self.fd, path = tempfile.mkstemp(prefix='datapoints')
+      os.unlink(path)
+      self.map = mmap.mmap(-1, self.size)
+      self._initialise()
+      return
+
+    # Kept open to be locked, see Locked
+    self.fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0644)
+    try:
+      if os.fstat(self.fd).st_size != self.size:
+        os.ftruncate(self.fd, self.size)
+      self.map = mmap.mmap(self.fd, self.size)
+    except:
+      os.close(self.fd)
+      raise
+    if HEADER.unpack_from(self.map, 0) != (MAGIC, VERSION, slots):
+      logging.info('Initialising %s' % filename)
+      self._initialise()
+    elif self.get('clean') == 1:
+      self._repair()
+      self.restored = True
+    else:
+      logging.warning('%s was not closed cleanly, latest values are read from storage' % filename)
+      self.clear()
+    # Until close(), the values may be ahead of what is stored
+    for name in ['clean', 'watermark', 'compacted']:
+      self.set(name, 0)
+    self.map.flush()
+
+  def _initialise(self):
+    self.map[:] = '\0' * self.size
+    HEADER.pack_into(self.map, 0, MAGIC, VERSION, self.slots)
+
+  def _repair(self):
+    """
+    Evens out the sequence numbers of slots which were being written
+    when a process died, readers would wait on them forever
+    """
+    for id in range(self.slots):
+      offset = HEADER_SIZE + id * SLOT.size
+      sequence = SEQUENCE.unpack_from(self.map, offset)[0]
+      if sequence % 2:
+        SEQUENCE.pack_into(self.map, offset, sequence + 1)
+
+  def _locked(self):
+    return Locked(self.fd, self.lock)
+
+  def recover(self):
+    """
+    Called once a process using the memory has died, evens out the slots
+    it may have been writing. Writers hold the lock, so any slot which is
+    odd meanwhile is one of those.
+    """
+    with self._locked():
+      self._repair()
+
+  def clear(self):
+    """
+    Forgets all latest values
+    """
+    with self._locked():
+      self.map[HEADER_SIZE:] = '\0' * (self.size - HEADER_SIZE)
+      self.restored = False
+
+  def close(self):
+    """
+    Marks the values as complete, so the next run can take them over.
+    Must only be called once nothing is recorded anymore.
+    """
+    self.set('clean', 1)
+    self.map.flush()
+    self.map.close()
+    os.close(self.fd)
+
+  def get(self, name):
+    return COUNTER.unpack_from(self.map, HEADER.size + self.FIELDS.index(name) * COUNTER.size)[0]
+
+  def set(self, name, value):
+    with self._locked():
+      COUNTER.pack_into(self.map, HEADER.size + self.FIELDS.index(name) * COUNTER.size, value)
+
+  def increment(self, name):
+    offset = HEADER.size + self.FIELDS.index(name) * COUNTER.size
+    with self._locked():
+      value = COUNTER.unpack_from(self.map, offset)[0] + 1
+      COUNTER.pack_into(self.map, offset, value)
+    return value
+
+  def fits(self, id):
+    """
+    Returns True if there is a slot for source id
+    """
+    if 0 <= id < self.slots:
+      return True
+    if not self.warned:
+      self.warned = True
+      logging.warning('Source id %d is beyond the %d shared slots, its latest value is only kept by the process recording it' % (id, self.slots))
+    return False
+
+  def _read(self, id):
+    """
+    Returns the fields of slot id, None if it was left being written by a
+    process which died
+    """
+    offset = HEADER_SIZE + id * SLOT.size
+    deadline = None
+    while True:
+      for i in range(100):
+        slot = SLOT.unpack_from(self.map, offset)
+        if slot[0] % 2 == 0 and SEQUENCE.unpack_from(self.map, offset)[0] == slot[0]:
+          return slot
+      if deadline is None:
+        deadline = time.time() + self.READ_TIMEOUT
+      elif time.time() > deadline:
+        break
+    # Once the lock is had, nobody is writing
+    with self._locked():
+      slot = SLOT.unpack_from(self.map, offset)
+    if slot[0] % 2:
+      return None
+    return slot
+
+  def owner(self, id):
+    """
+    Returns the uuid of the source whose value is in slot id, '' if the
+    slot has never been written
+    """
+    slot = self._read(id)
+    if slot is None:
+      return ''
+    return slot[4].rstrip('\0')
+
+  def latest(self, id):
+    """
+    Returns the latest value of source id as a dict of value and ts, None
+    if it has none
+    """
+    slot = self._read(id)
+    if slot is None or not slot[1]:
+      return None
+    sequence, present, ts, value, uuid = slot
+    return {'value' : number(value), 'ts' : number(ts)}
+
+  def update(self, id, uuid, value, ts):
+    """
+    Stores value as the latest of source id, unless it already has a
+    newer one
+    """
+    offset = HEADER_SIZE + id * SLOT.size
+    with self._locked():
+      sequence, present, current, old, owner = SLOT.unpack_from(self.map, offset)
+      if present and current > ts:
+        return
+      if sequence % 2:
+        # Left odd by a process which died while writing it
+        sequence += 1
+      SEQUENCE.pack_into(self.map, offset, sequence + 1)
+      SLOT.pack_into(self.map, offset, sequence + 1, 1, float(ts), float(value), str(uuid))
+      SEQUENCE.pack_into(self.map, offset, sequence + 2)
@@ -0,0 +1,146 @@
+import heapq
+import logging
+import Backend
+import Aggregate
+
+"""
+Helpers for backends which produce query results in Python rather than
+having a database do it. Rows are dicts of uuid, ts and value, same as
+what an Iterator returns, and are produced lazily by generators.
+"""
+
+def bucket(ts, groupby):
+  """
+  Timestamp a point is grouped under, which is the start of the bucket
+  of groupby seconds holding it
+  """
+  return ts - ts % groupby
+
+def group(rows, groupby, mode, percentile=50):
+  """
+  Groups rows ordered by ts (in either direction, of any number of
+  sources) into buckets of groupby seconds, using the aggregate for mode
+  (see Aggregate). Only the bucket being filled is held for each source.
+  """
+  current = None
+  buckets = {}
+  try:
+    for row in rows:
+      b = bucket(row['ts'], groupby)
+      if b != current:
+        for uuid in sorted(buckets):
+          yield {'uuid' : uuid, 'value' : buckets[uuid].result(), 'ts' : current}
+        current = b
+        buckets = {}
+      aggregate = buckets.get(row['uuid'])
+      if aggregate is None:
+        aggregate = buckets[row['uuid']] = Aggregate.create(mode, percentile)
+      aggregate.add(row['ts'], row['value'])
+    for uuid in sorted(buckets):
+      yield {'uuid' : uuid, 'value' : buckets[uuid].result(), 'ts' : current}
+  finally:
+    rows.close()
+
+def rows(result):
+  """
+  Yields the rows of an Iterator, raises RuntimeError if reading it fails.
+  The Iterator is released when done.
+  """
+  try:
+    if result.getError() is not None:
+      raise RuntimeError(result.getError())
+    while True:
+      row = result.next()
+      if row is None:
+        break
+      yield row
+    if result.getError() is not None:
+      raise RuntimeError(result.getError())
+  finally:
+    result.release()
+
+def merge(streams, descending=False):
+  """
+  Merges streams of rows, each ordered by ts, into one stream ordered
+  by ts
+  """
+  heap = []
+  try:
+    for i, stream in enumerate(streams):
+      row = next(stream, None)
+      if row is not None:
+        heap.append((-row['ts'] if descending else row['ts'], i, row))
+    heapq.heapify(heap)
+    while heap:
+      key, i, row = heap[0]
+      yield row
+      row = next(streams[i], None)
+      if row is None:
+        heapq.heappop(heap)
+      else:
+        heapq.heapreplace(heap, (-row['ts'] if descending else row['ts'], i, row))
+  finally:
+    for stream in streams:
+      stream.close()
+
+def overlay(rows, newer, descending=False):
+  """
+  Merges two streams of rows for the same source, each ordered by ts.
+  Where both have a row with the same ts, the one from newer is used.
+  """
+  try:
+    a = next(rows, None)
+    b = next(newer, None)
+    while a is not None or b is not None:
+      if b is None or (a is not None and (a['ts'] > b['ts'] if descending else a['ts'] < b['ts'])):
+        yield a
+        a = next(rows, None)
+      else:
+        if a is not None and a['ts'] == b['ts']:
+          a = next(rows, None)
+        yield b
+        b = next(newer, None)
+  finally:
+    rows.close()
+    newer.close()
+
+def limit(rows, count):
+  """
+  Stops after count rows
+  """
+  try:
+    for row in rows:
+      if count <= 0:
+        break
+      count -= 1
+      yield row
+  finally:
+    rows.close()
+
+class StreamIterator(Backend.Iterator):
+  """
+  Iterator reading rows from a generator. Releasing it closes the
+  generator so any resources it holds are freed.
+  """
+  def __init__(self, rows, error=None):
+    Backend.Iterator.__init__(self, error)
+    self.rows = rows
+
+  def next(self):
+    if self.error is not None or self.rows is None:
+      return None
+    try:
+      return next(self.rows)
+    except StopIteration:
+      return None
+    except Exception as e:
+      logging.exception('Failed to read result')
+      self.error = 'Error reading result'
+    return None
+
+  def release(self):
+    if self.rows is None:
+      return
+    Backend.Iterator.release(self)
+    self.rows.close()
+    self.rows = None
@@ -0,0 +1,144 @@
+import time
+import threading
+import logging
+
+class Batch:
+  """
+  A group of data points which will be written in one go. Anyone who
+  needs to know when (and if) the points made it to storage can wait
+  on it.
+  """
+  def __init__(self):
+    self.points = []
+    self.created = None
+    self.result = None
+    self.event = threading.Event()
+
+  def add(self, points):
+    if self.created is None:
+      self.created = time.time()
+    self.points.extend(points)
+
+  def done(self, result):
+    self.result = result
+    self.event.set()
+
+  def wait(self):
+    self.event.wait()
+    return self.result
+
+class WriteBuffer:
+  """
+  Write-behind queue for data points. Points are collected in memory and
+  handed to the flush function as one batch when either size points are
+  pending or the oldest pending point has waited interval seconds.
+
+  The flush function receives a list of points and returns True if they
+  were stored successfully.
+  """
+  def __init__(self, flush, size=500, interval=1.0):
+    self.flush = flush
+    self.size = size
+    self.interval = interval
+    self.lock = threading.Condition()
+    self.batch = Batch()
+    self.forced = False
+    self.running = True
+    self.thread = threading.Thread(target=self._run, name='WriteBuffer')
+    self.thread.daemon = True
+    self.thread.start()
+
+  def put(self, point, sync=False):
+    """
+    Queues a point. If sync is True, the call blocks until the batch
+    holding the point has been flushed and returns the outcome of it.
+    Returns False if the buffer has been closed.
+    """
+    return self.put_many([point], sync)
+
+  def put_many(self, points, sync=False):
+    """
+    Queues a list of points, which all end up in the same batch. See put()
+    """
+    self.lock.acquire()
+    try:
+      if not self.running:
+        return False
+      batch = self.batch
+      batch.add(points)
+      if sync:
+        self.forced = True
+      if sync or len(batch.points) >= self.size:
+        self.lock.notify()
+    finally:
+      self.lock.release()
+
+    if sync:
+      return batch.wait()
+    return True
+
+  def sync(self):
+    """
+    Flushes anything pending and waits for it to be written
+    """
+    self.lock.acquire()
+    try:
+      batch = self.batch
+      if not batch.points:
+        return True
+      self.forced = True
+      self.lock.notify()
+    finally:
+      self.lock.release()
+    return batch.wait()
+
+  def pending(self):
+    return len(self.batch.points)
+
+  def close(self):
+    """
+    Stops accepting new points and drains the queue before returning
+    """
+    self.lock.acquire()
+    try:
+      self.running = False
+      self.lock.notify()
+    finally:
+      self.lock.release()
+    self.thread.join()
+
+  def _due(self):
+    if not self.batch.points:
+      return False
+    if self.forced or len(self.batch.points) >= self.size:
+      return True
+    return time.time() - self.batch.created >= self.interval
+
+  def _run(self):
+    while True:
+      self.lock.acquire()
+      try:
+        while self.running and not self._due():
+          timeout = None
+          if self.batch.points:
+            timeout = max(0, self.batch.created + self.interval - time.time())
+          self.lock.wait(timeout)
+        batch = self.batch
+        self.batch = Batch()
+        self.forced = False
+        running = self.running
+      finally:
+        self.lock.release()
+
+      if batch.points:
+        try:
+          result = self.flush(batch.points)
+        except Exception:
+          logging.exception('Failed to flush %d data points' % len(batch.points))
+          result = False
+        batch.done(result)
+      else:
+        batch.done(True)
+
+      if not running:
+        break
@@ -7,6 +7,24 @@ GROUP_BY_NONE = 0
 GROUP_BY_SUM = 1
 GROUP_BY_AVERAGE = 2
 GROUP_BY_MEDIAN = 3
+GROUP_BY_MIN = 4
+GROUP_BY_MAX = 5
+GROUP_BY_COUNT = 6
+GROUP_BY_FIRST = 7
+GROUP_BY_LAST = 8
+GROUP_BY_STDDEV = 9
+GROUP_BY_PERCENTILE = 10
 
-from MariaDB import MariaDB
+from Backend import Backend, Iterator
+from SQLite import SQLite
+from Columnar import Columnar
+from Shared import Shared
+from Metrics import Metrics
+import Downsample
+
+try:
+  from MariaDB import MariaDB
+except ImportError:
+  # Only needed when storing data in MariaDB/mySQL
+  MariaDB = None
 
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""
+Measures how well the chunk compression in Storage/Compression.py does on
+generated sensor data, and how fast it decodes.
+
+A day of points is generated for a source reporting at a fixed interval,
+with some jitter in the timestamps and a value drifting slowly. The size
+is compared against the 12 bytes a point takes in the columnar backend.
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Storage'))
+import Compression
+
+parser = argparse.ArgumentParser(description="Benchmark compression of data points", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--interval', default=10, type=int, help='Seconds between points')
+parser.add_argument('--jitter', default=0.05, type=float, help='Share of points arriving a few seconds off')
+parser.add_argument('--drift', default=2, type=int, help='Largest change in value between points')
+parser.add_argument('--runs', default=5, type=int, help='Times to decode, the best run is reported')
+cmdline = parser.parse_args()
+
+points = []
+ts = int(time.time())
+value = random.randint(-1000, 1000)
+for i in range(86400 // cmdline.interval):
+  ts += cmdline.interval
+  if random.random() < cmdline.jitter:
+    ts += random.randint(-3, 3)
+  value += random.randint(-cmdline.drift, cmdline.drift)
+  points.append((ts, value))
+
+began = time.time()
+data = Compression.encode(points)
+encoded = time.time() - began
+
+decoded = None
+for run in range(cmdline.runs):
+  began = time.time()
+  result = list(Compression.decode(data))
+  took = time.time() - began
+  if decoded is None or took < decoded:
+    decoded = took
+if result != points:
+  print('Decoded points differ from the original!')
+
+print('%d points, %d bytes compressed (%.2f bytes per point, %.1fx smaller than 12 bytes)' % (len(points), len(data), float(len(data)) / len(points), 12.0 * len(points) / len(data)))
+print('Encoded in %.1fms, decoded in %.1fms (%.0f points/s)' % (encoded * 1000, decoded * 1000, len(points) / max(decoded, 0.000001)))
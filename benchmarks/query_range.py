@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+Compares range queries written the way MariaDB.query() used to build them,
+with UNIX_TIMESTAMP() wrapped around the ts column, against the sargable
+form it builds now.
+
+A scratch copy of the sources and data tables is seeded with one point per
+interval for a number of sources, then the same queries are timed in both
+forms. The scratch tables are dropped afterwards.
+"""
+from __future__ import print_function
+import time
+import random
+import argparse
+
+import mysql.connector
+
+parser = argparse.ArgumentParser(description="Benchmark range queries against a seeded table", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--database', metavar='DATABASE', help='Which database to use')
+parser.add_argument('--dbserver', metavar="SERVER", help='Server running mySQL or MariaDB')
+parser.add_argument('--dbuser', metavar='USER', help='Username for server access')
+parser.add_argument('--dbpassword', metavar='PASSWORD', help='Password for server access')
+parser.add_argument('--sources', default=20, type=int, help='Number of sources to seed')
+parser.add_argument('--days', default=30, type=int, help='Days of data to seed per source')
+parser.add_argument('--interval', default=60, type=int, help='Seconds between seeded points')
+parser.add_argument('--runs', default=5, type=int, help='Times to run each query, the best run is reported')
+cmdline = parser.parse_args()
+
+cnx = mysql.connector.connect(user=cmdline.dbuser, password=cmdline.dbpassword, host=cmdline.dbserver, database=cmdline.database)
+cursor = cnx.cursor()
+
+def seed(now):
+  cursor.execute('DROP TABLE IF EXISTS bench_data')
+  cursor.execute('DROP TABLE IF EXISTS bench_sources')
+  cursor.execute('CREATE TABLE bench_sources (id int primary key, uuid varchar(64) not null unique)')
+  cursor.execute('CREATE TABLE bench_data (source int not null, ts datetime not null, value int not null, PRIMARY KEY (source, ts))')
+  for source in range(1, cmdline.sources + 1):
+    cursor.execute('INSERT INTO bench_sources (id, uuid) VALUES (%s, %s)', (source, 'source-%d' % source))
+    rows = []
+    for ts in range(now - cmdline.days * 86400, now, cmdline.interval):
+      rows.extend([source, ts, random.randint(-100, 100)])
+      if len(rows) >= 3000:
+        cursor.execute('INSERT INTO bench_data (source, ts, value) VALUES ' + ','.join(['(%s, FROM_UNIXTIME(%s), %s)'] * (len(rows) // 3)), rows)
+        rows = []
+    if rows:
+      cursor.execute('INSERT INTO bench_data (source, ts, value) VALUES ' + ','.join(['(%s, FROM_UNIXTIME(%s), %s)'] * (len(rows) // 3)), rows)
+    cnx.commit()
+  cursor.execute('ANALYZE TABLE bench_data')
+  cursor.fetchall()
+
+def old_query(ids, start, end):
+  query = 'SELECT uuid, value, UNIX_TIMESTAMP(ts) AS ts FROM bench_data LEFT JOIN bench_sources ON bench_data.source = bench_sources.id WHERE id IN (%s) ' % ','.join([str(i) for i in ids])
+  query += 'AND UNIX_TIMESTAMP(ts) >= %d AND UNIX_TIMESTAMP(ts) <= %d ORDER BY ts' % (start, end)
+  return query, None
+
+def new_query(ids, start, end):
+  query = 'SELECT uuid, value, UNIX_TIMESTAMP(bench_data.ts) AS ts FROM bench_data JOIN bench_sources ON bench_data.source = bench_sources.id WHERE bench_data.source IN (%s) ' % ', '.join(['%s'] * len(ids))
+  query += 'AND bench_data.ts >= FROM_UNIXTIME(%s) AND bench_data.ts <= FROM_UNIXTIME(%s) ORDER BY bench_data.ts'
+  return query, ids + [start, end]
+
+def best(builder, ids, start, end):
+  query, params = builder(ids, start, end)
+  result = None
+  rows = 0
+  for run in range(cmdline.runs):
+    began = time.time()
+    cursor.execute(query, params)
+    rows = len(cursor.fetchall())
+    took = time.time() - began
+    if result is None or took < result:
+      result = took
+  return result, rows
+
+now = int(time.time())
+print('Seeding %d sources with %d days of data every %ds...' % (cmdline.sources, cmdline.days, cmdline.interval))
+seed(now)
+
+cases = [
+  ('1 source, last hour', [1], now - 3600, now),
+  ('1 source, last day', [1], now - 86400, now),
+  ('5 sources, last hour', [1, 2, 3, 4, 5], now - 3600, now),
+  ('5 sources, last day', [1, 2, 3, 4, 5], now - 86400, now),
+  ('1 source, one hour a week ago', [1], now - 7 * 86400, now - 7 * 86400 + 3600),
+]
+
+print('%-32s %8s %10s %10s %8s' % ('Query', 'Rows', 'Before ms', 'After ms', 'Speedup'))
+try:
+  for name, ids, start, end in cases:
+    before, rows = best(old_query, ids, start, end)
+    after, rows2 = best(new_query, ids, start, end)
+    if rows != rows2:
+      print('%s: row count differs (%d != %d)' % (name, rows, rows2))
+    print('%-32s %8d %10.1f %10.1f %7.1fx' % (name, rows, before * 1000, after * 1000, before / max(after, 0.000001)))
+finally:
+  cursor.execute('DROP TABLE IF EXISTS bench_data')
+  cursor.execute('DROP TABLE IF EXISTS bench_sources')
+  cursor.close()
+  cnx.close()
@@ -7,17 +7,30 @@ import sys
 import re
 import urllib2, urllib
 import time
+import json
+import select
+import numbers
+from spool import spool
 
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 class client:
-  def __init__(self, atomic=True, server="localhost", port=8088):
+  def __init__(self, atomic=True, server="localhost", port=8088, window=1, batch=100,
+               spool_file=None, spool_size=16*1024*1024, drop="oldest"):
     """Setup the class
     atomic If true, any recorded value must be acked and cannot be sent later (default)
-    If you set atomic to false, it will cache entries until they can be sent (not yet implemented)
+    If you set atomic to false, it will cache entries until they can be sent
     server By default localhost
     port By default 8088
+    window How many messages may be sent before their results have come back. With 1
+    (default) record() waits for the result of each value, with more it returns as soon as
+    the value is queued and the results are collected as they arrive, see flush(). Values
+    recorded while the window is full are sent together in the next message
+    batch Most values sent in one message
+    spool_file With atomic set to false, values waiting to be sent are kept in this file
+    rather than in memory, so they survive a restart. At most spool_size bytes of them are
+    kept, after which the oldest (default) or newest values are dropped, see drop
     """
     self.tokens = []
     self.counter = 0
@@ -26,6 +39,20 @@ class client:
     self.port = port
     self.queue = []
     self.atomic = atomic
+    self.window = max(1, window)
+    self.batch = max(1, batch)
+    # Values waiting to be sent, those sent but not acked yet by id and the
+    # number of values not acked yet of each message sent, by its first id
+    self.pending = []
+    self.inflight = {}
+    self.messages = {}
+    # Set when a value failed, until the next flush()
+    self.failed = False
+    # Offset in the spool of each value sent from it, by id
+    self.spool = None
+    self.spooled = {}
+    if spool_file is not None and not atomic:
+      self.spool = spool(spool_file, spool_size, drop)
 
     try:
       import websocket
@@ -125,67 +152,178 @@ class client:
       self.tokens.pop(self.tokens.index(token))
 
   def record(self, reference, value, timestamp=None):
-    """Records a value for an attached source, timestamp is optional, uses current time if not provided"""
+    """Records a value for an attached source, timestamp is optional, uses current time if not provided
+    With a window of more than one, returns True as soon as the value is queued, see flush()
+    """
 
     # Avoid allowing anyone to record values without attaching
     if reference >= len(self.tokens) or len(self.tokens) == 0:
       return False
 
-    extras = ""
-    myid = self.counter
-    self.counter += 1
+    # Anything else can't be sent and would hold up the values behind it
+    if not isinstance(value, numbers.Real) or isinstance(value, bool):
+      eprint("Value has to be a number: " + repr(value))
+      return False
+    if timestamp is not None and (not isinstance(timestamp, numbers.Real) or isinstance(timestamp, bool)):
+      eprint("Timestamp has to be a number: " + repr(timestamp))
+      return False
 
-    if not self.atomic and timestamp is None:
+    if (not self.atomic or self.window > 1) and timestamp is None:
       # Generate local timestamp, otherwise queuing with fail
       timestamp = int(round(time.time()))
 
+    data = {"value": value}
     if timestamp is not None:
-      extras = ',"timestamp":%d' % timestamp
+      data["ts"] = timestamp
+    self.pending.append({"uuid": self.tokens[reference], "data": data, "id": self.counter})
+    self.counter += 1
 
-    json = '{"uuid":"%s","data":{"value":%d%s},"id":"%s"}' % (self.tokens[reference], value, extras, myid)
+    if self.window == 1:
+      return self.flush()
+    self._pump(False)
+    return True
 
-    # If we fail but aren't in atomic mode, store entry to send later...
-    sent = self._send(myid, json)
-    if not sent and not self.atomic:
-      eprint('Failed to send, queuing')
-      self.queue.append({"id": myid, "data": json})
-      return True
-    elif sent and len(self.queue) != 0:
-      # Since we succeeded and we have queued items, fire them off now too before returning
-      eprint('Sending queued items')
-      while len(self.queue):
-        item = self.queue[0]
-        if not self._send(item['id'], item['data']):
+  def flush(self):
+    """Sends all queued values and waits for their results
+    Returns False if any value recorded since the last flush failed, values which are kept
+    to be sent later (see atomic) don't count
+    """
+    self._pump(True)
+    result = not self.failed
+    self.failed = False
+    return result
+
+  def poll(self):
+    """Sends queued values as far as the window allows and handles results which have
+    arrived. Only blocks if a whole batch is waiting for room in the window
+    """
+    self._pump(False)
+
+  def _pump(self, wait):
+    if self.queue or (self.spool is not None and self.spool.unread()):
+      if not self._connect():
+        self._lost()
+        return
+      self.pending[:0] = self.queue
+      self.queue = []
+
+    self._replay()
+    while self.pending or self.inflight:
+      if self.pending and len(self.messages) < self.window:
+        entries = self.pending[:self.batch]
+        if not self._send(entries):
           break
-        self.queue.pop(0)
-    return sent
+        del self.pending[:len(entries)]
+        self._replay()
+        continue
+      # Values pile up while the window is full, until there is a batch of them
+      if not self._receive(wait or len(self.pending) >= self.batch):
+        break
 
-  def _send(self, id, data):
+    if not self.connected:
+      self._lost()
+
+  def _replay(self):
+    """Adds values from the spool to those to send, a batch at a time"""
+    if self.spool is None or len(self.pending) >= self.batch or not self.spool.unread():
+      return
+    entries = []
+    for entry, offset in self.spool.read(self.batch):
+      entry["id"] = self.counter
+      self.spooled[self.counter] = offset
+      self.counter += 1
+      entries.append(entry)
+    self.pending[:0] = entries
+
+  def _send(self, entries):
     if not self._connect():
       return False
 
     try:
-        if self.ws.send(data) == 0:
-          eprint("Not connected")
-          self.connected = False
-          return False
+      if len(entries) == 1:
+        message = json.dumps(entries[0])
+      else:
+        message = json.dumps(entries)
+      if self.ws.send(message) == 0:
+        eprint("Not connected")
+        self.connected = False
+        return False
     except:
       self.connected = False
       eprint("Fatal error: %s" % repr(sys.exc_info()))
       return False
 
+    key = entries[0]["id"]
+    for entry in entries:
+      self.inflight[entry["id"]] = (key, entry)
+    self.messages[key] = len(entries)
+    return True
+
+  def _receive(self, block):
+    """Handles a message from the server, returns False if there was none without blocking
+    (unless block is set) or the connection was lost
+    """
+    if not block and not select.select([self.ws.sock], [], [], 0)[0]:
+      return False
+
     try:
-      result = self.ws.recv()
+      message = self.ws.recv()
     except:
       self.connected = False
       eprint("Fatal error: %s" % repr(sys.exc_info()))
       return False
 
-    # {"status": "OK", "status_code": 200, "id": "0"}
-    m = re.search('{"status": "([^"]+)", "status_code": ([0-9]+), "id": "([^"]+)"}', result)
-    if m is not None and m.group(1) == "OK":
-      if int(m.group(3)) != id:
-        # We should be able to handle multiple concurrent calls, but for now...
-        eprint("WARNING: Result was not the same ID as sent (%d != %d)" % (int(m.group(3)), id))
+    # {"status": "OK", "status_code": 200, "id": 0} or a list of those
+    try:
+      results = json.loads(message)
+    except ValueError:
+      eprint("Invalid message from server")
       return True
-    return False
+    if not isinstance(results, list):
+      results = [results]
+    for result in results:
+      # Updates of subscriptions and errors which aren't about a value carry no id
+      if not isinstance(result, dict) or result.get("id") not in self.inflight:
+        continue
+      key, entry = self.inflight.pop(result["id"])
+      self.messages[key] -= 1
+      if self.messages[key] == 0:
+        del self.messages[key]
+      if result["id"] in self.spooled:
+        self.spool.ack(self.spooled.pop(result["id"]))
+      if result.get("status_code") == 200:
+        continue
+      if result.get("status_code") == 503 and not self.atomic:
+        # Server is busy, try again later
+        self._keep([entry])
+      else:
+        eprint("Failed to record value: %s" % result.get("status"))
+        self.failed = True
+    if self.spool is not None:
+      self.spool.commit()
+    return True
+
+  def _keep(self, entries):
+    if self.spool is not None:
+      self.spool.append(entries)
+    else:
+      self.queue.extend(entries)
+
+  def _lost(self):
+    """Connection is gone, values which aren't acked are kept for later or failed"""
+    entries = [self.inflight[id][1] for id in sorted(self.inflight)] + self.pending
+    self.inflight = {}
+    self.messages = {}
+    self.pending = []
+    if self.spool is not None:
+      # Values from the spool are still in it
+      entries = [entry for entry in entries if entry["id"] not in self.spooled]
+      self.spooled = {}
+      self.spool.rewind()
+    if not entries:
+      return
+    if self.atomic:
+      self.failed = True
+    else:
+      eprint('Failed to send, queuing')
+      self._keep(entries)
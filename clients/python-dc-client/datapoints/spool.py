@@ -0,0 +1,191 @@
+"""Values which couldn't be sent, kept on disk until they can be sent.
+One value per line, appended to the spool file. The offset of the first value which
+hasn't been acked yet is kept in a second file (the checkpoint), so after a restart
+only the values from there on are sent again.
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import collections
+
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+class spool:
+  def __init__(self, filename, size=16*1024*1024, drop="oldest"):
+    """Open (or create) the spool
+    filename File holding the values, the checkpoint goes in filename.offset
+    size Most bytes of values kept, once full either the oldest values are dropped (default)
+    or the newest, see drop
+    """
+    if drop not in ("oldest", "newest"):
+      raise ValueError("drop has to be oldest or newest")
+    self.filename = filename
+    self.checkpoint_file = filename + ".offset"
+    self.size = size
+    self.drop = drop
+    self.dropped = 0
+    self.file = open(filename, "a+b")
+    self.end = self._repair()
+    self.checkpoint = self._load_checkpoint()
+    # Where the next value is read from, and the end of each value read
+    # but not acked yet in order, with those that have been acked since
+    self.cursor = self.checkpoint
+    self.reading = collections.deque()
+    self.acked = set()
+    self.saved = self.checkpoint
+
+  def _repair(self):
+    """Drops a value which was being written when the device went down"""
+    self.file.seek(0, os.SEEK_END)
+    end = self.file.tell()
+    position = end
+    while position > 0:
+      step = min(65536, position)
+      self.file.seek(position - step)
+      chunk = self.file.read(step)
+      i = chunk.rfind("\n")
+      if i >= 0:
+        position = position - step + i + 1
+        break
+      position -= step
+    if position != end:
+      eprint("Dropping incomplete value at the end of the spool")
+      self.file.truncate(position)
+    return position
+
+  def _load_checkpoint(self):
+    try:
+      with open(self.checkpoint_file) as f:
+        offset = int(f.read())
+    except (IOError, ValueError):
+      return 0
+    if offset < 0 or offset > self.end:
+      return 0
+    return offset
+
+  def _save_checkpoint(self):
+    temp = self.checkpoint_file + ".tmp"
+    with open(temp, "w") as f:
+      f.write("%d\n" % self.checkpoint)
+    os.rename(temp, self.checkpoint_file)
+    self.saved = self.checkpoint
+
+  def __len__(self):
+    """Bytes of values which haven't been acked"""
+    return self.end - self.checkpoint
+
+  def unread(self):
+    return self.cursor < self.end
+
+  def append(self, entries):
+    """Adds values (dicts of uuid and data) to the end of the spool and syncs it to disk"""
+    lines = [json.dumps({"uuid": entry["uuid"], "data": entry["data"]}) + "\n" for entry in entries]
+    needed = sum(len(line) for line in lines)
+    if len(self) + needed > self.size:
+      if self.drop == "newest":
+        while lines and len(self) + needed > self.size:
+          needed -= len(lines.pop())
+          self.dropped += 1
+      else:
+        # Values which wouldn't fit on their own are older than the rest
+        while lines and needed > self.size:
+          needed -= len(lines.pop(0))
+          self.dropped += 1
+        if len(self) + needed > self.size:
+          self._drop_oldest(len(self) + needed - self.size)
+      eprint("Spool is full, %d values dropped so far" % self.dropped)
+    if not lines:
+      return
+    self.file.seek(0, os.SEEK_END)
+    self.file.write("".join(lines))
+    self.file.flush()
+    os.fsync(self.file.fileno())
+    self.end += needed
+
+  def _drop_oldest(self, count):
+    """Moves the checkpoint past at least count bytes worth of values"""
+    self.file.seek(self.checkpoint)
+    target = self.checkpoint + count
+    while self.checkpoint < target and self.checkpoint < self.end:
+      self.checkpoint += len(self.file.readline())
+      self.dropped += 1
+    # Values being sent which were dropped no longer hold up the checkpoint
+    while self.reading and self.reading[0] <= self.checkpoint:
+      self.acked.discard(self.reading.popleft())
+    self.cursor = max(self.cursor, self.checkpoint)
+    self._compact()
+    self._save_checkpoint()
+
+  def read(self, count):
+    """Returns up to count of the values after the ones read so far, as a list of
+    (value, offset), offset is passed to ack() once the server has it
+    """
+    result = []
+    self.file.seek(self.cursor)
+    while len(result) < count and self.cursor < self.end:
+      line = self.file.readline()
+      self.cursor += len(line)
+      self.reading.append(self.cursor)
+      try:
+        entry = json.loads(line)
+      except ValueError:
+        eprint("Skipping corrupt value in the spool")
+        self.acked.add(self.cursor)
+        continue
+      result.append((entry, self.cursor))
+    return result
+
+  def ack(self, offset):
+    """The value ending at offset is no longer needed, see commit()"""
+    self.acked.add(offset)
+
+  def commit(self):
+    """Moves the checkpoint past all values acked in order and saves it"""
+    while self.reading and self.reading[0] in self.acked:
+      self.checkpoint = self.reading.popleft()
+      self.acked.discard(self.checkpoint)
+    if self.checkpoint != self.saved:
+      self._compact()
+      self._save_checkpoint()
+
+  def rewind(self):
+    """Values read but not acked are read again, after the connection was lost"""
+    self.cursor = self.checkpoint
+    self.reading.clear()
+    self.acked.clear()
+
+  def _compact(self):
+    """Empties the file once everything has been acked, or moves the values left to
+    the start of a new file once the acked ones take up more than size
+    """
+    if self.checkpoint == self.end and self.end > 0:
+      # A crash before the checkpoint is saved leaves it beyond the end, which reads as 0
+      self.file.truncate(0)
+      self._shift(self.end)
+    elif self.checkpoint > self.size:
+      temp = self.filename + ".tmp"
+      with open(temp, "wb") as f:
+        self.file.seek(self.checkpoint)
+        while True:
+          chunk = self.file.read(1024*1024)
+          if not chunk:
+            break
+          f.write(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+      self._shift(self.checkpoint)
+      # Saved before the new file replaces the old one, a crash in between sends the
+      # acked values again rather than skipping some which weren't
+      self._save_checkpoint()
+      os.rename(temp, self.filename)
+      self.file.close()
+      self.file = open(self.filename, "a+b")
+
+  def _shift(self, shift):
+    self.end -= shift
+    self.checkpoint -= shift
+    self.cursor -= shift
+    self.reading = collections.deque(offset - shift for offset in self.reading)
+    self.acked = set(offset - shift for offset in self.acked)
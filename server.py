@@ -26,14 +26,20 @@ analyze it.
 
 This daemon aims to solve this dilema
 """
+import os
 import sys
 import time
+import errno
 import threading
 import logging
 import argparse
 import datetime
 import traceback
 import random
+import signal
+import decimal
+import hashlib
+import numbers
 from uuid import uuid4
 import Storage
 import json
@@ -43,101 +49,254 @@ parser = argparse.ArgumentParser(description="dataPoints - Gather all your data
 parser.add_argument('--logfile', metavar="FILE", help="Log to file instead of stdout")
 parser.add_argument('--port', default=8088, type=int, help="Port to listen on")
 parser.add_argument('--listen', metavar="ADDRESS", default="0.0.0.0", help="Address to listen on")
-parser.add_argument('--database', metavar='DATABASE', help='Which database to use')
+parser.add_argument('--backend', default='mariadb', choices=['mariadb', 'sqlite', 'columnar'], help='Where to store data')
+parser.add_argument('--database', metavar='DATABASE', help='Which database to use (or file, for sqlite, or directory, for columnar)')
 parser.add_argument('--dbserver', metavar="SERVER", help='Server running mySQL or MariaDB')
 parser.add_argument('--dbuser', metavar='USER', help='Username for server access')
 parser.add_argument('--dbpassword', metavar='PASSWORD', help='Password for server access')
 parser.add_argument('--setup', action='store_true', default=False, help="Create necessary tables")
 parser.add_argument('--force', action='store_true', default=False, help="Causes setup to delete tables if necessary (NOTE! YOU'LL LOSE ALL EXISTING DATA)")
+parser.add_argument('--partition', action='store_true', default=False, help="Split the data table into monthly partitions when creating or upgrading it")
+parser.add_argument('--upgrade', action='store_true', default=False, help="Upgrade the database tables to the latest version while the server is running")
+parser.add_argument('--pool-size', default=5, type=int, help="Maximum number of database connections")
+parser.add_argument('--pool-timeout', default=10, type=int, help="Seconds to wait for a free database connection before giving up")
+parser.add_argument('--pool-recycle', default=60, type=int, help="Check that a database connection is alive if it has been idle for this many seconds")
+parser.add_argument('--batch-size', default=0, type=int, help="Buffer up to this many data points and write them in one transaction (0 writes every point directly)")
+parser.add_argument('--batch-interval', default=1.0, type=float, help="Maximum number of seconds a buffered data point waits before being written")
+parser.add_argument('--compact-after', default=0, type=int, help="Compress data points once they are this many hours old (0 disables)")
+parser.add_argument('--rollups', default='', help="Comma separated resolutions (seconds) to keep rollups of, for example 60,3600,86400")
+parser.add_argument('--query-cache', default=0, type=int, help="Keep up to this many rows of grouped query results in memory, for dashboards asking for the same again (0 disables)")
+parser.add_argument('--threads', default=4, type=int, help="Number of threads running storage calls, so they don't hold up other requests. Data points are written by as many threads of their own.")
+parser.add_argument('--max-queries', type=int, help="Maximum number of queries reading from the database at once, the rest wait their turn (defaults to one less than --pool-size, leaving a connection for writing)")
+parser.add_argument('--workers', default=1, type=int, help="Number of processes serving requests, each with its own database connections and --threads threads")
+parser.add_argument('--latest-file', metavar='FILE', help="Keep the latest value of every source in this file, which other processes can read and the next run starts from")
+parser.add_argument('--trace', default=0.01, type=float, help="Fraction of requests and WebSocket messages to log along with how long they took (failed requests are always logged)")
+parser.add_argument('--ingest-queue', default=1000, type=int, help="Maximum number of data points waiting to be written, beyond that sources are told the server is busy (503)")
 cmdline = parser.parse_args()
 
 """ Setup logging first """
 logging.getLogger('').handlers = []
 logging.basicConfig(filename=cmdline.logfile, level=logging.DEBUG, format='%(asctime)s - %(filename)s@%(lineno)d - %(levelname)s - %(message)s')
 
-from tornado.wsgi import WSGIContainer
-from tornado.ioloop import IOLoop
-from tornado.web import Application, FallbackHandler
-from tornado.websocket import WebSocketHandler
-
-from flask import Flask, jsonify, abort, request, make_response
-
-import mysql.connector
-from mysql.connector import errorcode
-
-""" Disable some logging by-default """
-logging.getLogger("Flask-Cors").setLevel(logging.ERROR)
-logging.getLogger("werkzeug").setLevel(logging.ERROR)
-
-""" Initialize the REST server """
-app = Flask(__name__)
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.web import Application, RequestHandler
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from tornado.iostream import StreamClosedError
+from tornado.queues import Queue
+from tornado.locks import Semaphore
+from tornado.concurrent import Future
+from tornado import gen
+from tornado.websocket import WebSocketHandler, WebSocketClosedError
+from concurrent.futures import ThreadPoolExecutor
 
 """ Initiate database connection """
 
-database = Storage.MariaDB()
+if cmdline.backend == 'sqlite':
+  database = Storage.SQLite()
+elif cmdline.backend == 'columnar':
+  database = Storage.Columnar()
+elif Storage.MariaDB is None:
+  logging.error('MariaDB backend requires mysql.connector')
+  sys.exit(1)
+else:
+  database = Storage.MariaDB(cmdline.pool_size, cmdline.pool_timeout, cmdline.pool_recycle)
 if not database.connect(cmdline.dbuser, cmdline.dbpassword, cmdline.dbserver, cmdline.database):
   sys.exit(1)
 
+if cmdline.workers > 1 and not cmdline.setup:
+  if cmdline.backend == 'columnar':
+    logging.error('Columnar storage can only be used by one process, --workers is not supported')
+    sys.exit(1)
+  # Threads don't survive forking, background jobs are started by the
+  # first worker once it's running
+  database.hold()
+
 if cmdline.setup:
-  if database.setup(cmdline.force):
+  if database.setup(cmdline.force, cmdline.partition):
     logging.info('Tables created successfully')
     sys.exit(0)
   else:
     logging.error('Setup failed')
     sys.exit(1)
 
+upgrade = None
 result = database.validate()
 if result == Storage.VALIDATION_NOT_SETUP:
   logging.error('Database is not setup, use --setup to create necessary tables')
   sys.exit(2)
+elif result == Storage.VALIDATION_NEED_UPGRADE:
+  if not cmdline.upgrade:
+    logging.error('Database needs to be upgraded, use --upgrade to do so while the server is running')
+    sys.exit(2)
+  upgrade = threading.Thread(target=database.upgrade, args=(cmdline.partition,), name='Upgrade')
+  upgrade.daemon = True
 elif result != Storage.VALIDATION_OK:
   logging.error('Internal database error ' + repr(result))
   sys.exit(1)
 
+shared = None
+if cmdline.latest_file:
+  try:
+    shared = Storage.Shared(cmdline.latest_file)
+  except EnvironmentError as err:
+    logging.error('Unable to map %s: %s' % (cmdline.latest_file, repr(err)))
+    sys.exit(1)
+elif cmdline.workers > 1:
+  # Latest values and such are kept in memory all workers share
+  shared = Storage.Shared()
+if shared is not None:
+  database.share(shared)
+
 database.prepare()
 
+if cmdline.compact_after > 0:
+  if not database.start_compactor(cmdline.compact_after * 3600):
+    sys.exit(1)
+  logging.info('Compressing data points older than %d hours' % cmdline.compact_after)
+
+if cmdline.rollups:
+  try:
+    resolutions = [int(r) for r in cmdline.rollups.split(',')]
+  except ValueError:
+    logging.error('--rollups takes a comma separated list of seconds')
+    sys.exit(1)
+  if not database.start_rollups(resolutions):
+    sys.exit(1)
+
+if cmdline.query_cache > 0:
+  if not database.start_query_cache(cmdline.query_cache):
+    sys.exit(1)
+  logging.info('Caching up to %d rows of query results' % cmdline.query_cache)
+
+""" Storage calls block, so handlers run them on these threads """
+executor = ThreadPoolExecutor(cmdline.threads)
+# Data points are written by threads of their own, so slow queries can't
+# hold them up
+ingest_executor = ThreadPoolExecutor(cmdline.threads)
+# A query holds a database connection until its result has been sent,
+# which is up to the client. Limiting them leaves connections for writing.
+if cmdline.max_queries is None:
+  cmdline.max_queries = max(1, cmdline.pool_size - 1)
+queries = Semaphore(cmdline.max_queries)
+
+""" Timings and counters of the server, the backend keeps its own """
+metrics = Storage.Metrics()
+
+def traced():
+  """
+  True for the requests and messages to log, see --trace
+  """
+  return random.random() < cmdline.trace
+
+def log_request(handler):
+  """
+  Called by tornado once a request has been answered, in place of its own
+  logging. Records how long it took and logs it if it failed or is traced.
+  """
+  duration = handler.request.request_time()
+  metrics.histogram('datapoints_http_request_seconds', 'Time taken answering requests', handler=handler.__class__.__name__, method=handler.request.method).observe(duration)
+  status = handler.get_status()
+  if status >= 500:
+    log = logging.error
+  elif status >= 400:
+    log = logging.warning
+  elif traced():
+    log = logging.info
+  else:
+    return
+  log('%d %s %s (%s) %.2fms' % (status, handler.request.method, handler.request.uri, handler.request.remote_ip, 1000.0 * duration))
+
 def createResult(http_code, status, data=None):
-  with app.app_context():
-    content = {"status" : status}
-    if data is not None:
-      content['data'] = data
-    ret = {"data" : json.dumps(content), "status" : status, "code" : http_code }
-    return ret
-
-def createResponse(content):
-  ret = make_response(content['data'])
-  if 'status' in content:
-    ret.status = content['status']
-  if 'code' in content:
-    ret.status_code = content['code']
+  content = {"status" : status}
+  if data is not None:
+    content['data'] = data
+  ret = {"data" : json.dumps(content), "status" : status, "code" : http_code }
   return ret
 
-@app.route("/resolve", methods=['POST'])
-def resolve():
+def jsonDefault(o):
+  """
+  Aggregated values and timestamps come back from the database as decimals
+  """
+  if isinstance(o, decimal.Decimal):
+    if o == o.to_integral_value():
+      return int(o)
+    return float(o)
+  raise TypeError(repr(o) + ' is not JSON serializable')
+
+class JSONHandler(RequestHandler):
+  def get_json(self):
+    """
+    Returns the decoded body of the request or None if it isn't valid JSON
+    """
+    try:
+      return json.loads(self.request.body)
+    except ValueError:
+      return None
+
+  def respond(self, content):
+    self.set_status(content['code'])
+    self.set_header('Content-Type', 'application/json')
+    self.finish(content['data'])
+
+@gen.coroutine
+def catch_up():
+  """
+  Waits until sources and types registered through other workers are
+  loaded, lookups answered from memory would leave them out until then
+  """
+  if database.outdated():
+    yield executor.submit(database.refresh)
+
+class Listing:
+  """
+  Result of listing all sources or types, which is only put together
+  again once one is added
+  """
+  def __init__(self, fetch):
+    self.fetch = fetch
+    self.version = None
+    self.result = None
+
+  def get(self):
+    version = database.registry_version()
+    if version != self.version:
+      self.result = createResult(200, "OK", self.fetch())
+      self.version = version
+    return self.result
+
+class ResolveHandler(JSONHandler):
   """
   Expects the following:
     { sid: <source id> }
+  or
+    { sid: [ <source id>, ... ] }
 
   Result 200:
     { status : <result of operation>, data : { uuid : <uuid or null> } }
+  or, for a list of sids, the uuid of each in the same order
+    { status : <result of operation>, data : { uuid : [ <uuid or null>, ... ] } }
   Result 400:
     --- happens when data is corrupt, ie, not JSON ---
   Result 500:
     { status : <result of operation> }
   """
-  result = None
-
-  json = request.get_json()
-  if json is None or 'sid' not in json:
-    result = createResult(500, "Invalid or missing JSON data")
-  else:
-    uuid = database.sid2uuid(json['sid'])
-    result = createResult(200, "Result", {'uuid':uuid})    
-
-  return createResponse(result)
+  @gen.coroutine
+  def post(self):
+    req = self.get_json()
+    if req is None:
+      self.respond(createResult(400, 'Malformed JSON data'))
+      return
+    if 'sid' not in req:
+      self.respond(createResult(500, "Invalid or missing JSON data"))
+      return
+    yield catch_up()
+    if isinstance(req['sid'], list):
+      self.respond(createResult(200, "Result", {'uuid' : [database.sid2uuid(sid) for sid in req['sid']]}))
+    else:
+      self.respond(createResult(200, "Result", {'uuid' : database.sid2uuid(req['sid'])}))
 
-@app.route("/register", methods=['POST'])
-def register():
+class RegisterHandler(JSONHandler):
   """
   Expects the following:
     { id: <unique id for app source>, name : <name of source>, type : <uuid>, (accuracy : <int>, parameters : <str>) }
@@ -169,65 +328,293 @@ def register():
     { status : <result of operation> }
 
   """
-  result = None
-
-  json = request.get_json()
-  if json is None or 'sid' not in json or 'name' not in json or 'type' not in json:
-    result = createResult(500, "Invalid or missing JSON data")
-  else:
-    uuid = str(uuid4())
-    accuracy = json.get('accuracy', 1)
-    parameters = json.get('parameters', '')
-    if not database.add_source(uuid, json['sid'], json['name'], json['type'], accuracy, parameters):
-      result = createResult(500, "Invalid or missing JSON data")
+  @gen.coroutine
+  def post(self):
+    req = self.get_json()
+    if req is None:
+      self.respond(createResult(400, 'Malformed JSON data'))
+    elif 'sid' not in req or 'name' not in req or 'type' not in req:
+      self.respond(createResult(500, "Invalid or missing JSON data"))
     else:
-      result = createResult(200, "Source registered", {'uuid':uuid})
-
-  return createResponse(result)
+      uuid = str(uuid4())
+      accuracy = req.get('accuracy', 1)
+      parameters = req.get('parameters', '')
+      added = yield executor.submit(database.add_source, uuid, req['sid'], req['name'], req['type'], accuracy, parameters)
+      if not added:
+        self.respond(createResult(500, "Invalid or missing JSON data"))
+      else:
+        self.respond(createResult(200, "Source registered", {'uuid':uuid}))
 
-@app.route('/entry/<uuid>', methods=['PUT', 'GET'])
-def add_data(uuid):
+class EntryHandler(JSONHandler):
   """
   Expects the following format of the data:
-    { value : <value>, (ts : <timestamp>) }
+    { value : <value>, (ts : <timestamp>), (sync : <bool>) }
   If timestamp is omitted, server fills in with current time
 
+  When the server buffers writes, the result is returned as soon as the
+  value is queued. Set sync to true to wait until it has been committed.
+
   Result 200:
     { status : OK }
   Result 400:
     --- Malformed JSON or otherwise incorrect data ---
   Result 500:
     { status : <error message> }
+  Result 503:
+    { status : <error message> } --- too many data points waiting to be written ---
 
   Using GET will retrieve the latest entry reported for the source
   """
-  if request.method == 'GET':
-    json = database.query_latest([uuid])
-    if json is None:
-      return createResponse(createResult(500, 'No such UUID or no data'))
-    return createResponse((200, 'OK', json))
-  elif request.method == 'PUT':
-    json = request.get_json()
-    return createResponse(process_data(uuid, json))
-
-@app.route('/type/register', methods=['POST'])
-def register_type():
-  result = None
-
-  json = request.get_json()
-  if json is None or 'uuid' not in json or 'name' not in json:
-    result = createResult(500, "Invalid or missing JSON data")
-  else:
-    if not database.add_type(json['uuid'], json['name'], json.get('description','')):
-      result = createResult(500, "Invalid or missing JSON data")
+  @gen.coroutine
+  def get(self, uuid):
+    # Served from memory, only waits if other workers registered
+    # sources or types since
+    yield catch_up()
+    data = database.query_latest([uuid])
+    if data is None:
+      self.respond(createResult(500, 'No such UUID or no data'))
+    else:
+      self.respond(createResult(200, 'OK', data))
+
+  @gen.coroutine
+  def put(self, uuid):
+    req = self.get_json()
+    if req is None:
+      self.respond(createResult(400, 'Malformed JSON data'))
+    else:
+      result = yield ingest.put(uuid, req)
+      self.respond(result)
+
+class StatsHandler(JSONHandler):
+  """
+  Result 200:
+    { status : OK, data : { (query_cache : { hits : <int>, misses : <int>, entries : <int>, rows : <int> }) } }
+
+  Counters are those of the process answering, see --workers
+  """
+  def get(self):
+    self.respond(createResult(200, 'OK', database.stats()))
+
+class MetricsHandler(RequestHandler):
+  """
+  Returns timings and counters in the Prometheus text format. As with
+  /stats, they are those of the process answering, see --workers
+  """
+  def get(self):
+    self.set_header('Content-Type', 'text/plain; version=0.0.4')
+    self.finish(metrics.render() + database.metrics.render())
+
+def uuid_list(uuids):
+  """
+  Returns uuids as a list, which may also be a single uuid, or None if
+  it isn't one
+  """
+  if not isinstance(uuids, list):
+    uuids = [uuids]
+  for u in uuids:
+    if not isinstance(u, basestring):
+      return None
+  return uuids
+
+class LatestHandler(JSONHandler):
+  """
+  Expects the following:
+    { uuid : [ <uuid>, ... ] }
+  or using GET, /latest?uuid=<uuid>&uuid=<uuid>...
+
+  uuid can either be a <uuid> or an array of <uuid>'s, same as /query
+
+  Result 200:
+    { status : OK, data : [ { uuid : <uuid>, ts : <timestamp>, value : <value> }, ... ] }
+  Result 304:
+    --- If-None-Match holds the ETag of the result, nothing has changed ---
+  Result 400:
+    --- happens when data is corrupt, ie, not JSON ---
+  Result 500:
+    { status : <error message> }
+
+  Values come from memory, sources which are unknown or have no data are
+  left out
+  """
+  @gen.coroutine
+  def get(self):
+    yield self.latest(self.get_query_arguments('uuid'))
+
+  @gen.coroutine
+  def post(self):
+    req = self.get_json()
+    if req is None:
+      self.respond(createResult(400, 'Malformed JSON data'))
+    elif 'uuid' not in req:
+      self.respond(createResult(500, 'Missing uuid(s)'))
     else:
-      result = createResult(200, "Type registered")
+      yield self.latest(req['uuid'])
+
+  @gen.coroutine
+  def latest(self, uuids):
+    uuids = uuid_list(uuids)
+    if uuids is None:
+      self.respond(createResult(500, 'uuid has to be a string or a list of strings'))
+      return
+    yield catch_up()
+    body = createResult(200, 'OK', database.query_latest(uuids))['data']
+    # Tornado only does this for GET, dashboards polling with POST should
+    # be spared the body too
+    self.set_header('Etag', '"%s"' % hashlib.sha1(body).hexdigest())
+    if self.check_etag_header():
+      self.set_status(304)
+      self.finish()
+      return
+    self.set_header('Content-Type', 'application/json')
+    self.finish(body)
+
+def check_point(value, ts):
+  """
+  Returns why value and ts aren't a data point, None if they are
+  """
+  if not isinstance(value, numbers.Real) or isinstance(value, bool):
+    return 'Value has to be a number'
+  if ts is not None and (not isinstance(ts, numbers.Real) or isinstance(ts, bool)):
+    return 'Timestamp has to be a number'
+  return None
 
-  return createResponse(result)
+def parse_ndjson(body):
+  """
+  Reads one { uuid : <uuid>, value : <value>, (ts : <timestamp>) } per
+  line. Returns a list of (uuid, value, ts, line) along with a list of
+  (uuid, line, reason) for the lines which aren't data points.
+  """
+  points = []
+  failed = []
+  for line, text in enumerate(body.splitlines()):
+    if not text.strip():
+      continue
+    try:
+      j = json.loads(text)
+    except ValueError:
+      failed.append((None, line, 'Malformed JSON data'))
+      continue
+    if not isinstance(j, dict) or 'uuid' not in j or 'value' not in j:
+      failed.append((None, line, 'Needs uuid and value'))
+      continue
+    reason = check_point(j['value'], j.get('ts', None))
+    if reason is not None:
+      failed.append((j['uuid'], line, reason))
+      continue
+    points.append((j['uuid'], j['value'], j.get('ts', None), line))
+  return points, failed
+
+def parse_columnar(req):
+  """
+  Reads { <uuid> : { ts : [ <timestamp>, ... ], value : [ <value>, ... ] }, ... }
+  where ts may be left out for all points to get the current time.
+  Returns None if req isn't laid out like that, otherwise the same as
+  parse_ndjson() with the position in the arrays instead of line.
+  """
+  if not isinstance(req, dict):
+    return None
+  points = []
+  failed = []
+  for uuid, columns in req.items():
+    if not isinstance(columns, dict) or not isinstance(columns.get('value', None), list):
+      return None
+    values = columns['value']
+    stamps = columns.get('ts', None)
+    if stamps is None:
+      stamps = [None] * len(values)
+    if not isinstance(stamps, list) or len(stamps) != len(values):
+      return None
+    for index, (value, ts) in enumerate(zip(values, stamps)):
+      reason = check_point(value, ts)
+      if reason is not None:
+        failed.append((uuid, index, reason))
+      else:
+        points.append((uuid, value, ts, index))
+  return points, failed
 
-@app.route('/type', methods=['GET'], defaults={'uuid' : None})
-@app.route('/type/<uuid>', methods=['GET'])
-def list_types(uuid):
+class BulkHandler(JSONHandler):
+  """
+  Records many data points in one go, for example when a source catches
+  up after being offline. Either one data point per line (with
+  Content-Type: application/x-ndjson):
+
+    { uuid : <uuid>, value : <value>, (ts : <timestamp>) }
+    ...
+
+  or, when the points of each source are sent as columns:
+
+    {
+      <uuid> : { (ts : [ <timestamp>, ... ]), value : [ <value>, ... ] },
+      ...
+    }
+
+  The body may be compressed, with Content-Encoding: gzip.
+
+  Every data point is checked before any is written, the ones which are
+  fine are then written together and the result is returned once they
+  have been committed. Only the data points which could not be recorded
+  are listed, by line or position in the arrays:
+
+  Result 200:
+    { status : <msg>, data : { recorded : <count>, failed : [ { (uuid : <uuid>), index : <index>, status : <why> }, ... ] } }
+  Result 400:
+    --- Malformed JSON or otherwise incorrect data ---
+  Result 500:
+    { status : <error message> } --- nothing was recorded ---
+  """
+  @gen.coroutine
+  def post(self):
+    if 'application/x-ndjson' in self.request.headers.get('Content-Type', ''):
+      parsed = parse_ndjson(self.request.body)
+    else:
+      parsed = parse_columnar(self.get_json())
+    if parsed is None:
+      self.respond(createResult(400, 'Malformed JSON data'))
+      return
+    points, failed = parsed
+
+    # Counted along with the points received over WebSocket or PUT
+    ingest.batches.observe(len(points))
+    start = time.time()
+    try:
+      rejected = yield ingest_executor.submit(database.record_many, [p[:3] for p in points], True)
+      ingest.writing.observe(time.time() - start)
+    except Exception:
+      logging.exception('Failed to write %d data points' % len(points))
+      rejected = None
+    if rejected is None:
+      ingest.points['failed'].inc(len(points) + len(failed))
+      self.respond(createResult(500, 'Unable to record data points'))
+      return
+    for i, reason in rejected:
+      failed.append((points[i][0], points[i][3], reason))
+    ingest.points['written'].inc(len(points) - len(rejected))
+    ingest.points['failed'].inc(len(failed))
+
+    result = []
+    for uuid, index, reason in failed:
+      item = {'index' : index, 'status' : reason}
+      if uuid is not None:
+        item['uuid'] = uuid
+      result.append(item)
+    self.respond(createResult(200, 'OK', {'recorded' : len(points) - len(rejected), 'failed' : result}))
+
+class TypeRegisterHandler(JSONHandler):
+  @gen.coroutine
+  def post(self):
+    req = self.get_json()
+    if req is None:
+      self.respond(createResult(400, 'Malformed JSON data'))
+    elif 'uuid' not in req or 'name' not in req:
+      self.respond(createResult(500, "Invalid or missing JSON data"))
+    else:
+      added = yield executor.submit(database.add_type, req['uuid'], req['name'], req.get('description',''))
+      if not added:
+        self.respond(createResult(500, "Invalid or missing JSON data"))
+      else:
+        self.respond(createResult(200, "Type registered"))
+
+class TypeHandler(JSONHandler):
   """
   Returns a list of all registered types or just one if uuid is provided:
   [
@@ -235,18 +622,23 @@ def list_types(uuid):
     ...
   ]
   """
-  data = database.types(uuid)
+  listing = None
 
-  if data is None:
+  @gen.coroutine
+  def get(self, uuid=None):
+    # Served from memory, only waits if other workers registered
+    # sources or types since
+    yield catch_up()
     if uuid is None:
-      return createResponse(createResult(500, "Unable to get list of registered types"))
+      self.respond(TypeHandler.listing.get())
+      return
+    data = database.types(uuid)
+    if data is None:
+      self.respond(createResult(500, "Unable to get type, no such uuid?"))
     else:
-      return createResponse(createResult(500, "Unable to get type, no such uuid?"))
-  return createResponse(createResult(200, "OK", data))
+      self.respond(createResult(200, "OK", data))
 
-@app.route('/source', methods=['GET'], defaults={'uuid' : None})
-@app.route('/source/<uuid>', methods=['GET'])
-def list_sources(uuid):
+class SourceHandler(JSONHandler):
   """
   Returns a list of all registered sources or just one if uuid is provided:
   [
@@ -254,30 +646,54 @@ def list_sources(uuid):
     ...
   ]
   """
-  data = database.sources(uuid)
+  listing = None
 
-  if data is None:
+  @gen.coroutine
+  def get(self, uuid=None):
+    # Served from memory, only waits if other workers registered
+    # sources or types since
+    yield catch_up()
     if uuid is None:
-      return createResponse(createResult(500, "Unable to get list of registered sources"))
+      self.respond(SourceHandler.listing.get())
+      return
+    data = database.sources(uuid)
+    if data is None:
+      self.respond(createResult(500, "Unable to get source, no such uuid?"))
     else:
-      return createResponse(createResult(500, "Unable to get source, no such uuid?"))
-  return createResponse(createResult(200, "OK", data))
-
-@app.route('/query', methods=['POST'])
-def query():
+      self.respond(createResult(200, "OK", data))
+
+GROUP_MODES = {
+  'none' : Storage.GROUP_BY_NONE,
+  'sum' : Storage.GROUP_BY_SUM,
+  'average' : Storage.GROUP_BY_AVERAGE,
+  'median' : Storage.GROUP_BY_MEDIAN,
+  'min' : Storage.GROUP_BY_MIN,
+  'max' : Storage.GROUP_BY_MAX,
+  'count' : Storage.GROUP_BY_COUNT,
+  'first' : Storage.GROUP_BY_FIRST,
+  'last' : Storage.GROUP_BY_LAST,
+  'stddev' : Storage.GROUP_BY_STDDEV,
+  'percentile' : Storage.GROUP_BY_PERCENTILE
+}
+
+class QueryHandler(JSONHandler):
   """
   Requests information from server, format is as follows:
 
   {
    uuid : [ <uuid>, ... ],
    (count : <nbr of results>),
-   (groupby : <period>, mode : <sum/average/median>),
+   (groupby : <period>, mode : <see GROUP_MODES>, (percentile : <0-100>)),
+   (max_points : <nbr of points per uuid>, (downsample : lttb|minmax)),
    (reverse : <bool>),
    (range : { (start : <ts>), (end : <ts>) })
   }
 
   uuid is special, it can either be a <uuid> or an array of <uuid>'s
   range requires either start, end or both
+  percentile is only used (and required) with mode percentile
+  max_points reduces the result to about that many points per uuid, for
+  plotting, and can't be combined with groupby
 
   Server returns:
 
@@ -289,73 +705,418 @@ def query():
     ]
   }
 
+  The result is streamed to the client as it is read from the database.
+  If the request carries "Accept: application/x-ndjson", each data point is
+  instead sent as a JSON object on a line of its own, without the envelope.
+
   Please note that the value isn't corrected with the accuracy defined in source!
 
   """
-  json = request.get_json()
-  if json is None or 'uuid' not in json:
-    return createResponse(createResult(500, 'Missing uuid(s)'))
+  CHUNK_ROWS = 500
+
+  def initialize(self):
+    self.iterator = None
+    self.closed = False
+
+  @gen.coroutine
+  def post(self):
+    req = self.get_json()
+    if req is None:
+      self.respond(createResult(400, 'Malformed JSON data'))
+      return
+    if 'uuid' not in req:
+      self.respond(createResult(500, 'Missing uuid(s)'))
+      return
+
+    uuids = uuid_list(req['uuid'])
+    if uuids is None:
+      self.respond(createResult(500, 'uuid has to be a string or a list of strings'))
+      return
+    mode = GROUP_MODES.get(str(req.get('mode', 'none')).lower(), None)
+    if mode is None:
+      self.respond(createResult(500, 'Unsupported mode'))
+      return
+    percentile = 50
+    if mode == Storage.GROUP_BY_PERCENTILE:
+      percentile = req.get('percentile', None)
+      if not isinstance(percentile, (int, float)) or percentile < 0 or percentile > 100:
+        self.respond(createResult(500, 'Mode percentile requires a percentile between 0 and 100'))
+        return
+
+    ts_start = ts_end = None
+    if 'range' in req:
+      ts_start = req['range'].get('start', None)
+      ts_end   = req['range'].get('end', None)
+      if ts_start is None and ts_end is None:
+        self.respond(createResult(500, 'Using range requires start, end or both'))
+        return
+      if ts_end is not None and ts_start is not None and ts_end < ts_start:
+        self.respond(createResult(500, 'Start of range has to be before end of range'))
+        return
+
+    reverse = False
+    if req.get('reverse', False) != False:
+      reverse = True
+
+    max_points = req.get('max_points', 0)
+    if max_points:
+      method = str(req.get('downsample', Storage.Downsample.LTTB)).lower()
+      if not isinstance(max_points, int) or max_points < 3:
+        self.respond(createResult(500, 'max_points has to be at least 3'))
+        return
+      if method not in Storage.Downsample.SAMPLERS:
+        self.respond(createResult(500, 'Unsupported downsample method'))
+        return
+      if req.get('groupby', 0) or mode != Storage.GROUP_BY_NONE:
+        self.respond(createResult(500, 'max_points can\'t be combined with groupby'))
+        return
+
+    yield queries.acquire()
+    try:
+      if max_points:
+        self.iterator = yield executor.submit(Storage.Downsample.query,
+                                              database,
+                                              uuids,
+                                              ts_start,
+                                              ts_end,
+                                              max_points,
+                                              method,
+                                              reverse,
+                                              req.get('count', 0))
+      else:
+        self.iterator = yield executor.submit(database.query,
+                                              uuids,
+                                              ts_start,
+                                              ts_end,
+                                              req.get('count', 0),
+                                              req.get('groupby', 0),
+                                              mode,
+                                              reverse,
+                                              percentile)
+      if self.closed and self.iterator is not None:
+        self.iterator.release()
+        return
+      if self.iterator is None or self.iterator.getError() is not None:
+        self.respond(createResult(500, 'Unable to perform query'))
+        return
+
+      ndjson = 'application/x-ndjson' in self.request.headers.get('Accept', '')
+      try:
+        yield self.stream(ndjson)
+      except StreamClosedError:
+        logging.info('Client went away during query')
+      finally:
+        self.iterator.release()
+    finally:
+      queries.release()
 
-  uuids = json['uuid']
-  if not isinstance(uuids, list):
-    uuids = [uuids]
-  mode = json.get('mode', 'none').lower()
-  if mode == 'sum':
-    mode = Storage.GROUP_BY_SUM
-  elif mode == 'average':
-    mode = Storage.GROUP_BY_AVERAGE
-  elif mode == 'median':
-    mode = Storage.GROUP_BY_MEDIAN
-  elif mode == 'none':
-    mode = Storage.GROUP_BY_NONE
-  else:
-    return createResponse(createResult(500, 'Unsupported mode'))
-
-  ts_start = ts_end = None
-  if 'range' in json:
-    ts_start = json['range'].get('start', None)
-    ts_end   = json['range'].get('end', None)
-    if ts_start is None and ts_end is None:
-      return createResponse(createResult(500, 'Using range requires start, end or both'))
-    if ts_end is not None and ts_start is not None and ts_end < ts_start:
-      return createResponse(createResult(500, 'Start of range has to be before end of range'))
-
-  reverse = False
-  if json.get('reverse', False) != False:
-    reverse = True
-
-  iterator = database.query(uuids,
-                            ts_start,
-                            ts_end,
-                            json.get('count', 0),
-                            json.get('groupby', 0),
-                            mode,
-                            reverse)
-
-  # This part will need to be redone to allow streaming instead of buffering
-  result = []
-  e = iterator.next()
-  while e is not None:
-    result.append(e)
-    e = iterator.next()
-  iterator.release()
-
-  return createResponse(createResult(200, "OK", result))
+  @gen.coroutine
+  def stream(self, ndjson):
+    """
+    Writes the result in chunks, waiting for each chunk to be sent before
+    reading more rows so only one chunk is held in memory at a time.
+    Rows are read on the executor, so other requests are served while
+    waiting for the database.
+    """
+    if ndjson:
+      self.set_header('Content-Type', 'application/x-ndjson')
+      separator = '\n'
+    else:
+      self.set_header('Content-Type', 'application/json')
+      self.write('{"status": "OK", "data": [')
+      separator = ', '
+
+    first = True
+    while True:
+      rows = yield executor.submit(self.read)
+      if not rows or self.closed:
+        break
+      self.write(('' if first else separator) + separator.join(rows))
+      first = False
+      yield self.flush()
+
+    if self.closed:
+      return
+    if self.iterator.getError() is not None:
+      # Headers are long gone, so the only way to tell the client is to
+      # cut the response short instead of terminating it properly.
+      logging.error('Query failed while streaming: ' + self.iterator.getError())
+      self.request.connection.close()
+      return
+
+    if ndjson:
+      if not first:
+        self.write('\n')
+    else:
+      self.write(']}')
+    self.finish()
+
+  def read(self):
+    """
+    Reads and serializes the next CHUNK_ROWS rows, runs on the executor
+    since reading may have to wait for the database
+    """
+    rows = []
+    while len(rows) < self.CHUNK_ROWS:
+      e = self.iterator.next()
+      if e is None:
+        break
+      rows.append(json.dumps(e, default=jsonDefault))
+    return rows
+
+  def on_connection_close(self):
+    # The iterator may be in use by the executor, it is released once
+    # stream() notices
+    self.closed = True
+
+def check_data(json):
+  """
+  Returns an error result if json isn't a data point, None if it is
+  """
+  if not isinstance(json, dict) or 'value' not in json:
+    return createResult(500, "Invalid or missing JSON data")
+  reason = check_point(json['value'], json.get('ts', None))
+  if reason is not None:
+    return createResult(500, reason)
+  return None
 
 def process_data(uuid, json):
-  result = None
-  if json is None or 'value' not in json:
-    result = createResult(500, "Invalid or missing JSON data")
-  else:
-    if not database.record(uuid, json['value'], json.get('ts', None)):
+  result = check_data(json)
+  if result is None:
+    if not database.record(uuid, json['value'], json.get('ts', None), json.get('sync', False)):
       result = createResult(500, 'Unable to add new value. Invalid UUID?')
     else:
       result = createResult(200, "OK")
   return result
 
+def process_batch(entries):
+  """
+  Records a list of (uuid, data) which passed check_data() in one go,
+  returns the result of each
+  """
+  if len(entries) == 1:
+    return [process_data(*entries[0])]
+  sync = False
+  points = []
+  for uuid, data in entries:
+    sync = sync or data.get('sync', False)
+    points.append((uuid, data['value'], data.get('ts', None)))
+  rejected = database.record_many(points, sync)
+  if rejected is None:
+    return [createResult(500, 'Unable to add new value')] * len(entries)
+  results = [createResult(200, "OK")] * len(entries)
+  for i, reason in rejected:
+    results[i] = createResult(500, 'Unable to add new value. ' + reason)
+  return results
+
+class Ingest:
+  """
+  Writes the data points received over WebSocket or PUT. Points are checked on
+  the IOLoop and queued, the queue is drained by threads of ingest_executor
+  doing the actual writes. This way a slow write only holds up the points
+  behind it rather than every connected source. The points of a message
+  are queued and written together, as one transaction.
+
+  At most size points may be waiting. Once the queue is full, points are
+  turned away with status 503 right away and the source should send them
+  again later. A message holding more than size points is only taken
+  when nothing else is waiting.
+  """
+  def __init__(self, size, threads):
+    self.queue = Queue()
+    self.size = size
+    self.waiting = 0
+    self.threads = threads
+    self.points = dict([(result, metrics.counter('datapoints_ingest_points_total', 'Data points received, by whether they were written', result=result)) for result in ['written', 'failed', 'busy']])
+    self.batches = metrics.histogram('datapoints_ingest_batch_points', 'Data points written together', Storage.Metrics.SIZES)
+    self.writing = metrics.histogram('datapoints_ingest_write_seconds', 'Time taken writing a batch of data points')
+    metrics.reading('datapoints_ingest_queue_points', 'gauge', 'Data points waiting to be written', lambda: self.waiting)
+
+  def start(self):
+    for i in range(self.threads):
+      IOLoop.current().spawn_callback(self._worker)
+
+  @gen.coroutine
+  def put(self, uuid, data):
+    """
+    Queues a point, returns a Future holding the result of writing it
+    """
+    results = yield self.put_many([(uuid, data)])
+    raise gen.Return(results[0])
+
+  def put_many(self, entries):
+    """
+    Queues a list of (uuid, data) to be written together, returns a
+    Future holding the list of results
+    """
+    future = Future()
+    results = [check_data(data) for uuid, data in entries]
+    valid = [(i, uuid, data) for i, (uuid, data) in enumerate(entries) if results[i] is None]
+    if len(valid) < len(entries):
+      self.points['failed'].inc(len(entries) - len(valid))
+    if valid:
+      if self.waiting == 0 or self.waiting + len(valid) <= self.size:
+        self.waiting += len(valid)
+        self.queue.put_nowait((valid, results, future))
+        return future
+      logging.warning('Ingest queue is full, turning away %d data points' % len(valid))
+      self.points['busy'].inc(len(valid))
+      for i, uuid, data in valid:
+        results[i] = createResult(503, 'Server busy, try again later')
+    future.set_result(results)
+    return future
+
+  def drain(self):
+    """
+    Returns a Future which is done once every queued point is written
+    """
+    return self.queue.join()
+
+  @gen.coroutine
+  def _worker(self):
+    while True:
+      valid, results, future = yield self.queue.get()
+      self.batches.observe(len(valid))
+      start = time.time()
+      try:
+        written = yield ingest_executor.submit(process_batch, [(uuid, data) for i, uuid, data in valid])
+        self.writing.observe(time.time() - start)
+      except Exception:
+        logging.exception('Failed to write %d data points' % len(valid))
+        written = [createResult(500, 'Unable to add new value')] * len(valid)
+      finally:
+        self.waiting -= len(valid)
+        self.queue.task_done()
+      ok = 0
+      for (i, uuid, data), result in zip(valid, written):
+        results[i] = result
+        if result['code'] == 200:
+          ok += 1
+      self.points['written'].inc(ok)
+      if ok < len(valid):
+        self.points['failed'].inc(len(valid) - ok)
+      future.set_result(results)
+
+def parse_entries(j):
+  """
+  Checks the data points of a decoded message sent to /stream, returns
+  whether it was an array along with the list of entries. Raises
+  ValueError if it is malformed.
+  """
+  entries = j if isinstance(j, list) else [j]
+  for i in entries:
+    if not isinstance(i, dict) or 'uuid' not in i or 'data' not in i:
+      raise ValueError('Each entry needs uuid and data')
+  return isinstance(j, list), entries
+
+def coalesce(points):
+  """
+  Keeps only the newest of the points of each source, oldest first
+  """
+  newest = {}
+  for point in points:
+    if point['uuid'] not in newest or newest[point['uuid']]['ts'] <= point['ts']:
+      newest[point['uuid']] = point
+  return sorted(newest.values(), key=lambda point: point['ts'])
+
+class Subscriptions:
+  """
+  Keeps track of the sources WebSocket connections have subscribed to and
+  pushes data points to them as they are recorded. Points are handed over
+  by the threads recording them (see Backend.watch()) and fanned out on
+  the IOLoop, nothing is read from storage.
+
+  When other workers record points as well, the latest values of the
+  subscribed sources are checked for theirs every POLL seconds.
+  """
+  POLL = 0.25
+
+  def __init__(self, poll):
+    self.poll = poll
+    # Connections subscribed to each uuid
+    self.sources = {}
+    # Newest (ts, value) pushed of each uuid, so points aren't pushed twice
+    self.seen = {}
+    self.loop = None
+
+  def start(self):
+    self.loop = IOLoop.current()
+    database.watch(self.recorded)
+    if self.poll:
+      PeriodicCallback(self._poll, self.POLL * 1000).start()
+
+  def subscribe(self, connection, uuids):
+    """
+    Subscribes connection to uuids, returns their latest values
+    """
+    latest = database.query_latest(uuids)
+    for u in uuids:
+      self.sources.setdefault(u, set()).add(connection)
+    for point in latest:
+      self.seen.setdefault(point['uuid'], (point['ts'], point['value']))
+    return latest
+
+  def unsubscribe(self, connection, uuids):
+    for u in uuids:
+      connections = self.sources.get(u, None)
+      if connections is None:
+        continue
+      connections.discard(connection)
+      if not connections:
+        del self.sources[u]
+        self.seen.pop(u, None)
+
+  def recorded(self, points):
+    """
+    Called with a list of (uuid, value, ts) recorded, from any thread
+    """
+    wanted = [point for point in points if point[0] in self.sources]
+    if wanted:
+      self.loop.add_callback(self._publish, wanted)
+
+  def _publish(self, points):
+    updates = {}
+    for uuid, value, ts in points:
+      connections = self.sources.get(uuid, None)
+      if not connections:
+        continue
+      seen = self.seen.get(uuid, None)
+      if seen == (ts, value):
+        continue
+      if seen is None or seen[0] <= ts:
+        self.seen[uuid] = (ts, value)
+      point = {'uuid' : uuid, 'ts' : ts, 'value' : value}
+      for connection in connections:
+        updates.setdefault(connection, []).append(point)
+    for connection, points in updates.items():
+      connection.push(points)
+
+  def _poll(self):
+    if not self.sources:
+      return
+    points = []
+    for latest in database.query_latest(self.sources.keys()):
+      seen = self.seen.get(latest['uuid'], None)
+      if seen is None or seen[0] < latest['ts'] or (seen[0] == latest['ts'] and seen[1] != latest['value']):
+        points.append((latest['uuid'], latest['value'], latest['ts']))
+    if points:
+      self._publish(points)
+
 class WebSocket(WebSocketHandler):
+  # Points waiting to be pushed beyond this are coalesced, for clients
+  # which don't keep up
+  BACKLOG = 10000
+  # Open connections, for metrics
+  connections = set()
+  messages = metrics.counter('datapoints_websocket_messages_total', 'Messages received over WebSocket')
+
   def open(self):
     logging.info("Source connected to WebSocket")
+    WebSocket.connections.add(self)
+    self.subscribed = set()
+    self.updates = []
+    self.interval = 0
+    self.pushing = False
 
   def check_origin(self, origin):
     return True
@@ -382,43 +1143,275 @@ class WebSocket(WebSocketHandler):
 
     The ID field allows a client to backtrack the result to the request. Server does
     not care about what kind of data it is, as long as it's a string or integer.
+
+    The latest values of sources are requested with:
+      { latest : [ <uuid>, ... ], (id : <str/int>) }
+    and returned as:
+      { status : OK, status_code : 200, data : <same as /latest>, (id : <str/int>) }
+
+    To have data points of sources pushed as they are recorded:
+      { subscribe : [ <uuid>, ... ], (interval : <seconds>), (id : <str/int>) }
+    which is answered the same as latest, followed by
+      { status : Update, status_code : 200, data : <same as /latest> }
+    for every batch of points recorded. With interval, updates are sent at
+    most that often and only hold the newest point of each source. Stop
+    with:
+      { unsubscribe : [ <uuid>, ... ], (id : <str/int>) }
+
+    The result is sent once the data has been written, so results of
+    messages sent back to back may arrive in a different order. If the
+    server is too busy to take a data point, its status_code is 503.
     """
-    logging.debug("Message from source: " + repr(message))
-    result = {'status':'Invalid data', 'status_code':500}
+    WebSocket.messages.inc()
+    trace = None
+    if traced():
+      trace = time.time()
+      logging.debug('Message from source: ' + repr(message))
     try:
       j = json.loads(message)
-      if isinstance(j, list):
-        result = []
-        for i in j:
-          ret = process_data(i['uuid'], i['data'])
-          if 'id' in i:
-            result.append({'status' : ret['status'], 'status_code' : ret['code'], 'id' : j['id']})
-          else:
-            result.append({'status' : ret['status'], 'status_code' : ret['code']})
-      else:
-        ret = process_data(j['uuid'], j['data'])
-        result['status'] = ret['status']
-        result['status_code'] = ret['code']
-        if 'id' in j:
-          result['id'] = j['id']
+      if isinstance(j, dict) and 'latest' in j:
+        self.latest(j)
+        return
+      if isinstance(j, dict) and 'subscribe' in j:
+        self.subscribe(j)
+        return
+      if isinstance(j, dict) and 'unsubscribe' in j:
+        self.unsubscribe(j)
+        return
+      batch, entries = parse_entries(j)
     except Exception as e:
       logging.error('Source sent invalid message: ' + repr(e))
-      result = {'status':'Invalid data', 'status_code':500, 'description' : repr(e)}
-    finally:
-      print repr(result)
+      self.send({'status':'Invalid data', 'status_code':500, 'description' : repr(e)})
+      return
+    # Not waited for, so the next message is read while this is written
+    self.reply(batch, entries, trace)
+
+  @gen.coroutine
+  def reply(self, batch, entries, trace=None):
+    """
+    Queues the entries and sends back the result once all are written.
+    trace is when the message arrived, if it is to be logged.
+    """
+    results = yield ingest.put_many([(i['uuid'], i['data']) for i in entries])
+    if trace is not None:
+      logging.debug('Wrote %d data points in %.2fms: %s' % (len(entries), 1000.0 * (time.time() - trace), repr([r['status'] for r in results])))
+    result = []
+    for i, ret in zip(entries, results):
+      r = {'status' : ret['status'], 'status_code' : ret['code']}
+      if 'id' in i:
+        r['id'] = i['id']
+      result.append(r)
+    self.send(result if batch else result[0])
+
+  def answer(self, j, data=None):
+    result = {'status' : 'OK', 'status_code' : 200}
+    if data is not None:
+      result['data'] = data
+    if 'id' in j:
+      result['id'] = j['id']
+    self.send(result)
+
+  def latest(self, j):
+    uuids = uuid_list(j['latest'])
+    if uuids is None:
+      raise ValueError('latest has to be a string or a list of strings')
+    self.later(j, database.query_latest, uuids)
+
+  def subscribe(self, j):
+    uuids = uuid_list(j['subscribe'])
+    if uuids is None:
+      raise ValueError('subscribe has to be a string or a list of strings')
+    interval = j.get('interval', 0)
+    if not isinstance(interval, numbers.Real) or interval < 0:
+      raise ValueError('interval has to be a number of seconds')
+    self.interval = interval
+    self.subscribed.update(uuids)
+    self.later(j, subscriptions.subscribe, self, uuids)
+
+  @gen.coroutine
+  def later(self, j, fetch, *args):
+    """
+    Answers j with what fetch(*args) returns, once sources registered
+    through other workers are loaded
+    """
+    yield catch_up()
+    if self.ws_connection is None:
+      # Closed meanwhile
+      return
+    self.answer(j, fetch(*args))
+
+  def unsubscribe(self, j):
+    uuids = uuid_list(j['unsubscribe'])
+    if uuids is None:
+      raise ValueError('unsubscribe has to be a string or a list of strings')
+    self.subscribed.difference_update(uuids)
+    subscriptions.unsubscribe(self, uuids)
+    self.answer(j)
+
+  def push(self, points):
+    """
+    Sends points of subscribed sources, unless the last ones are still
+    being sent, in which case they go out together once it's done
+    """
+    self.updates.extend(points)
+    if len(self.updates) > self.BACKLOG:
+      self.updates = coalesce(self.updates)
+    if not self.pushing:
+      self.pushing = True
+      self._push()
+
+  @gen.coroutine
+  def _push(self):
+    while self.updates:
+      updates, self.updates = self.updates, []
+      if self.interval:
+        updates = coalesce(updates)
+      try:
+        yield self.write_message(json.dumps({'status' : 'Update', 'status_code' : 200, 'data' : updates}))
+      except WebSocketClosedError:
+        break
+      if self.interval:
+        yield gen.sleep(self.interval)
+    self.pushing = False
+
+  def send(self, result):
+    try:
       self.write_message(json.dumps(result))
+    except WebSocketClosedError:
+      logging.info('Source disconnected before result was sent')
 
   def on_close(self):
     logging.info("Source disconnected")
+    WebSocket.connections.discard(self)
+    subscriptions.unsubscribe(self, self.subscribed)
+    self.updates = []
+
+def fork_workers(count):
+  """
+  Forks count processes and returns the number of the worker (0 and up)
+  in each of them. The parent stays behind to start workers again if
+  they die, passes SIGTERM on to them and returns None once they all
+  have exited cleanly.
+  """
+  workers = {}
+  stopping = []
+  failed = []
+
+  def start(number):
+    pid = os.fork()
+    if pid == 0:
+      signal.signal(signal.SIGTERM, signal.SIG_DFL)
+      return True
+    workers[pid] = number
+    return False
+
+  def stop(signum, frame):
+    stopping.append(signum)
+    for pid in workers:
+      try:
+        os.kill(pid, signal.SIGTERM)
+      except OSError:
+        pass
+
+  for number in range(count):
+    if start(number):
+      return number
+  signal.signal(signal.SIGTERM, stop)
+  logging.info('Started %d workers' % count)
+
+  while workers:
+    try:
+      pid, status = os.wait()
+    except OSError as e:
+      if e.errno == errno.EINTR:
+        continue
+      raise
+    except KeyboardInterrupt:
+      # The workers got it too and are on their way out
+      stopping.append(signal.SIGINT)
+      continue
+    number = workers.pop(pid, None)
+    if number is None:
+      continue
+    if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+      logging.info('Worker %d has exited' % number)
+      continue
+    if stopping:
+      # Whatever it had buffered is lost
+      logging.error('Worker %d died (status %d) while stopping' % (number, status))
+      failed.append(number)
+      continue
+    logging.error('Worker %d died (status %d), starting it again' % (number, status))
+    shared.recover()
+    time.sleep(1)
+    if start(number):
+      return number
+  if failed:
+    sys.exit(1)
+  return None
 
 """ Finally, launch! """
 if __name__ == "__main__":
-  app.debug = False
   logging.info("dataPoints running")
-  container = WSGIContainer(app)
   server = Application([
     (r'/stream', WebSocket),
-    (r'.*', FallbackHandler, dict(fallback=container))
-    ])
-  server.listen(cmdline.port)
-  IOLoop.instance().start()
+    (r'/query', QueryHandler),
+    (r'/resolve', ResolveHandler),
+    (r'/register', RegisterHandler),
+    (r'/latest', LatestHandler),
+    (r'/stats', StatsHandler),
+    (r'/metrics', MetricsHandler),
+    (r'/entry/bulk', BulkHandler),
+    (r'/entry/([^/]+)', EntryHandler),
+    (r'/type/register', TypeRegisterHandler),
+    (r'/type(?:/([^/]+))?', TypeHandler),
+    (r'/source(?:/([^/]+))?', SourceHandler)
+    ], log_function=log_request)
+  sockets = bind_sockets(cmdline.port)
+
+  worker = 0
+  if cmdline.workers > 1:
+    worker = fork_workers(cmdline.workers)
+    if worker is None:
+      # All workers are done recording
+      if cmdline.latest_file:
+        shared.close()
+      sys.exit(0)
+    database.forked()
+    logging.info('Worker %d running' % worker)
+  if worker == 0:
+    database.resume()
+    if upgrade is not None:
+      upgrade.start()
+
+  if cmdline.batch_size > 0:
+    if not database.start_buffer(cmdline.batch_size, cmdline.batch_interval):
+      sys.exit(1)
+    logging.info('Buffering up to %d data points for %.1fs' % (cmdline.batch_size, cmdline.batch_interval))
+
+  http = HTTPServer(server, decompress_request=True)
+  http.add_sockets(sockets)
+  ingest = Ingest(cmdline.ingest_queue, cmdline.threads)
+  ingest.start()
+  subscriptions = Subscriptions(cmdline.workers > 1)
+  subscriptions.start()
+  SourceHandler.listing = Listing(database.sources)
+  TypeHandler.listing = Listing(database.types)
+  metrics.reading('datapoints_websocket_connections', 'gauge', 'Open WebSocket connections', lambda: len(WebSocket.connections))
+  metrics.reading('datapoints_websocket_pending_points', 'gauge', 'Data points waiting to be pushed to subscribers', lambda: sum([len(c.updates) for c in WebSocket.connections]))
+  metrics.reading('datapoints_subscribed_sources', 'gauge', 'Sources with subscribers', lambda: len(subscriptions.sources))
+
+  def shutdown(signum, frame):
+    IOLoop.instance().add_callback_from_signal(IOLoop.instance().stop)
+  signal.signal(signal.SIGTERM, shutdown)
+
+  try:
+    IOLoop.instance().start()
+  except KeyboardInterrupt:
+    pass
+  # Make sure any queued or buffered data points are written before exiting
+  logging.info("dataPoints shutting down")
+  IOLoop.instance().run_sync(ingest.drain)
+  database.disconnect()
+  if cmdline.latest_file and cmdline.workers == 1:
+    shared.close()
@@ -0,0 +1,79 @@
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import Storage
+from Storage import Aggregate
+
+class TDigestTest(unittest.TestCase):
+  def setUp(self):
+    random.seed(1)
+    self.values = [random.gauss(0, 1) for i in range(20000)]
+    self.ranks = sorted(self.values)
+
+  def rank(self, value):
+    """
+    Quantile of value in self.values
+    """
+    low, high = 0, len(self.ranks)
+    while low < high:
+      middle = (low + high) // 2
+      if self.ranks[middle] < value:
+        low = middle + 1
+      else:
+        high = middle
+    return low / float(len(self.ranks))
+
+  def assertClose(self, digest, q):
+    # Error is measured in quantile, it's smallest near the ends
+    error = abs(self.rank(digest.quantile(q)) - q)
+    self.assertTrue(error <= 0.01 if 0.05 < q < 0.95 else error <= 0.002, (q, error))
+
+  def test_empty(self):
+    self.assertEqual(Aggregate.TDigest().quantile(0.5), None)
+
+  def test_few_points_exact(self):
+    digest = Aggregate.TDigest()
+    for value in (5, 1, 3, 2, 4):
+      digest.add(value)
+    self.assertEqual(digest.quantile(0.5), 3)
+    self.assertEqual(digest.quantile(0), 1)
+    self.assertEqual(digest.quantile(1), 5)
+
+  def test_quantile_error(self):
+    digest = Aggregate.TDigest()
+    for value in self.values:
+      digest.add(value)
+    for q in (0.001, 0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99, 0.999):
+      self.assertClose(digest, q)
+    self.assertEqual(digest.quantile(0), min(self.values))
+    self.assertEqual(digest.quantile(1), max(self.values))
+    self.assertTrue(len(digest.centroids) <= 2 * digest.compression)
+
+  def test_merge(self):
+    parts = [Aggregate.TDigest() for i in range(10)]
+    for i, value in enumerate(self.values):
+      parts[i % len(parts)].add(value)
+    digest = Aggregate.TDigest()
+    for part in parts:
+      digest.merge(part)
+    digest.merge(Aggregate.TDigest())
+    for q in (0.001, 0.01, 0.1, 0.5, 0.9, 0.99, 0.999):
+      self.assertClose(digest, q)
+    self.assertEqual(sum([weight for mean, weight in digest.centroids]), len(self.values))
+    self.assertEqual(digest.quantile(1), max(self.values))
+
+  def test_quantile_aggregate(self):
+    median = Aggregate.create(Storage.GROUP_BY_MEDIAN)
+    upper = Aggregate.create(Storage.GROUP_BY_PERCENTILE, 90)
+    for value in range(1, 50):
+      median.add(value, value)
+      upper.add(value, value)
+    self.assertEqual(median.result(), 25)
+    # Interpolated between 44 and 45
+    self.assertAlmostEqual(upper.result(), 44.6)
+
+if __name__ == '__main__':
+  unittest.main()
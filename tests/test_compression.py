@@ -0,0 +1,51 @@
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Storage import Compression
+
+INT32_MIN = -2**31
+INT32_MAX = 2**31 - 1
+
+class CompressionTest(unittest.TestCase):
+  def roundtrip(self, points):
+    self.assertEqual(list(Compression.decode(Compression.encode(points))), points)
+
+  def test_empty(self):
+    self.roundtrip([])
+
+  def test_regular(self):
+    self.roundtrip([(1500000000 + i * 10, 20 + i % 3) for i in range(1000)])
+
+  def test_jitter(self):
+    random.seed(1)
+    ts = 1500000000
+    points = []
+    for i in range(1000):
+      ts += random.randint(1, 120)
+      points.append((ts, random.randint(-1000, 1000)))
+    self.roundtrip(points)
+
+  def test_int32_extremes(self):
+    self.roundtrip([(0, INT32_MIN), (1, INT32_MAX), (2, INT32_MIN), (3, 0), (4, INT32_MAX), (INT32_MAX, INT32_MIN)])
+
+  def test_small_is_two_bytes(self):
+    data = Compression.encode([(i * 10, 5) for i in range(100)])
+    # Version and count, then two bytes per point
+    self.assertEqual(len(data), 2 + 2 * 100)
+
+  def test_unknown_format(self):
+    self.assertRaises(ValueError, list, Compression.decode(b'\x02\x00'))
+
+  def test_read_range(self):
+    points = [(i * 10, i) for i in range(100)]
+    data = Compression.encode(points)
+    self.assertEqual(list(Compression.read(data, 95, 205)), points[10:21])
+    self.assertEqual(list(Compression.read(data, 95, 205, True)), points[10:21][::-1])
+    self.assertEqual(list(Compression.read(data, None, 15)), points[:2])
+    self.assertEqual(list(Compression.read(data, 2000, None)), [])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,71 @@
+import os
+import sys
+import math
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Storage import Downsample
+
+def generate(uuids, count, start=1000, step=10):
+  """
+  Rows of a sine per source, ordered by ts
+  """
+  for i in range(count):
+    for n, uuid in enumerate(uuids):
+      yield {'uuid' : uuid, 'ts' : start + i * step + n, 'value' : math.sin(i / 50.0) * 100 + n}
+
+class DownsampleTest(unittest.TestCase):
+  def downsample(self, rows, points, method, descending=False):
+    rows = list(rows)
+    ts = [row['ts'] for row in rows]
+    if descending:
+      rows.reverse()
+    # downsample() closes the rows when done, as it does with a query result
+    return list(Downsample.downsample((row for row in rows), points, min(ts), max(ts), method, descending))
+
+  def assertOrdered(self, rows, descending=False):
+    ts = [row['ts'] for row in rows]
+    self.assertEqual(ts, sorted(ts, reverse=descending))
+
+  def test_lttb_count(self):
+    rows = list(generate(['a'], 10000))
+    result = self.downsample(rows, 100, Downsample.LTTB)
+    self.assertEqual(len(result), 100)
+    self.assertOrdered(result)
+    self.assertEqual(result[0], rows[0])
+    self.assertEqual(result[-1], rows[-1])
+
+  def test_lttb_descending(self):
+    rows = list(generate(['a'], 10000))
+    result = self.downsample(rows, 100, Downsample.LTTB, True)
+    self.assertEqual(len(result), 100)
+    self.assertOrdered(result, True)
+    self.assertEqual(result[0], rows[-1])
+    self.assertEqual(result[-1], rows[0])
+
+  def test_minmax_count(self):
+    rows = list(generate(['a'], 10000))
+    rows[5000]['value'] = 1000
+    rows[7000]['value'] = -1000
+    result = self.downsample(rows, 100, Downsample.MINMAX)
+    self.assertEqual(len(result), 100)
+    self.assertOrdered(result)
+    # Spikes are never lost
+    self.assertTrue(rows[5000] in result)
+    self.assertTrue(rows[7000] in result)
+
+  def test_sources(self):
+    for method in (Downsample.LTTB, Downsample.MINMAX):
+      for descending in (False, True):
+        result = self.downsample(generate(['a', 'b', 'c'], 5000), 50, method, descending)
+        self.assertOrdered(result, descending)
+        for uuid in ('a', 'b', 'c'):
+          self.assertEqual(len([row for row in result if row['uuid'] == uuid]), 50)
+
+  def test_few_points(self):
+    rows = list(generate(['a', 'b'], 40))
+    for method in (Downsample.LTTB, Downsample.MINMAX):
+      self.assertEqual(self.downsample(rows, 40, method), rows)
+
+if __name__ == '__main__':
+  unittest.main()
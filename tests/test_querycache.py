@@ -0,0 +1,122 @@
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import Storage
+from Storage import Stream
+from Storage.QueryCache import QueryCache
+
+class QueryCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.now = int(time.time())
+    self.now -= self.now % 300
+    # Points by source id, one a minute for the last two hours
+    self.data = {}
+    for id in (1, 2):
+      self.data[id] = dict([(ts, id) for ts in range(self.now - 7200, self.now, 60)])
+    self.fetched = []
+    # Called while fetching, to record points meanwhile
+    self.during = None
+
+  def fetch(self, ids, ts_start, ts_end, count, groupby, mode, descending, percentile):
+    self.fetched.append((ts_start, ts_end))
+    if self.during is not None:
+      self.during()
+    points = []
+    for id in ids:
+      for ts, value in self.data[id].items():
+        if (ts_start is None or ts >= ts_start) and (ts_end is None or ts <= ts_end):
+          points.append((ts, id, value))
+    points.sort(reverse=descending)
+    rows = ({'uuid' : str(id), 'ts' : ts, 'value' : value} for ts, id, value in points)
+    result = Stream.group(rows, groupby, mode, percentile)
+    if count > 0:
+      result = Stream.limit(result, count)
+    return Stream.StreamIterator(result)
+
+  def query(self, cache, ts_start, ts_end=None):
+    return list(Stream.rows(cache.query([1, 2], ts_start, ts_end, 0, 300, Storage.GROUP_BY_SUM, False, 50)))
+
+  def expected(self, ts_start, ts_end=None):
+    return list(Stream.rows(self.fetch([1, 2], ts_start, ts_end, 0, 300, Storage.GROUP_BY_SUM, False, 50)))
+
+  def record(self, cache, id, value, ts):
+    self.data[id][ts] = value
+    cache.invalidate([(id, value, ts)])
+
+  def test_hit(self):
+    cache = QueryCache(self.fetch, 10000, 60)
+    start = self.now - 3600
+    expected = self.expected(start)
+    self.assertEqual(self.query(cache, start), expected)
+    del self.fetched[:]
+    self.assertEqual(self.query(cache, start), expected)
+    # Only what isn't settled yet was read again
+    self.assertEqual(len(self.fetched), 1)
+    self.assertEqual(cache.stats()['hits'], 1)
+
+  def test_late_point(self):
+    cache = QueryCache(self.fetch, 10000, 60)
+    start = self.now - 3600
+    self.query(cache, start)
+    self.record(cache, 1, 100, self.now - 1800)
+    # The bucket and the ones after it are dropped
+    entry = cache.entries.values()[0]
+    self.assertEqual(entry.high, self.now - 1800)
+    self.assertEqual(cache.stats()['rows'], 2 * 6)
+    self.assertEqual(self.query(cache, start), self.expected(start))
+
+  def test_late_point_first_bucket(self):
+    cache = QueryCache(self.fetch, 10000, 60)
+    start = self.now - 3600
+    self.query(cache, start)
+    self.record(cache, 2, 100, start)
+    self.assertEqual(cache.stats()['entries'], 0)
+    self.assertEqual(self.query(cache, start), self.expected(start))
+
+  def test_recent_point(self):
+    cache = QueryCache(self.fetch, 10000, 60)
+    start = self.now - 3600
+    self.query(cache, start)
+    rows = cache.stats()['rows']
+    epoch = cache.epoch
+    self.record(cache, 1, 100, int(time.time()))
+    self.assertEqual(cache.epoch, epoch)
+    self.assertEqual(cache.stats()['rows'], rows)
+
+  def test_epoch(self):
+    cache = QueryCache(self.fetch, 10000, 60)
+    start = self.now - 3600
+    # A late point recorded while the result is being read may or may not
+    # be in it, so it isn't kept
+    self.during = lambda: self.record(cache, 1, 100, self.now - 1800)
+    self.query(cache, start)
+    self.during = None
+    self.assertEqual(cache.stats()['entries'], 0)
+    self.assertEqual(self.query(cache, start), self.expected(start))
+    self.assertEqual(cache.stats()['misses'], 2)
+
+  def test_shared(self):
+    shared = Storage.Shared(slots=16)
+    cache = QueryCache(self.fetch, 10000, 60, shared)
+    other = QueryCache(self.fetch, 10000, 60, shared)
+    start = self.now - 3600
+    self.query(cache, start)
+    self.query(other, start)
+    # Late points recorded by another process drop everything
+    self.record(other, 1, 100, self.now - 1800)
+    self.assertEqual(self.query(cache, start), self.expected(start))
+    self.assertEqual(cache.stats()['misses'], 2)
+    self.query(other, start)
+    self.assertEqual(other.stats()['hits'], 1)
+
+  def test_size(self):
+    cache = QueryCache(self.fetch, 10, 60)
+    self.query(cache, self.now - 3600)
+    self.assertEqual(cache.stats()['entries'], 0)
+    self.assertEqual(cache.stats()['rows'], 0)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,130 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'clients', 'python-dc-client'))
+from datapoints.spool import spool
+
+def entries(start, count):
+  return [{'uuid' : 'u', 'data' : {'value' : i, 'ts' : i}} for i in range(start, start + count)]
+
+def values(read):
+  return [entry['data']['value'] for entry, offset in read]
+
+class SpoolTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.filename = os.path.join(self.directory, 'spool')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def checkpoint(self):
+    with open(self.filename + '.offset') as f:
+      return int(f.read())
+
+  def test_out_of_order_acks(self):
+    s = spool(self.filename)
+    s.append(entries(0, 100))
+    read = s.read(10)
+    self.assertEqual(values(read), range(10))
+    # The checkpoint only moves past values acked in order
+    for entry, offset in read[5:]:
+      s.ack(offset)
+    s.commit()
+    self.assertEqual(s.checkpoint, 0)
+    for entry, offset in read[:4]:
+      s.ack(offset)
+    s.commit()
+    self.assertEqual(s.checkpoint, read[3][1])
+    self.assertEqual(self.checkpoint(), read[3][1])
+    s.ack(read[4][1])
+    s.commit()
+    self.assertEqual(self.checkpoint(), read[9][1])
+
+    # A restart sends the values after the checkpoint again
+    s.read(20)
+    self.assertEqual(values(spool(self.filename).read(3)), [10, 11, 12])
+
+  def test_rewind(self):
+    s = spool(self.filename)
+    s.append(entries(0, 10))
+    read = s.read(5)
+    s.ack(read[1][1])
+    s.rewind()
+    self.assertEqual(values(s.read(10)), range(10))
+
+  def test_crash_while_appending(self):
+    s = spool(self.filename)
+    s.append(entries(0, 10))
+    end = s.end
+    with open(self.filename, 'ab') as f:
+      f.write('{"uuid": "u", "da')
+    s = spool(self.filename)
+    self.assertEqual(s.end, end)
+    self.assertEqual(os.path.getsize(self.filename), end)
+    s.append(entries(10, 1))
+    self.assertEqual(values(s.read(100)), range(11))
+
+  def test_crash_before_checkpoint(self):
+    s = spool(self.filename)
+    s.append(entries(0, 10))
+    for entry, offset in s.read(10):
+      s.ack(offset)
+    s.commit()
+    # Emptied once everything is acked
+    self.assertEqual(os.path.getsize(self.filename), 0)
+    # A checkpoint left beyond the end of the file reads as the start
+    with open(self.filename + '.offset', 'w') as f:
+      f.write('1000\n')
+    s = spool(self.filename)
+    s.append(entries(10, 5))
+    self.assertEqual(values(s.read(100)), range(10, 15))
+
+  def test_drop_oldest(self):
+    s = spool(self.filename, size=2000)
+    for i in range(0, 200, 10):
+      s.append(entries(i, 10))
+    self.assertTrue(len(s) <= 2000)
+    self.assertTrue(s.dropped > 0)
+    kept = values(s.read(1000))
+    self.assertEqual(kept, range(s.dropped, 200))
+    s.rewind()
+    # The checkpoint is saved and the file compacted
+    self.assertTrue(os.path.getsize(self.filename) <= 2 * 2000)
+    self.assertEqual(values(spool(self.filename, size=2000).read(1000)), kept)
+
+  def test_drop_oldest_being_sent(self):
+    s = spool(self.filename, size=1000)
+    s.append(entries(0, 10))
+    read = s.read(5)
+    s.append(entries(10, 100))
+    # Values dropped while being sent don't hold up the checkpoint
+    for entry, offset in read:
+      s.ack(offset)
+    s.commit()
+    self.assertTrue(len(s) <= 1000)
+    self.assertEqual(values(s.read(1000))[-1], 109)
+
+  def test_drop_oldest_large_append(self):
+    s = spool(self.filename, size=1000)
+    s.append(entries(0, 100))
+    self.assertTrue(len(s) <= 1000)
+    self.assertEqual(values(s.read(1000)), range(s.dropped, 100))
+
+  def test_drop_newest(self):
+    s = spool(self.filename, size=1000, drop='newest')
+    s.append(entries(0, 100))
+    self.assertTrue(len(s) <= 1000)
+    kept = values(s.read(1000))
+    self.assertEqual(kept, range(100 - s.dropped))
+    s.append(entries(100, 1))
+    self.assertEqual(values(s.read(1000)), [])
+
+  def test_drop(self):
+    self.assertRaises(ValueError, spool, self.filename, 1000, 'random')
+
+if __name__ == '__main__':
+  unittest.main()